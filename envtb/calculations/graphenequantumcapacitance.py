@@ -1,4 +1,5 @@
 from envtb.quantumcapacitance import electrostatics, quantumcapacitance
+from envtb.quantumcapacitance.sweep import VoltageSweep
 import numpy
 
 
@@ -30,12 +31,16 @@ def PeriodicGraphenePatchWithGrapheneSidegatesSiO2Rectangle(
     grapheneelements = [periodicrect[graphenepos, y] for y in range(
         (breite-graphenebreite)/2, (breite+graphenebreite)/2)]
 
-    Ef_dependence_function = quantumcapacitance.BulkGrapheneWithTemperature(
-        temperature, gridsize).Ef_interp
+    Ef_dependence = quantumcapacitance.BulkGrapheneWithTemperature(
+        temperature, gridsize)
+    Ef_dependence_function = Ef_dependence.Ef_interp
+    Ef_dependence_derivative = Ef_dependence.dEf_dQ
     for element in grapheneelements:
         element.potential = 0
         element.fermi_energy = 0
         element.fermi_energy_charge_dependence = Ef_dependence_function
+        element.fermi_energy_charge_dependence_derivative = \
+            Ef_dependence_derivative
 
     graphenesidegateelementsleft = [periodicrect[graphenepos, y]
                                     for y in range(sidegatebreite)]
@@ -44,6 +49,8 @@ def PeriodicGraphenePatchWithGrapheneSidegatesSiO2Rectangle(
     for element in graphenesidegateelementsleft+graphenesidegateelementsright:
         element.potential = 0
         element.fermi_energy_charge_dependence = Ef_dependence_function
+        element.fermi_energy_charge_dependence_derivative = \
+            Ef_dependence_derivative
 
     for x in range(graphenepos, hoehe):
         for y in range(breite):
@@ -55,25 +62,20 @@ def PeriodicGraphenePatchWithGrapheneSidegatesSiO2Rectangle(
 
 def QuantumCapacitanceVoltageSweep(
         qcsolver, container, charge_operator,
-        solver, voltages, voltage_elements, charge_elements):
+        solver, voltages, voltage_elements, charge_elements, processes=1):
     # all elements whose charge shall be saved are in charge_elements,
     # i.e. graphene, sidegate etc.
-    charges = []
-    for v in voltages:
-        print v
-        for elem in voltage_elements:
-            elem.potential = v
-            # periodicrect[hoehe-1,y].fermi_energy=v #not needed!?
-        # print "env"
-        qcsolver.refresh_environment_contrib()
-        # print "qcsolve"
-        qcsolution = qcsolver.solve()
-        # print "inhom"
-        inhom = container.createinhomogeneity()
-        # print "solve"
-        sol = solver(inhom)
-        charges.append(container.charge(sol, charge_operator, charge_elements))
-    return numpy.array(charges)
+    # container, charge_operator and solver have to be those of qcsolver,
+    # the sweep uses the system of qcsolver. The voltage points are
+    # distributed over processes worker processes.
+    if container is not qcsolver.container or \
+            charge_operator is not qcsolver.charge_operator or \
+            solver is not qcsolver.solver:
+        raise ValueError('container, charge_operator and solver have to be '
+                         'those of qcsolver')
+    sweep = VoltageSweep(qcsolver, [voltage_elements], charge_elements)
+    charges, potentials = sweep.run(voltages, processes)
+    return charges
     
 def ClassicalCapacitance(container, charge_operator,
                          solver, voltage_elements, charge_elements):
@@ -102,7 +104,7 @@ def QuantumCapacityOfGraphene2DModelWithSidegates(
         hoehe, breite, graphenepos,
         graphenebreite, vstart, vend, dv, graphenesidegatebreite=None,
         vsidegate=[(0, 0)], graphenesidegate_behavior='metal',
-        normalize_to_classical_capacitance=False):
+        normalize_to_classical_capacitance=False, processes=1):
     # breite=400
     # hoehe=600
     temperature = 300
@@ -150,27 +152,35 @@ def QuantumCapacityOfGraphene2DModelWithSidegates(
                          solver, backgateelements, grapheneelements)  
                          
         print classical_capacitance      
+        classical_capacitance_list.append(classical_capacitance)
 
-        print "loop " + str(vrightsidegate)
-        charges = QuantumCapacitanceVoltageSweep(
-            qcsolver, percont, lapl, solver, voltages,
-            backgateelements, grapheneelements)
-        print "end"
-
-        totalcharge = numpy.array([sum(x) for x in charges])
+    # all sidegate configurations in one sweep, backgate voltage sweeps
+    # one after the other (continuation)
+    print "loop"
+    sweep = VoltageSweep(
+        qcsolver, [backgateelements, graphenesidegateelementsleft,
+                   graphenesidegateelementsright], grapheneelements)
+    points = [(v, vleftsidegate, vrightsidegate)
+              for vleftsidegate, vrightsidegate in vsidegate
+              for v in voltages]
+    allcharges, potentials = sweep.run(points, processes)
+    print "end"
+
+    for nr, classical_capacitance in enumerate(classical_capacitance_list):
+        charges = allcharges[nr*len(voltages):(nr+1)*len(voltages)]
+        totalcharge = charges.sum(axis=1)
         capacitance2 = (totalcharge[2:]-totalcharge[:-2]) / \
             len(grapheneelements)*my_gridsize/(2*dv)
             
         if normalize_to_classical_capacitance:
             capacitance2 /= classical_capacitance
         capacitance_list.append(capacitance2)
-        classical_capacitance_list.append(classical_capacitance)
         
     return voltages[1:-1], capacitance_list, classical_capacitance_list
 
 
 def LoopQuantumCapacitanceWithSidegatesFixedSystem(
-        sidegatevoltages, graphenesidegate_behavior='metal'):
+        sidegatevoltages, graphenesidegate_behavior='metal', processes=None):
     """
     The function calculates the quantum capacitance of a GNR, embedded in the
     following system:
@@ -193,6 +203,8 @@ def LoopQuantumCapacitanceWithSidegatesFixedSystem(
                       symmetrically and asymetrically.
     graphenesidegate_behaviour: can have the values 'metal' and 'graphene',
                       the sidegates will behave accordingly.
+    processes: number of worker processes for the voltage sweep. Default
+               is None (one per CPU).
 
     Return:
 
@@ -222,17 +234,19 @@ def LoopQuantumCapacitanceWithSidegatesFixedSystem(
                      for sidegatevoltage in sidegatevoltages
                      for sidegatesign in (1, -1)]
         # print sidegatebreite
-        voltages, capacitancequantum = \
+        voltages, capacitancequantum, classicalcapacitance = \
             QuantumCapacityOfGraphene2DModelWithSidegates(
                 hoehe, breite, hoehe+graphenepos, graphenebreite, vstart,
-                vend, dv, sidegatebreite, vsidegate, graphenesidegate_behavior)
+                vend, dv, sidegatebreite, vsidegate, graphenesidegate_behavior,
+                processes=processes)
         capacitancequantumlist.append(capacitancequantum)
         parameters.append((graphenebreite, vsidegate))
     return voltages, parameters, capacitancequantumlist
 
 
-def CalcSidegateSaveToFile(sidegatevoltage, graphenesidegate_behavior='metal'):
+def CalcSidegateSaveToFile(sidegatevoltage, graphenesidegate_behavior='metal',
+                           processes=None):
     voltages, parameters, capacitancequantumlist = \
         LoopQuantumCapacitanceWithSidegatesFixedSystem(
-            (sidegatevoltage,), graphenesidegate_behavior)
+            (sidegatevoltage,), graphenesidegate_behavior, processes)
     numpy.savetxt("qc"+str(sidegatevoltage)+".txt", capacitancequantumlist[0])
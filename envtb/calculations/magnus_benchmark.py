@@ -0,0 +1,74 @@
+#! /usr/bin/env python
+"""
+Convergence benchmark of the time propagation of an eigenstate of a
+graphene flake in a laser pulse:
+
+- 'endpoint': the scheme of time_eigenstate_laser.py so far, one Lanczos
+  exponential per step with the vector potential at the end of the step
+- 'midpoint': MagnusPropagator(order=2)
+- 'CFM4': MagnusPropagator(order=4), commutator-free Magnus with the
+  vector potential at the Gauss-Legendre nodes
+
+The error is the norm of the difference to a CFM4 reference with a very
+small time step, at the end of the pulse.
+"""
+import time
+import numpy as np
+import envtb.ldos.hamiltonian
+import envtb.time_propagator.lanczos
+import envtb.time_propagator.magnus
+import envtb.time_propagator.vector_potential
+
+
+def propagate_endpoint(ham, A_pot, wf, dt, nsteps, NK=12, num_error=10**(-24)):
+    for i in xrange(nsteps):
+        ham2 = ham.apply_vector_potential(A_pot((i + 1) * dt))
+        prop = envtb.time_propagator.lanczos.LanczosPropagator(
+            wf=wf, ham=ham2, NK=NK, dt=dt)
+        wf_final, dt_new, NK = prop.propagate(num_error=num_error, regime='TSC')
+        wf = wf_final.wf1d
+    return wf
+
+
+def convergence_benchmark(Nx=10, Ny=12, amplitude_E0=2*10**7,
+                          frequency=10**14, Nc=1,
+                          steps=[125, 250, 500, 1000, 2000],
+                          reference_steps=8000):
+
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Ny, Nx)
+    ham.build_hamiltonian()
+    w, v = np.linalg.eigh(ham.mtot.toarray())
+    wf0 = v[:, len(w) / 2 + 2].astype(complex)
+
+    A_pot = envtb.time_propagator.vector_potential.SinSqEnvelopePulse(
+        amplitude_E0=amplitude_E0, frequency=frequency, Nc=Nc)
+    T = A_pot.pulse_duration
+
+    reference = envtb.time_propagator.magnus.MagnusPropagator(
+        ham, A_pot, order=4, exponential='chebyshev').propagate(
+        wf0, 0.0, T / reference_steps, reference_steps)
+
+    schemes = [
+        ('endpoint', lambda dt, n: propagate_endpoint(ham, A_pot, wf0, dt, n)),
+        ('midpoint', lambda dt, n: envtb.time_propagator.magnus.MagnusPropagator(
+            ham, A_pot, order=2, NK=12, num_error=10**(-24)).propagate(wf0, 0.0, dt, n)),
+        ('CFM4', lambda dt, n: envtb.time_propagator.magnus.MagnusPropagator(
+            ham, A_pot, order=4, NK=12, num_error=10**(-24)).propagate(wf0, 0.0, dt, n))]
+
+    print '%8s %10s %12s %10s' % ('scheme', 'steps', 'error', 'time (s)')
+    results = {}
+    for name, propagate in schemes:
+        results[name] = []
+        for n in steps:
+            st = time.time()
+            wf = propagate(T / n, n)
+            wall = time.time() - st
+            error = np.linalg.norm(wf - reference)
+            results[name].append((n, error, wall))
+            print '%8s %10d %12.3e %10.3f' % (name, n, error, wall)
+
+    return results
+
+
+if __name__ == '__main__':
+    convergence_benchmark()
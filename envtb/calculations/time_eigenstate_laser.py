@@ -4,6 +4,9 @@ import numpy as np
 #import matplotlib.pylab as plt
 import envtb.time_propagator.lanczos
 import envtb.time_propagator.wave_function
+import envtb.time_propagator.trajectory
+import envtb.time_propagator.driver
+import envtb.time_propagator.many_electron
 import envtb.time_propagator.vector_potential
 import envtb.wannier90.w90hamiltonian as w90hamiltonian
 
@@ -77,66 +80,80 @@ def propagate_graphene_pulse(Nx=20, Ny=20, frame_num=10, magnetic_B=None):
 
     N_range = range(myid * Nthread, (myid + 1) * Nthread, 10)
 
-    for Nstate in N_range:
-
-        wf_out = open('wave_functions_%(Nstate)d.out' % vars(), 'w')
-        expansion_out = open('expansion_%(Nstate)d.out' % vars(), 'w')
-        coords_out = open('coords_current_%(Nstate)d.out' % vars(), 'w')
-        dipole_out = open('dipole_%(Nstate)d.out' % vars(), 'w')
+    def frame_data(t, wf, ham2):
+        frame = wf.calculate_observables(ham=ham2, v=v)
+        x, y = np.abs(frame['position'][:2])
+        j_x, j_y = frame['current'][:2]
+        return {'expansion': np.abs(frame['expansion']),
+                'x': x, 'y': y, 'j_x': j_x, 'j_y': j_y}
 
-        dt_new = dt
-        NK_new = NK
-        time_counter = 0.0
+    for Nstate in N_range:
 
         '''initialize wave function
-        create wave function from file (WaveFunction(coords=ham.coords).wave_function_from_file),
+        create wave function from file (WaveFunction(coords=ham.coords).wave_function_from_file('wave_functions_0.trj')),
         wave function from eigenstate (WaveFunction(vec=v[:, Nstate],coords=ham.coords)) or
         create Gaussian wave packet (GaussianWavePacket(coords=ham.coords, ic=ic, p0=[0.0, 1.5], sigma=7.))
         '''
-        #wf_final = envtb.time_propagator.wave_function.WaveFunction(coords=ham.coords)
-        #time_counter = wf_final.wave_function_from_file('wave_functions_0.out')
-        wf_final = envtb.time_propagator.wave_function.WaveFunction(vec=v[:, Nstate],coords=ham.coords)
+        wf_init = envtb.time_propagator.wave_function.WaveFunction(vec=v[:, Nstate],coords=ham.coords)
         ##ic = Nx/2 * Ny + Ny/2
-        ##wf_final = envtb.time_propagator.wave_function.GaussianWavePacket(
+        ##wf_init = envtb.time_propagator.wave_function.GaussianWavePacket(
         ##        ham.coords, ic, p0=[0.0, 1.5], sigma=7.)
-        #maxel = max(wf_final.wf1d)
 
-        wf_final.save_wave_function_data(wf_out, time_counter)
+        '''the driver applies A_pot once per step and continues from the
+        checkpoint if the run was interrupted'''
+        driver = envtb.time_propagator.driver.TimeEvolutionDriver(
+            wf_init, ham, dt, frame_num, vector_potential=A_pot, NK=NK,
+            checkpoint='checkpoint_%(Nstate)d.npz' % vars(),
+            checkpoint_every=100)
+        restarted = driver.restart()
 
-        import time
+        wf_out = envtb.time_propagator.trajectory.TrajectoryWriter(
+            'wave_functions_%(Nstate)d.trj' % vars(), len(v[:, Nstate]),
+            expansion_size=Nall, observables=['x', 'y', 'j_x', 'j_y'],
+            description={'Nstate': Nstate, 'dt': dt, 'Nx': Nx, 'Ny': Ny},
+            append=restarted)
+        driver.add_trajectory(wf_out, every=10, callback=frame_data)
 
-        '''main loop'''
-        for i in xrange(frame_num):
+        driver.run()
 
-            #print 'frame %(i)d' % vars()
-            time_counter += dt_new
+        wf_out.close()
 
-            st = time.time()
-            ham2 = ham.apply_vector_potential(A_pot(time_counter))
-            #print 'efficiency ham2', time.time() - st
+    pypar.finalize()
 
-            #print 'time', time_counter, 'A', A_pot(time)
-            st = time.time()
-            wf_init = wf_final
-            wf_final, dt_new, NK_new = propagate_wave_function(
-                  wf_init, ham2, NK=NK_new, dt=dt_new, maxel=None,
-                  regime='TSC', alpha=0.7)
-                  #file_out = directory+'f%03d_2d.png' % i)
-            #print 'efficiency lanz', time.time() - st
+    return None
 
-            if np.mod(i,10) == 0:
-                  wf_final.save_wave_function_data(wf_out, time_counter)
-                  wf_final.save_wave_function_expansion(expansion_out, v)
-                  wf_final.save_coords_current(coords_out, A_pot(time))
+def propagate_graphene_pulse_many_electron(Nx=20, Ny=20, frame_num=10, mu=0.0,
+                                           kT=0.0, every=10):
+    """
+    The occupied states of the energy window (Fermi occupations) are
+    propagated together as one block, current, dipole and occupations of
+    the eigenstates are traces over the block. The high harmonic spectrum
+    is calculated from the current in the same run.
+    """
+    ham = envtb.ldos.hamiltonian.HamiltonianGraphene(Nx, Ny)
 
+    Nall = 250
 
-        wf_out.close()
-        expansion_out.close()
-        coords_out.close()
-        dipole_out.close()
+    w, v = ham.sorted_eigenvalue_problem(k=Nall, sigma=0.0)
+    f = envtb.time_propagator.many_electron.fermi_occupations(w, mu, kT)
+    occupied = f > 10**(-10)
 
-    pypar.finalize()
+    A_pot = envtb.time_propagator.vector_potential.SinSqEnvelopePulse(
+        amplitude_E0=laser_amp, frequency=laser_freq, Nc=Nc, cep=CEP, direction=direct)
+
+    run = envtb.time_propagator.many_electron.ManyElectronPropagation(
+        ham, v[:, occupied], dt, frame_num, vector_potential=A_pot,
+        weights=f[occupied], v=v, every=every, checkpoint='checkpoint_block.npz',
+        checkpoint_every=100, output='many_electron')
+    run.restart()
+    run.run()
+
+    t, j = run.results('current')
+    frequencies, spectrum = envtb.time_propagator.many_electron.harmonic_spectrum(
+        t, np.dot(j[:, :2], direct))
+    np.savetxt('harmonic_spectrum.out',
+               np.transpose([frequencies / laser_freq, spectrum]))
 
     return None
 
-propagate_graphene_pulse(Nx=Nx, Ny=Ny, frame_num=Nframes)
+propagate_graphene_pulse_many_electron(Nx=Nx, Ny=Ny, frame_num=Nframes)
@@ -0,0 +1,208 @@
+import numpy as np
+import os
+import multiprocessing
+import scipy.sparse
+
+# ensemble and function of DisorderEnsemble.map(), inherited by the forked
+# worker processes
+_active_map = None
+
+
+def _map_realization(n):
+    ensemble, function = _active_map
+    return function(ensemble.realization(n))
+
+
+class DisorderConfiguration(object):
+    """
+    One realization of structural disorder of a hamiltonian:
+
+    vacancies: indices of removed sites
+    onsite: on-site energies (Anderson disorder), array (N,)
+    hopping: relative change delta_ij of the hoppings,
+             H_ij -> H_ij (1 + delta_ij), sparse matrix (strictly upper
+             triangular, the lower triangle is the conjugate)
+    """
+
+    def __init__(self, vacancies=None, onsite=None, hopping=None):
+        self.vacancies = vacancies
+        self.onsite = onsite
+        self.hopping = hopping
+
+    def apply(self, ham):
+        """
+        The hamiltonian of this realization: the hopping and on-site
+        disorder are added as sparse (data, diagonal) updates, the vacancies
+        are removed from the matrix (submatrix of the remaining sites).
+
+        Return:
+        a copy of the hamiltonian instance. With vacancies, its coords are
+        those of the remaining sites and ins.sites are their indices in the
+        clean hamiltonian. The remaining sites do not form slices any more:
+        as for lattice.LatticeHamiltonian, Nx = 1 and Ny = Ntot (m0 is the
+        whole matrix, mI is zero), so the ribbon operations (slices, leads,
+        band structure, transport) are not available.
+        """
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        mt = ham.mtot.tocsr()
+        N = mt.shape[0]
+
+        if self.hopping is not None:
+            delta = self.hopping + self.hopping.T
+            mt = mt + mt.multiply(delta)
+        if self.onsite is not None:
+            mt = mt + scipy.sparse.diags(self.onsite, 0, shape=(N, N), format='csr')
+
+        if self.vacancies is None or len(self.vacancies) == 0:
+            return ham.copy_ins_with_new_matrix(scipy.sparse.csr_matrix(mt))
+
+        keep = np.ones(N, dtype=bool)
+        keep[self.vacancies] = False
+        sites = np.flatnonzero(keep)
+        matrix = scipy.sparse.csr_matrix(mt)[sites][:, sites]
+        ins = ham.copy_ins_with_new_matrix(matrix)
+        ins.coords = ham.coords_array()[sites]
+        ins.Nx = 1
+        ins.Ny = len(sites)
+        ins.Ntot = len(sites)
+        ins.m0 = matrix
+        ins.mI = scipy.sparse.csr_matrix(matrix.shape)
+        ins.sites = sites
+        return ins
+
+# end class DisorderConfiguration
+
+
+class DisorderEnsemble(object):
+    """
+    Ensemble of disorder realizations of a hamiltonian. Realization n is
+    drawn from its own random state (seed, n), so it does not depend on
+    which other realizations are calculated and the realizations can be
+    calculated in parallel (map()).
+
+    Usage:
+
+        ensemble = DisorderEnsemble(ham, vacancies=0.01, anderson=0.5,
+                                    seed=1)
+        dos = ensemble.average(lambda h: kpm.density_of_states(h.mtot)[1],
+                               nrealizations=100)
+    """
+
+    def __init__(self, ham, vacancies=0, anderson=0.0, hopping=0.0,
+                 sublattice=None, distribution='uniform', seed=0):
+        """
+        ham: clean hamiltonian instance
+        vacancies: number of removed sites, or their concentration if < 1
+        sublattice: None, 0 or 1; the vacancies are restricted to the sites
+                    with index % 2 == sublattice (as in add_vacancies)
+        anderson: width W of the on-site disorder
+        hopping: relative width of the hopping disorder (on the stored
+                 off-diagonal elements)
+        distribution: 'uniform' in [-W/2, W/2] or 'gaussian' with standard
+                      deviation W
+        seed: seed of the ensemble
+        """
+        if distribution not in ('uniform', 'gaussian'):
+            raise ValueError('unknown distribution %s' % distribution)
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        self.ham = ham
+        self.N = ham.mtot.shape[0]
+        if sublattice is None:
+            self.candidates = np.arange(self.N)
+        else:
+            self.candidates = np.arange(sublattice, self.N, 2)
+        if 0 < vacancies < 1:
+            vacancies = int(round(vacancies * len(self.candidates)))
+        self.nvacancies = int(vacancies)
+        self.anderson = anderson
+        self.hopping = hopping
+        self.distribution = distribution
+        self.seed = seed
+        self.__bonds = scipy.sparse.triu(ham.mtot, k=1).tocoo()
+
+    def __random(self, random, width, size):
+        if self.distribution == 'uniform':
+            return width * (random.rand(size) - 0.5)
+        return width * random.randn(size)
+
+    def configuration(self, n):
+        """
+        The DisorderConfiguration of realization n.
+        """
+        random = np.random.RandomState([self.seed, n])
+        vacancies = None
+        onsite = None
+        hopping = None
+        if self.nvacancies > 0:
+            vacancies = np.sort(random.choice(self.candidates, self.nvacancies,
+                                              replace=False))
+        if self.anderson != 0.0:
+            onsite = self.__random(random, self.anderson, self.N)
+        if self.hopping != 0.0:
+            bonds = self.__bonds
+            hopping = scipy.sparse.coo_matrix(
+                (self.__random(random, self.hopping, bonds.nnz),
+                 (bonds.row, bonds.col)), shape=bonds.shape).tocsr()
+        return DisorderConfiguration(vacancies, onsite, hopping)
+
+    def realization(self, n):
+        """
+        The hamiltonian of realization n.
+        """
+        return self.configuration(n).apply(self.ham)
+
+    def realizations(self, nrealizations, start=0):
+        """
+        Iterator over the hamiltonians of the realizations
+        start ... start + nrealizations - 1.
+        """
+        for n in xrange(start, start + nrealizations):
+            yield self.realization(n)
+
+    def map(self, function, nrealizations, start=0, processes=1):
+        """
+        function(hamiltonian) for the realizations start ...
+        start + nrealizations - 1.
+
+        processes: number of worker processes, None means one per CPU. The
+                   workers are forked (not available on Windows, where the
+                   realizations are calculated serially), so function can
+                   be any callable, e.g. a lambda.
+
+        Return:
+        list of the results
+        """
+        global _active_map
+
+        indices = range(start, start + nrealizations)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if not hasattr(os, 'fork'):
+            processes = 1
+        if processes == 1 or nrealizations < 2:
+            return [function(self.realization(n)) for n in indices]
+
+        _active_map = (self, function)
+        pool = multiprocessing.Pool(processes)
+        try:
+            return pool.map(_map_realization, indices)
+        finally:
+            pool.close()
+            pool.join()
+            _active_map = None
+
+    def average(self, function, nrealizations, start=0, processes=1):
+        """
+        Disorder average of function(hamiltonian) (number or array), see
+        map().
+
+        Return:
+        mean, standard error of the mean
+        """
+        values = np.array(self.map(function, nrealizations, start, processes))
+        error = np.std(values, axis=0) / np.sqrt(max(len(values) - 1, 1))
+        return np.mean(values, axis=0), error
+
+# end class DisorderEnsemble
@@ -2,7 +2,7 @@ import hamiltonian
 from scipy import sparse
 from scipy.sparse import linalg
 import numpy as np
-import make_matrix as mm
+import transport
 
 class GreensFunction:
     """
@@ -27,16 +27,27 @@ class GreensFunction:
     def __inv_greens_matrix(self, E, H):
         
         zplus = complex(0.0, 1.0) * 10**(-12)
-        #sig1 = np.zeros((H.Ny * Nx, H.Ny * Nx), dtype = complex)
-        #sig2 = np.zeros((H.Ny * Nx, H.Ny * Nx), dtype = complex)
-      
-        #if self.bc == 'open':
-        #sig1[0,0] = self.calculate_self_energy_for_1d(E, -0.05)
-        #sig2[-1,-1] = self.calculate_self_energy_for_1d(E, 0.05)
         matrix = (E + zplus) * sparse.eye(H.Ntot, H.Ntot, k = 0, dtype = complex) - H.mtot
+        if self.bc == 'open':
+            matrix = matrix - self.__self_energies(E, H)
+        elif self.bc != 'closed':
+            raise ValueError("unknown boundary condition %s" % self.bc)
         solver = linalg.factorized(matrix.tocsc())
         return solver
     
+    def __self_energies(self, E, H):
+        """
+        Self-energies of semi-infinite leads (continuations of the ribbon,
+        H.m0 and H.mI) on the first and the last slice
+        """
+        Ny = H.Ny
+        sigma = sparse.lil_matrix((H.Ntot, H.Ntot), dtype = complex)
+        sigma[:Ny, :Ny] = transport.Lead(H.m0, H.mI, 'left').self_energy(E)
+        # added, as both leads couple to the same slice for Nx == 1
+        sigma[H.Ntot - Ny:, H.Ntot - Ny:] = sigma[H.Ntot - Ny:, H.Ntot - Ny:] + \
+            transport.Lead(H.m0, H.mI, 'right').self_energy(E)
+        return sigma.tocsc()
+    
     def get_diagonal_elements(self):
         
         vec = np.eye(self.Ntot, self.Ntot)
@@ -45,13 +56,3 @@ class GreensFunction:
         Green_diagonal = np.array([Green_solver(vec[:, i])[i] for i in xrange(self.Ntot)])
         
         return Green_diagonal
-    
-    def __calculate_self_energy_for_1d(self, Ef, U):
-        zplus = complex(0.0,1.0) * 10**(-12)
-        ck = (1.-((Ef + zplus - U)/(2. * mm.t)))
-        ka = np.arccos(ck)
-        sigma = -mm.t * (np.cos(ka) + complex(0.0,1.0) * np.sin(ka))
-      
-        return sigma
-
-
@@ -3,6 +3,8 @@ import make_matrix as mm
 import make_matrix_graphene as mmg
 import make_matrix_graphene_armchair_5nn as mmg_a
 import potential
+import kpm
+import lazy_matrix
 import copy
 try:
     import matplotlib.pylab as plt
@@ -10,11 +12,24 @@ except:
     print 'Warning(hamiltonian): no module matplotlib'
     pass
 import scipy.sparse
+import scipy.spatial
 from scipy.sparse import linalg
+import scipy.sparse.csgraph
 import cmath
+import os
+import multiprocessing
 #from scipy.sparse import linalg
 #from scipy import sparse
 
+# hamiltonian and options of GeneralHamiltonian.ribbon_bands(), inherited by
+# the forked worker processes
+_active_bands = None
+
+
+def _ribbon_bands_chunk(krange):
+    ham, kwrds = _active_bands
+    return ham.ribbon_bands(krange, processes=1, **kwrds)
+
 def FermiFunction(x, mu, kT):
     return 1./(1. + np.exp((x - mu).real/kT))
 
@@ -36,9 +51,79 @@ class GeneralHamiltonian(object):
         self.w = None
         self.v = None
 
+    # mtot, m0 and mI of a lazy hamiltonian (see copy_ins_with_modifier())
+    # are assembled from self._lazy on first access
+    @property
+    def mtot(self):
+        if getattr(self, '_mtot', None) is None and getattr(self, '_lazy', None) is not None:
+            self._mtot = self._lazy.tocsr()
+        return getattr(self, '_mtot', None)
+
+    @mtot.setter
+    def mtot(self, mtot):
+        self._mtot = mtot
+        self._lazy = None
+
+    @property
+    def m0(self):
+        if getattr(self, '_m0', None) is None and getattr(self, '_lazy', None) is not None:
+            self._m0 = self._lazy.block((0, self.Ny), (0, self.Ny))
+        return getattr(self, '_m0', None)
+
+    @m0.setter
+    def m0(self, m0):
+        self._m0 = m0
+
+    @property
+    def mI(self):
+        if getattr(self, '_mI', None) is None and getattr(self, '_lazy', None) is not None:
+            self._mI = self._lazy.block((0, self.Ny), (self.Ny, 2 * self.Ny))
+        return getattr(self, '_mI', None)
+
+    @mI.setter
+    def mI(self, mI):
+        self._mI = mI
+
     def build_hamiltonian(self):
         self.mtot = mm.make_H(self.m0, self.mI, self.Nx)
 
+    def lazy_matrix(self):
+        """
+        The hamiltonian as lazy_matrix.LazyMatrix (base matrix and stack of
+        modifiers).
+        """
+        if getattr(self, '_lazy', None) is not None:
+            return self._lazy
+        if self.mtot is None:
+            self.build_hamiltonian()
+        return lazy_matrix.LazyMatrix(self.mtot)
+
+    def copy_ins_with_modifier(self, modifier):
+        """
+        A copy of the instance whose matrix is the matrix of this instance
+        with the modifier (lazy_matrix.DiagonalTerm, SparseTerm or
+        ElementFactor) added to its stack. The matrix is not copied: mtot,
+        m0 and mI are assembled on first access and dot() is calculated
+        from the components.
+        """
+        ins = copy.copy(self)
+        ins.mtot = None
+        ins._lazy = self.lazy_matrix().modified(modifier)
+        ins.m0 = None
+        ins.mI = None
+        return ins
+
+    def dot(self, x):
+        """
+        H x for a vector or a block of vectors (N, M), without assembling
+        the matrix of a lazy hamiltonian.
+        """
+        if getattr(self, '_mtot', None) is None and getattr(self, '_lazy', None) is not None:
+            return self._lazy.dot(x)
+        if self.mtot is None:
+            self.build_hamiltonian()
+        return self.mtot.dot(x)
+
     def copy_ins(self, m0, mI, Ny = None):
         ins = copy.copy(self)
         ins.m0 = m0
@@ -56,14 +141,24 @@ class GeneralHamiltonian(object):
         return ins
 
     def make_periodic_x(self):
-        if self.mtot is None:
-            self.build_hamiltonian()
-        mtot = self.mtot.copy().tolil()
-
-        mtot[-self.Ny:,:self.Ny] = mtot[:self.Ny, self.Ny:2*self.Ny]
-        mtot[:self.Ny, -self.Ny:] = mtot[self.Ny:2*self.Ny, :self.Ny]
-
-        return self.copy_ins_with_new_matrix(mtot.tocsr())
+        """
+        Couples the last slice to the first one: the corner blocks are set
+        to the couplings of the first slices (added as one sparse term).
+        """
+        lazy = self.lazy_matrix()
+        Ny = self.Ny
+        N = lazy.shape[0]
+        # new value - old value of the corner blocks
+        upper = lazy.block((0, Ny), (Ny, 2 * Ny)) - lazy.block((N - Ny, N), (0, Ny))
+        lower = lazy.block((Ny, 2 * Ny), (0, Ny)) - lazy.block((0, Ny), (N - Ny, N))
+        upper = upper.tocoo()
+        lower = lower.tocoo()
+        corner = scipy.sparse.csr_matrix(
+            (np.concatenate([upper.data, lower.data]),
+             (np.concatenate([upper.row + N - Ny, lower.row]),
+              np.concatenate([upper.col, lower.col + N - Ny]))), shape=(N, N))
+
+        return self.copy_ins_with_modifier(lazy_matrix.SparseTerm(corner))
 
     def apply_potential(self, U, sign_variation=False, in_x = False):
         """
@@ -72,7 +167,8 @@ class GeneralHamiltonian(object):
         U: potential, an instance of Potential1D or Potential2D type
 
         The applied potential adds to the diagonal elements of the
-        hamiltonian.
+        hamiltonian. Complex values (e.g. ComplexAbsorbingPotential) give a
+        non-hermitian hamiltonian.
         """
         if not isinstance(U, potential.Potential1D):
             if not isinstance(U, potential.Potential2D):
@@ -82,56 +178,43 @@ class GeneralHamiltonian(object):
                                          or SoftConfinmentPotential
                                          or SuperLatticePotential,
                                          not %s''', U.__class__.__name__)
-        if self.mtot is None:
-            self.build_hamiltonian()
-
-        mt = self.mtot.copy()
+        coords = self.coords_array()[:self.Ntot]
 
         if isinstance(U, potential.Potential1D):
-
-            #mdia = scipy.sparse.dia_matrix((np.array([U(self.coords[i][1])
-            #                    for i in xrange(self.Ntot)]), np.array([0])),
-            #                               shape=(self.Ntot,self.Ntot))
             if in_x:
-                mdia = np.array([U(self.coords[i][0])
-                                for i in xrange(self.Ntot)])
+                mdia = potential.on_sites(U, coords[:, 0])
             else:
-                mdia = np.array([U(self.coords[i][1])
-                                for i in xrange(self.Ntot)])
-
-            if sign_variation:
-                mdia[::2] = -1.0 * mdia[::2]
-
-            mdia = scipy.sparse.dia_matrix((mdia, np.array([0])), shape=(self.Ntot,self.Ntot))
-            mt = mt + mdia.tocsr()
-
+                mdia = potential.on_sites(U, coords[:, 1])
         else:
-            mdia = np.array([U([self.coords[i][0], self.coords[i][1]])
-                                for i in xrange(self.Ntot)])
+            mdia = potential.on_sites(U, coords[:, :2])
 
-            if sign_variation:
-                mdia[::2] = -1.0 * mdia[::2]
-
-            mdia = scipy.sparse.dia_matrix((mdia, np.array([0])), shape=(self.Ntot,self.Ntot))
-
-            mt = mt + mdia.tocsr()
+        if sign_variation:
+            mdia = np.array(mdia)
+            mdia[::2] = -1.0 * mdia[::2]
 
-        return self.copy_ins_with_new_matrix(mt)
+        return self.copy_ins_with_modifier(lazy_matrix.DiagonalTerm(mdia))
 
     def apply_stretch(self, U):
 
-        if self.mtot is None:
-            self.build_hamiltonian()
-
-        mt = self.mtot.copy()
-
         if isinstance(U, potential.Potential1D):
-            mdia = np.array([U(self.coords[i][1])
-                                for i in xrange(self.Ntot-1)])
+            mdia = potential.on_sites(U, self.coords_array()[:self.Ntot-1, 1])
 
             mdia = scipy.sparse.diags(np.array([mdia,mdia]), np.array([-1, 1]), shape=(self.Ntot,self.Ntot))
-            mt = mt + mdia.tocsr()
-        return self.copy_ins_with_new_matrix(mt)
+            return self.copy_ins_with_modifier(lazy_matrix.SparseTerm(mdia))
+        if self.mtot is None:
+            self.build_hamiltonian()
+        return self.copy_ins_with_new_matrix(self.mtot.copy())
+
+    def coords_array(self):
+        """
+        The coordinates of the sites as float array of shape (Ntot,
+        dimension). The array is cached as long as self.coords is not
+        replaced.
+        """
+        if getattr(self, '_coords_source', None) is not self.coords:
+            self._coords_array = np.asarray(self.coords, dtype=float)
+            self._coords_source = self.coords
+        return self._coords_array
 
 
     def apply_simple_vector_potential(self, A):
@@ -220,60 +303,56 @@ class GeneralHamiltonian(object):
         A: a vector potential of the form [Ax, Ay]
         """
 
-        if self.mtot is None:
-            self.build_hamiltonian()
         #TODO: implement vector potential A(r) position dependent
         conversion_factor = 1.602176487 / 1.0545717*1e5
+        coords = self.coords_array()[:, :2]
 
-        nonzero_elements = self.mtot.nonzero()
+        def phases(i, j):
+            dr = coords[j] - coords[i]
+            return np.exp(1j * conversion_factor * (A[0] * dr[:, 0] + A[1] * dr[:, 1]))
 
-        phase_matrix = np.exp(1j * conversion_factor * A[0] *
-                             np.array([self.coords[nonzero_elements[1][k]][0] -
-                                       self.coords[nonzero_elements[0][k]][0]
-                                       for k in xrange(len(nonzero_elements[0]))]))*\
-                      np.exp(1j * conversion_factor * A[1] *
-                             np.array([self.coords[nonzero_elements[1][k]][1] -
-                                       self.coords[nonzero_elements[0][k]][1]
-                                       for k in xrange(len(nonzero_elements[0]))]))
-        m_pot_data = self.mtot.data * phase_matrix
-        m_pot = scipy.sparse.csr_matrix((m_pot_data, nonzero_elements), shape=(self.Ntot, self.Ntot))
-
-        return self.copy_ins_with_new_matrix(m_pot)
+        return self.copy_ins_with_modifier(lazy_matrix.ElementFactor(phases))
 
-    def apply_magnetic_field(self, magnetic_B=0, gauge='landau_x'):
+    def bond_vectors(self):
+        """
+        The bond vectors r_j - r_i of all stored elements H_ij of the
+        hamiltonian in csr order (the order of self.mtot.tocsr().data).
 
+        Return:
+        array of shape (number of stored elements, 2)
+        """
         if self.mtot is None:
             self.build_hamiltonian()
-        conversion_factor=1.602176487/1.0545717*1e-5  # e/hbar*Angstrem^2
+        mtot = self.mtot.tocsr()
+        coords = self.coords_array()[:, :2]
+        rows = np.repeat(np.arange(mtot.shape[0]), np.diff(mtot.indptr))
+        return coords[mtot.indices] - coords[rows]
 
-        nonzero_elements = self.mtot.nonzero()
-        if gauge == 'landau_x':
-             phase_matrix = np.exp(1j * conversion_factor * magnetic_B *
-                                   np.array([-0.5 * (self.coords[nonzero_elements[1][k]][0] -
-                                                      self.coords[nonzero_elements[0][k]][0]) *\
-                                              (self.coords[nonzero_elements[0][k]][1] +
-                                                self.coords[nonzero_elements[1][k]][1])
-                                              for k in xrange(len(nonzero_elements[0]))]))
-        elif gauge == 'landau_y':
-            phase_matrix = np.exp(1j * conversion_factor * magnetic_B *
-                                  np.array([0.5 * (self.coords[nonzero_elements[1][k]][0] +
-                                                    self.coords[nonzero_elements[0][k]][0]) *\
-                                             (self.coords[nonzero_elements[1][k]][1] -
-                                               self.coords[nonzero_elements[0][k]][1])
-                                              for k in xrange(len(nonzero_elements[0]))]))
+    def apply_magnetic_field(self, magnetic_B=0, gauge='landau_x'):
 
-        m_pot_data = self.mtot.data * phase_matrix
-        m_pot = scipy.sparse.csr_matrix((m_pot_data, nonzero_elements), shape=(self.Ntot, self.Ntot))
+        conversion_factor=1.602176487/1.0545717*1e-5  # e/hbar*Angstrem^2
+        if gauge not in ('landau_x', 'landau_y'):
+            raise ValueError('unknown gauge %s' % gauge)
+        coords = self.coords_array()
+
+        def phases(i, j):
+            x_i, y_i = coords[i, 0], coords[i, 1]
+            x_j, y_j = coords[j, 0], coords[j, 1]
+            if gauge == 'landau_x':
+                flux = -0.5 * (x_j - x_i) * (y_i + y_j)
+            else:
+                flux = 0.5 * (x_j + x_i) * (y_j - y_i)
+            return np.exp(1j * conversion_factor * magnetic_B * flux)
 
-        return self.copy_ins_with_new_matrix(m_pot)
+        return self.copy_ins_with_modifier(lazy_matrix.ElementFactor(phases))
 
     def add_vacancies(self, Nvac=10, vactype='single', sign_variation=True, sublat_sim=True, randseed=1000, E0=10.0):
+        """
+        Mimics vacancies by large on-site energies E0 (added as one diagonal
+        update). See disorder.DisorderEnsemble for vacancies as removed
+        sites, Anderson and hopping disorder.
+        """
         Ntotal = self.Nx * self.Ny
-        try:
-            mt = self.mtot.copy()
-        except:
-            self.build_hamiltonian()
-            mt = self.mtot.copy()
 
         import random
 
@@ -287,16 +366,16 @@ class GeneralHamiltonian(object):
         else:
             signs = [1.0 for i in xrange(Nvac)]
         print signs
+        shift = np.zeros(self.lazy_matrix().shape[0])
+        vacan_position = np.array(vacan_position, dtype=int)
         if vactype=='single':
-            for i in xrange(Nvac):
-                mt[vacan_position[i], vacan_position[i]] += E0 * np.sign(signs[i])
+            np.add.at(shift, vacan_position, E0 * np.sign(signs))
         if vactype=='double':
-            for i in xrange(Nvac):
-                mt[vacan_position[i], vacan_position[i]] += E0
-                pos = random.choice([-1,1])
-                mt[vacan_position[i]+pos, vacan_position[i]+pos] -= E0 
+            pos = np.array([random.choice([-1,1]) for i in xrange(Nvac)], dtype=int)
+            np.add.at(shift, vacan_position, E0)
+            np.add.at(shift, vacan_position + pos, -E0)
 
-        return self.copy_ins_with_new_matrix(mt)
+        return self.copy_ins_with_modifier(lazy_matrix.DiagonalTerm(shift))
 
     def eigenvalue_problem(self, k=20, sigma=0.0, **kwrds):
         if self.mtot is None:
@@ -325,26 +404,34 @@ class GeneralHamiltonian(object):
         else:
             return wsort, v
 
-    def get_spec(self, k0, get_wf=False, num_eigs=200):
-
-        m0 = self.m0#.tocsr()
-        mI = self.mI
-        mIT = self.mI.conjugate().transpose() #mlil[self.Ny:2*self.Ny,:self.Ny].tocsr()
+    def bloch_period(self):
+        """
+        The length of the unit cell (slice) of the ribbon along x.
+        """
+        coords = self.coords_array()
+        return coords[self.Ny][0] - coords[0][0]
 
-        #print 'mI', mI
-        #print 'mIT', mIT.transpose()
+    def bloch_matrix(self, k0):
+        """
+        The hamiltonian m0 + exp(ik dz) mI + exp(-ik dz) mI^H of the
+        infinite ribbon at the wave vector k0 (sparse, hermitian).
+        """
+        bloch_phase = cmath.exp(1j * k0 * self.bloch_period())
+        return (self.m0 + bloch_phase * self.mI +
+                self.mI.conjugate().transpose() / bloch_phase).tocsc()
 
-        dz = self.coords[self.Ny][0] - self.coords[0][0]
-        #print dz
-        bloch_phase = cmath.exp(1j * k0 * dz)
-        A = m0+ bloch_phase * mI + mIT / bloch_phase
-        n_eigs=num_eigs
-        #w, v = np.linalg.eig(A)
-        if m0.shape[0] <= n_eigs:
-            n_eigs = m0.shape[0]-2
+    def get_spec(self, k0, get_wf=False, num_eigs=200):
+        """
+        The num_eigs eigenvalues closest to zero (all of them for narrow
+        ribbons) of the infinite ribbon at k0, sorted.
 
-        w,v = linalg.eigs(A, k=n_eigs, sigma=0)
-        #w,v = np.linalg.eig(A.todense())
+        get_wf: return also the eigenvectors (columns)
+        """
+        A = self.bloch_matrix(k0)
+        if A.shape[0] - 1 <= num_eigs:
+            w, v = np.linalg.eigh(A.toarray())
+        else:
+            w, v = linalg.eigsh(A, k=num_eigs, sigma=0)
 
         if get_wf:
             wE, wV = self.__sort_spec(w, v, sortv=True)
@@ -353,10 +440,116 @@ class GeneralHamiltonian(object):
             wE = self.__sort_spec(w)[0]
             return wE
 
-    def plot_bandstructure(self, krange = np.linspace(0.0,2.5,100), n_eigs=200, **kwrds):
-        w = np.array([self.get_spec(k, num_eigs=n_eigs) for k in krange])
+    def ribbon_bands(self, krange, method='auto', num_eigs=200, sigma=0.0,
+                     processes=1, dense_max=1000, chunk_size=None):
+        """
+        The bands E_n(k) of the infinite ribbon (slices m0, coupled by mI).
+
+        method: 'dense': all Ny bands by a batched hermitian solve of the
+                         stacked Bloch matrices (array (Nk, Ny, Ny),
+                         np.linalg.eigvalsh)
+                'sparse': the num_eigs bands closest to sigma by a
+                          shift-invert eigsh per k. The fill-reducing
+                          ordering of the factorization is calculated once
+                          (the sparsity pattern does not depend on k) and
+                          the Lanczos iteration is started from the
+                          eigenvectors of the previous k.
+                'auto': 'dense' for Ny <= dense_max or if num_eigs covers
+                        (nearly) all bands, 'sparse' otherwise
+        processes: number of worker processes (chunks of k points), None
+                   means one per CPU. The workers are forked (not available
+                   on Windows, where the k points are calculated serially).
+        chunk_size: number of k points per chunk (dense: per batched solve)
+
+        Return:
+        array (Nk, nbands), the bands sorted at every k
+        """
+        global _active_bands
+
+        krange = np.atleast_1d(np.asarray(krange, dtype=float))
+        Ny = self.m0.shape[0]
+        if method == 'auto':
+            if Ny <= dense_max or num_eigs >= Ny - 1:
+                method = 'dense'
+            else:
+                method = 'sparse'
+        if method not in ('dense', 'sparse'):
+            raise ValueError('unknown method %s' % method)
+        if method == 'sparse' and num_eigs >= Ny - 1:
+            raise ValueError('num_eigs = %i too large for sparse method, Ny = %i'
+                             % (num_eigs, Ny))
+
+        if chunk_size is None:
+            if method == 'dense':
+                # about 64 MB of stacked complex matrices
+                chunk_size = max(1, 2**22 // Ny**2)
+            else:
+                chunk_size = len(krange)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if not hasattr(os, 'fork'):
+            processes = 1
+        if processes > 1:
+            chunk_size = min(chunk_size, -(-len(krange) // processes))
+        chunks = [krange[i:i + chunk_size]
+                  for i in xrange(0, len(krange), chunk_size)]
+
+        if processes == 1 or len(chunks) < 2:
+            if method == 'dense':
+                bands = [self.__dense_bands(chunk) for chunk in chunks]
+            else:
+                bands = [self.__sparse_bands(chunk, num_eigs, sigma)
+                         for chunk in chunks]
+            return np.concatenate(bands)
 
-        [plt.plot(krange, w[:,i],  ms=2, **kwrds) for i in xrange(len(w[0,:]))]
+        _active_bands = (self, {'method': method, 'num_eigs': num_eigs,
+                                'sigma': sigma, 'chunk_size': chunk_size})
+        pool = multiprocessing.Pool(processes)
+        try:
+            return np.concatenate(pool.map(_ribbon_bands_chunk, chunks))
+        finally:
+            pool.close()
+            pool.join()
+            _active_bands = None
+
+    def __dense_bands(self, krange):
+        m0 = np.asarray(self.m0.todense())
+        mI = np.asarray(self.mI.todense())
+        phase = np.exp(1j * krange * self.bloch_period())[:, np.newaxis, np.newaxis]
+        A = m0[np.newaxis] + phase * mI[np.newaxis] + \
+            np.conjugate(phase) * np.conjugate(mI.T)[np.newaxis]
+        return np.linalg.eigvalsh(A)
+
+    def __sparse_bands(self, krange, num_eigs, sigma):
+        A = self.bloch_matrix(krange[0])
+        Ny = A.shape[0]
+        order = scipy.sparse.csgraph.reverse_cuthill_mckee(
+            (abs(A) + abs(A.T)).tocsr(), symmetric_mode=True)
+        shift = sigma * scipy.sparse.identity(Ny, format='csc')
+        bands = np.zeros((len(krange), num_eigs))
+        v0 = None
+        for i, k0 in enumerate(krange):
+            A = self.bloch_matrix(k0)
+            lu = linalg.splu((A - shift)[order][:, order].tocsc(),
+                             permc_spec='NATURAL')
+
+            def solve(x, lu=lu):
+                y = np.empty(Ny, dtype=complex)
+                y[order] = lu.solve(np.asarray(x, dtype=complex)[order])
+                return y
+
+            OPinv = linalg.LinearOperator((Ny, Ny), matvec=solve, dtype=complex)
+            w, v = linalg.eigsh(A, k=num_eigs, sigma=sigma, OPinv=OPinv, v0=v0)
+            bands[i] = np.sort(w)
+            v0 = np.sum(v, axis=1)
+        return bands
+
+    def plot_bandstructure(self, krange = np.linspace(0.0,2.5,100), n_eigs=200,
+                           method='auto', processes=1, **kwrds):
+        w = self.ribbon_bands(krange, method=method, num_eigs=n_eigs,
+                              processes=processes)
+
+        plt.plot(krange, w, ms=2, **kwrds)
         #[plt.axhline(y = np.sign(n) * np.sqrt(2. * 1.6 * 10**(-19) * 
         #                                      1.05 * 10**(-34) * 0.82**2 * 
         #                                      10**12 * 300 * np.abs(n))/1.6*10**(19)) for n in range(-6,7)]
@@ -366,19 +559,85 @@ class GeneralHamiltonian(object):
         #plt.show()
         return None
 
-    def electron_density(self, mu, kT):
-
-        if self.w == None:
-            self.w, self.v = self.eigenvalue_problem()
-
-        rho = FermiFunction(self.w, mu, kT)
-        rho2 = np.dot(self.v, np.dot(
-                      np.diag(rho) * np.identity((self.Ny * self.Nx),dtype = float), 
-                      np.conjugate(np.transpose(self.v))))
-
-        density = np.diag(rho2)
+    def electron_density(self, mu, kT, method='auto', k=20, sigma=0.0,
+                         moments=None, vectors='probing', distance=2, nrandom=32,
+                         seed=None, block_size=16, dense_max=4000,
+                         tolerance=10**(-3)):
+        """
+        Occupation of each site, diag(f(H)), with the Fermi function f.
+
+        mu: chemical potential
+        kT: temperature
+        method: 'eigen': the k eigenstates closest to sigma (sparse eigsh,
+                         cached in self.w, self.v), i.e. only the states
+                         in this energy window are counted
+                'dense': all eigenstates (np.linalg.eigh), exact but with
+                         memory O(Ntot^2)
+                'chebyshev': Chebyshev expansion of the Fermi operator,
+                             memory linear in Ntot
+                'auto': 'dense' for Ntot <= dense_max, else 'chebyshev'
+        moments: number of Chebyshev moments, default such that the
+                 truncation error is below tolerance / 10
+                 (kpm.fermi_moments(), about a / kT for a half width a of
+                 the spectrum), 10000 for kT = 0
+        vectors: estimator of the diagonal for 'chebyshev':
+                 'probing': probing vectors with the distance (in hoppings)
+                            doubled from distance until two successive
+                            distances agree within tolerance on every site
+                            (kpm.converged_fermi_density()). The matrix
+                            elements of f(H) of metals decay within about
+                            a / (pi * kT) hoppings, so at low kT this falls
+                            back to the exact diagonal of the expansion
+                            (one Chebyshev recursion per site).
+                 'stochastic': nrandom random phase vectors (seed), with a
+                               statistical error of about
+                               1 / sqrt(nrandom) of the off-diagonal
+                               weight of f(H), i.e. only for averages over
+                               many sites; it is not checked.
+        block_size: number of vectors per Chebyshev recursion
+        tolerance: error of the occupations for 'chebyshev' with 'probing'
+
+        Return:
+        array (Ntot,)
+        """
+        if self.mtot is None:
+            self.build_hamiltonian()
+        Ntot = self.mtot.shape[0]
+        if method == 'auto':
+            method = 'dense' if Ntot <= dense_max else 'chebyshev'
+
+        if method == 'eigen':
+            if self.w is None or getattr(self, '_eigen_window', None) != (k, sigma) \
+                    or getattr(self, '_eigen_source', None) is not self.mtot:
+                self.w, self.v = linalg.eigsh(self.mtot.tocsc(), k=k, sigma=sigma)
+                self._eigen_window = (k, sigma)
+                self._eigen_source = self.mtot
+            w, v = self.w, self.v
+        elif method == 'dense':
+            w, v = np.linalg.eigh(self.mtot.toarray())
+        elif method == 'chebyshev':
+            a, b = kpm.spectral_bounds(self.mtot)
+            if vectors == 'probing':
+                coords = None
+                if self.coords is not None and len(self.coords) == Ntot:
+                    coords = self.coords_array()
+                return kpm.converged_fermi_density(self.mtot, mu, kT, tolerance,
+                                                   moments, (a, b), distance,
+                                                   coords, block_size=block_size)
+            elif vectors == 'stochastic':
+                if moments is None:
+                    moments = 10000 if kT == 0 else \
+                        kpm.fermi_moments(mu, kT, a, b, tolerance / 10.)
+                blocks = kpm.random_blocks(Ntot, nrandom, block_size, seed)
+                return kpm.fermi_density(self.mtot, mu, kT, moments, blocks, (a, b),
+                                         kernel=kT == 0)
+            else:
+                raise ValueError('unknown vectors %s' % vectors)
+        else:
+            raise ValueError('unknown method %s' % method)
 
-        return density
+        rho = kpm.fermi_function(w.real, mu, kT)
+        return np.einsum('ij,j,ij->i', v, rho, np.conjugate(v)).real
 
     def find_lead_solution(self, E=0.0, k=10, sigma=0.0, **kwrds):
         A = scipy.sparse.lil_matrix((2*self.Ny, 2*self.Ny), dtype=complex)
@@ -417,11 +676,11 @@ class HamiltonianTB(GeneralHamiltonian):
 
         #m0 = mlil[:self.Ny, :self.Ny]
         #mI = mlil[:self.Ny, self.Ny:2 * self.Ny]
-        m0 = self.m0.copy()
-        m0[0, -1] = -self.t
-        m0[-1, 0] = -self.t
+        corner = scipy.sparse.csr_matrix(([1., 1.], ([0, self.Ny - 1], [self.Ny - 1, 0])),
+                                         shape=self.m0.shape)
+        m0 = self.m0 - self.m0.multiply(corner) - self.t * corner
 
-        return self.copy_ins(m0=m0, mI=mI)
+        return self.copy_ins(m0=m0.tocsr(), mI=self.mI)
 
     @staticmethod
     def get_position(Nx, Ny, s=1, dx=1.0, dy=1.0):
@@ -575,16 +834,11 @@ class HamiltonianWithSpin(GeneralHamiltonian):
         self.mtot = None
 
     def make_m_spin(self, m, N):
-        m_new = m.tocsr()
-        data = m_new.data
-        nonzero_elements = m_new.nonzero()
-        ne_0 = np.append(nonzero_elements[0], nonzero_elements[0]+N)
-        ne_1 = np.append(nonzero_elements[1], nonzero_elements[1]+N)
-        non_zero_new = (ne_0, ne_1)
-
-        data_new = np.append(data[:], data[:])
-
-        return scipy.sparse.csr_matrix((data_new, non_zero_new), shape=(2*N, 2*N))
+        """
+        The spinful matrix 1 x m (spin up block, spin down block) of the
+        matrix m of N sites.
+        """
+        return scipy.sparse.kron(scipy.sparse.identity(2), m, format='csr')
 
 
     def apply_Zeeman(self,  magnetic_B=0.0):
@@ -592,15 +846,44 @@ class HamiltonianWithSpin(GeneralHamiltonian):
         """
             Ez = g*mu_B * B = 0.12*B[T] meV
         """
-        m0 = self.m0
-        for i in xrange(self.Ny/2):
-            m0[i, i] += 0.00012 * magnetic_B
-            m0[self.Ny/2+i, self.Ny/2+i] -= 0.00012 * magnetic_B
+        Ez = 0.00012 * magnetic_B
+        m0 = self.m0 + scipy.sparse.kron(self.pauli_matrices()[2],
+                                         Ez * scipy.sparse.identity(self.Ny/2),
+                                         format='csr')
         mI = self.mI
         #m_pot = mm.make_H(m0, mI,  self.Nx)
 
         return self.copy_ins(m0=m0, mI=mI)
 
+    def __bond_vectors(self, ham_id):
+        """
+        The nearest neighbour bonds (i, j) of the sites of a slice (ham_id =
+        0) or from a slice to the next one (ham_id = 1), found with a KD-tree.
+
+        Return:
+        sparse matrices (Ny/2 x Ny/2) of the bond vectors r_j - r_i,
+        x and y component
+        """
+        N = self.Ny / 2
+        r = np.array(self.coords[:N], dtype=float)[:, :2]
+        dxl = self.coords[self.Ny][0] - self.coords[0][0]
+        d = np.sqrt(self.coords[1][0]**2 + self.coords[1][1]**2)
+
+        tree = scipy.spatial.cKDTree(r)
+        if ham_id == 0:
+            pairs = tree.query_pairs(1.01 * d, output_type='ndarray')
+            i = np.append(pairs[:, 0], pairs[:, 1])
+            j = np.append(pairs[:, 1], pairs[:, 0])
+        else:
+            pairs = tree.sparse_distance_matrix(
+                scipy.spatial.cKDTree(r + [dxl * ham_id, 0.0]), 1.01 * d,
+                output_type='ndarray')
+            i = pairs['i']
+            j = pairs['j']
+        dr = r[j] - r[i]
+        dr[:, 0] += dxl * ham_id
+        return [scipy.sparse.csr_matrix((dr[:, k], (i, j)), shape=(N, N))
+                for k in xrange(2)]
 
     def apply_RashbaSO(self, tR=0.01):
         m0 = self.add_Rashba(m=self.m0.copy(), tR=tR, ham_id=0)
@@ -609,26 +892,15 @@ class HamiltonianWithSpin(GeneralHamiltonian):
         return self.copy_ins(m0=m0, mI=mI)
 
     def add_Rashba(self, m, tR, ham_id):
+        """
+        Adds the Rashba coupling i tR (sigma_x dy - sigma_y dx) of the
+        nearest neighbours (bond vector (dx, dy)) to the slice matrix m.
+        """
+        sigma_x, sigma_y, sigma_z = self.pauli_matrices()
+        dx, dy = self.__bond_vectors(ham_id)
 
-        dxl = self.coords[self.Ny][0] - self.coords[0][0]
-        d = np.sqrt(self.coords[1][0]**2 + self.coords[1][1]**2)
-        pauli_mat = self.pauli_matrices()
-
-        for i in xrange(self.Ny/2):
-            for j in xrange(self.Ny/2, self.Ny):
-                dx0 = self.coords[j][0] - self.coords[i][0] + dxl * ham_id
-                dy0 = self.coords[j][1] - self.coords[i][1]
-                ann = np.sqrt(dx0**2 + dy0**2)
-                if ann < 1.01*d:
-                    m[i,j] += 1j * tR * (pauli_mat[0][0, 1]*dy0 - pauli_mat[1][0, 1]*dx0)
-
-                dx0 = self.coords[i][0] - self.coords[j][0] + dxl * ham_id
-                #dy0 = -dy0
-                ann = np.sqrt(dx0**2 + dy0**2)
-                if ann < 1.01*d:
-                    m[j,i] += 1j * tR * (-pauli_mat[0][1, 0]*dy0 - pauli_mat[1][1, 0]*dx0)
-
-        return m
+        return m + 1j * tR * (scipy.sparse.kron(sigma_x, dy) -
+                              scipy.sparse.kron(sigma_y, dx)).tocsr()
 
     def apply_DresselhausSO(self, tD = 0.01):
         m0 = self.add_Dresselhaus(m=self.m0.copy(), tD=tD, ham_id=0)
@@ -637,25 +909,15 @@ class HamiltonianWithSpin(GeneralHamiltonian):
         return self.copy_ins(m0=m0, mI=mI)
 
     def add_Dresselhaus(self, m, tD, ham_id):
+        """
+        Adds the Dresselhaus coupling i tD (sigma_x dx - sigma_y dy) of the
+        nearest neighbours (bond vector (dx, dy)) to the slice matrix m.
+        """
+        sigma_x, sigma_y, sigma_z = self.pauli_matrices()
+        dx, dy = self.__bond_vectors(ham_id)
 
-        dxl = self.coords[self.Ny][0] - self.coords[0][0]
-        d = np.sqrt(self.coords[1][0]**2 + self.coords[1][1]**2)
-        pauli_mat = self.pauli_matrices()
-
-        for i in xrange(self.Ny/2):
-            for j in xrange(self.Ny/2, self.Ny):
-                dx0 = self.coords[j][0] - self.coords[i][0] + dxl * ham_id
-                dy0 = self.coords[j][1] - self.coords[i][1]
-                ann = np.sqrt(dx0**2 + dy0**2)
-                if ann < 1.01*d:
-                    m[i,j] += 1j * tD * (pauli_mat[0][0, 1]*dx0 - pauli_mat[1][0, 1]*dy0)
-                dx0 = self.coords[i][0] - self.coords[j][0] + dxl * ham_id
-                #dy0 = -dy0
-                ann = np.sqrt(dx0**2 + dy0**2)
-                if ann < 1.01*d:
-                    m[j,i] += 1j * tD * (pauli_mat[0][1, 0]*dx0 + pauli_mat[1][1, 0]*dy0)
-
-        return m
+        return m + 1j * tD * (scipy.sparse.kron(sigma_x, dx) -
+                              scipy.sparse.kron(sigma_y, dy)).tocsr()
 
     @staticmethod
     def pauli_matrices():
@@ -0,0 +1,418 @@
+import numpy as np
+import scipy.sparse
+import scipy.fftpack
+
+
+def spectral_bounds(H, margin=0.01):
+    """
+    Estimates the spectral range of H with the Gershgorin circle theorem.
+
+    H: hermitian matrix (sparse or dense)
+    margin: the rescaled spectrum lies within [-1 + margin / 2, 1 - margin / 2]
+
+    Returns a, b such that the spectrum of (H - b) / a lies within [-1, 1].
+    """
+    H = scipy.sparse.csr_matrix(H)
+    diagonal = H.diagonal()
+    radius = np.asarray(abs(H).sum(axis=1)).ravel() - np.abs(diagonal)
+    emin = np.min(diagonal.real - radius)
+    emax = np.max(diagonal.real + radius)
+    a = (emax - emin) / (2. - margin)
+    b = (emax + emin) / 2.
+    if a == 0:
+        a = 1.
+    return a, b
+
+
+def jackson_kernel(N):
+    """
+    Jackson kernel g_n, n = 0 ... N-1, which damps the Gibbs oscillations
+    of a Chebyshev expansion truncated after N moments.
+    """
+    n = np.arange(N)
+    q = np.pi / (N + 1.)
+    return ((N - n + 1) * np.cos(q * n) + np.sin(q * n) / np.tan(q)) / (N + 1.)
+
+
+def chebyshev_coefficients(f, N, a, b, kernel=True):
+    """
+    Chebyshev coefficients c_n of f((a * x + b)) on [-1, 1], i.e.
+    f(H) = sum_n c_n T_n((H - b) / a).
+
+    f: function of the energy, has to accept arrays
+    N: number of coefficients
+    a, b: rescaling, see spectral_bounds()
+    kernel: multiply with the Jackson kernel (default True)
+    """
+    K = 2 * N
+    theta = np.pi * (np.arange(K) + 0.5) / K
+    c = scipy.fftpack.dct(f(a * np.cos(theta) + b), type=2)[:N] / K
+    c[0] /= 2.
+    if kernel:
+        c *= jackson_kernel(N)
+    return c
+
+
+def fermi_function(E, mu, kT):
+    if kT == 0:
+        return np.where(E < mu, 1., np.where(E == mu, 0.5, 0.))
+    return 0.5 * (1. - np.tanh((E - mu) / (2. * kT)))
+
+
+def fermi_derivative(E, mu, kT):
+    """
+    -df/dE, the thermal broadening function (kT > 0).
+    """
+    return 0.25 / kT / np.cosh((E - mu) / (2. * kT))**2
+
+
+def fermi_coefficients(N, mu, kT, a, b, kernel=True):
+    """
+    Chebyshev coefficients of the Fermi function (see
+    chebyshev_coefficients()). For kT -> 0, N has to be large compared to
+    a / kT.
+    """
+    return chebyshev_coefficients(lambda E: fermi_function(E, mu, kT),
+                                  N, a, b, kernel)
+
+
+def fermi_moments(mu, kT, a, b, tolerance=10**(-4), maxmoments=100000):
+    """
+    Number of Chebyshev moments of the Fermi function (kT > 0, without
+    kernel) such that the sum of the absolute values of the dropped
+    coefficients, which bounds the error of every element of f(H), is
+    below tolerance. The coefficients decay like exp(-pi * kT * n / a).
+    """
+    N = 64
+    while 4 * N < maxmoments:
+        c = np.abs(fermi_coefficients(4 * N, mu, kT, a, b, kernel=False))
+        tail = np.cumsum(c[::-1])[::-1]
+        if tail[N] <= tolerance:
+            return max(int(np.argmax(tail <= tolerance)), 2)
+        N *= 2
+    return maxmoments
+
+
+def chebyshev_apply(H, coefficients, a, b, vectors):
+    """
+    Calculates sum_n c_n T_n((H - b) / a) vectors with the Chebyshev
+    recursion T_n+1 = 2 H T_n - T_n-1, i.e. one sparse matrix product
+    per coefficient.
+
+    coefficients: array of shape (N,), or (number of functions, N) to
+                  expand several functions in the same recursion
+    vectors: array of shape (N, number of vectors) or (N,)
+
+    Returns an array of the shape of vectors, or with an additional first
+    axis for several functions.
+    """
+    H = scipy.sparse.csr_matrix(H)
+    Hs = (H - b * scipy.sparse.identity(H.shape[0], format='csr')) / a
+    coefficients = np.asarray(coefficients)
+    t0 = np.asarray(vectors)
+    c = coefficients.T.reshape(coefficients.shape[-1], -1, *([1] * t0.ndim))
+    result = c[0] * t0
+    if len(c) > 1:
+        t1 = Hs.dot(t0)
+        result = result + c[1] * t1
+        for cn in c[2:]:
+            t0, t1 = t1, 2. * Hs.dot(t1) - t0
+            result = result + cn * t1
+    if coefficients.ndim == 1:
+        return result[0]
+    return result
+
+
+def hopping_lengths(H, coords):
+    """
+    |coords[i] - coords[j]| along every axis for the nonzero off-diagonal
+    elements H_ij, array (number of hoppings, dimension).
+    """
+    H = scipy.sparse.csr_matrix(H, copy=True)
+    H.eliminate_zeros()
+    coords = np.asarray(coords, dtype=float).reshape(H.shape[0], -1)
+    rows = np.repeat(np.arange(H.shape[0]), np.diff(H.indptr))
+    offdiagonal = rows != H.indices
+    return np.abs(coords[rows[offdiagonal]] - coords[H.indices[offdiagonal]])
+
+
+def hopping_range(H, coords):
+    """
+    The longest distance between sites coupled by H.
+    """
+    lengths = hopping_lengths(H, coords)
+    if len(lengths) == 0:
+        return 0.
+    return np.sqrt(np.max(np.sum(lengths**2, axis=1)))
+
+
+def lattice_colors(coords, radius, period=4):
+    """
+    Coloring of the sites from their coordinates, such that sites of the
+    same color are further apart than radius: space is divided into boxes
+    of side radius / (period - 1), which are colored periodically with
+    period boxes in every direction, and the sites within a box are
+    numbered. For a lattice, the number of colors is about
+    (period / (period - 1))^dimension times the number of sites within
+    radius (in a square or cube).
+
+    coords: array (N, dimension)
+
+    Returns an integer array of shape (N,).
+    """
+    coords = np.asarray(coords, dtype=float)
+    coords = coords.reshape(coords.shape[0], -1)
+    side = max(radius, 10**(-12)) / (period - 1.) * (1. + 10**(-9))
+    boxes = np.floor((coords - coords.min(axis=0)) / side).astype(np.int64)
+    pattern = np.ravel_multi_index((boxes % period).T, [period] * boxes.shape[1])
+    box = np.ravel_multi_index(boxes.T, boxes.max(axis=0) + 1)
+    # number of each site within its box
+    order = np.argsort(box, kind='mergesort')
+    sites = np.arange(len(box))
+    first = np.ones(len(box), dtype=bool)
+    first[1:] = box[order][1:] != box[order][:-1]
+    rank = np.empty(len(box), dtype=np.int64)
+    rank[order] = sites - np.maximum.accumulate(np.where(first, sites, 0))
+    colors = pattern * (rank.max() + 1) + rank
+    return np.unique(colors, return_inverse=True)[1]
+
+
+def probing_colors(H, distance=2, coords=None):
+    """
+    Coloring of the sites for probing vectors: sites within the given
+    number of hoppings have different colors.
+
+    coords: coordinates of the sites (array (N, dimension)). If given, the
+            coloring is lattice_colors() with radius distance times the
+            hopping range, which is fast for large lattices. Otherwise, or
+            if there are hoppings across the system (periodic boundary
+            conditions), the graph of sites within distance hoppings is
+            colored by independent sets (vectorized over the sites).
+
+    Returns an integer array of shape (N,).
+    """
+    if coords is not None:
+        coords = np.asarray(coords, dtype=float).reshape(H.shape[0], -1)
+        lengths = hopping_lengths(H, coords)
+        if len(lengths) == 0 or \
+                (lengths.max(axis=0) <= 0.5 * np.ptp(coords, axis=0)).all():
+            return lattice_colors(coords, distance * hopping_range(H, coords))
+
+    pattern = scipy.sparse.csr_matrix(H, dtype=bool).astype(int)
+    pattern = pattern + scipy.sparse.identity(pattern.shape[0], dtype=int,
+                                              format='csr')
+    reach = pattern
+    for i in xrange(distance - 1):
+        reach = (reach * pattern).tocsr()
+    reach = reach.tocsr()
+    starts = reach.indptr[:-1]
+    neighbours = reach.indices
+
+    # every color is a maximal independent set of the uncolored sites: a
+    # candidate is taken if its priority is the largest of the candidates
+    # within reach (the diagonal of reach is included)
+    priority = np.random.RandomState(0).permutation(pattern.shape[0]) + 1
+    colors = -np.ones(pattern.shape[0], dtype=int)
+    color = 0
+    while (colors < 0).any():
+        candidate = colors < 0
+        while candidate.any():
+            p = np.where(candidate, priority, 0)
+            taken = candidate & (p == np.maximum.reduceat(p[neighbours], starts))
+            colors[taken] = color
+            candidate &= ~np.logical_or.reduceat(taken[neighbours], starts)
+        color += 1
+    return colors
+
+
+def probing_vectors(H, distance=2, coords=None):
+    """
+    Probing vectors for the diagonal of a function of H. The sites are
+    colored such that sites within the given number of hoppings have
+    different colors (probing_colors()); vector k is 1 on the sites of
+    color k. The diagonal estimate is exact up to the matrix elements of
+    f(H) between sites of the same color, which decay exponentially for
+    local f(H) (e.g. Fermi function at finite temperature or in a gap).
+
+    Returns an array of shape (N, number of colors).
+    """
+    colors = probing_colors(H, distance, coords)
+    vectors = np.zeros((len(colors), colors.max() + 1))
+    vectors[np.arange(len(colors)), colors] = 1.
+    return vectors
+
+
+def probing_blocks(colors, block_size):
+    """
+    The probing vectors of the coloring (probing_colors()) in blocks of
+    block_size vectors, so that only N * block_size numbers are stored at
+    a time.
+    """
+    ncolors = colors.max() + 1
+    for start in xrange(0, ncolors, block_size):
+        block = np.arange(start, min(start + block_size, ncolors))
+        yield (colors[:, np.newaxis] == block[np.newaxis, :]).astype(float)
+
+
+def unit_blocks(sites, N, block_size):
+    """
+    The unit vectors of the given sites (length N) in blocks of block_size
+    vectors. With all sites, the diagonal is exact.
+    """
+    sites = np.asarray(sites)
+    for start in xrange(0, len(sites), block_size):
+        block = sites[start:start + block_size]
+        vectors = np.zeros((N, len(block)))
+        vectors[block, np.arange(len(block))] = 1.
+        yield vectors
+
+
+def random_blocks(N, R, block_size, seed=None):
+    """
+    R random phase vectors (as random_vectors()) in blocks of block_size
+    vectors.
+    """
+    random = np.random.RandomState(seed)
+    for start in xrange(0, R, block_size):
+        size = min(block_size, R - start)
+        yield np.exp(2j * np.pi * random.rand(N, size)) / np.sqrt(R)
+
+
+def random_vectors(N, R, seed=None):
+    """
+    R random phase vectors of length N for a stochastic estimate of the
+    diagonal, normalized such that sum_r |v_ir|^2 = 1.
+    """
+    random = np.random.RandomState(seed)
+    return np.exp(2j * np.pi * random.rand(N, R)) / np.sqrt(R)
+
+
+def diagonal(H, coefficients, a, b, vectors):
+    """
+    Estimates the diagonal of f(H) = sum_n c_n T_n((H - b) / a) from
+    probing or random vectors (see probing_vectors(), random_vectors()).
+    For several functions (coefficients of shape (number of functions, N)),
+    an array of diagonals is returned.
+    """
+    vectors = np.asarray(vectors)
+    fv = chebyshev_apply(H, coefficients, a, b, vectors)
+    return np.sum(np.conjugate(vectors) * fv, axis=-1).real
+
+
+def fermi_density(H, mu, kT, N=500, vectors=None, bounds=None,
+                  derivative=False, block_size=None, kernel=True):
+    """
+    Occupation of each site, diag(f(H)), by the kernel polynomial method.
+
+    H: hermitian (sparse) matrix
+    mu: chemical potential
+    kT: temperature
+    N: number of Chebyshev moments
+    vectors: probing or random vectors, default probing_vectors(H), or an
+             iterable of blocks of them (probing_blocks(), random_blocks())
+    bounds: (a, b) from spectral_bounds(), calculated if None
+    derivative: also return the thermally broadened local density of states
+                at mu, diag(-f'(H)), the derivative of the occupation with
+                respect to mu. It is calculated in the same recursion.
+    block_size: number of vectors per Chebyshev recursion, None for all at
+                once. With blocks, the memory is linear in the number of
+                sites.
+    kernel: use the Jackson kernel. It is needed for kT = 0; for kT > 0
+            the plain expansion converges exponentially (fermi_moments())
+            and is more accurate for the same N.
+    """
+    if bounds is None:
+        bounds = spectral_bounds(H)
+    a, b = bounds
+    if vectors is None:
+        if block_size is None:
+            vectors = probing_vectors(H)
+        else:
+            vectors = probing_blocks(probing_colors(H), block_size)
+    if not derivative:
+        coefficients = fermi_coefficients(N, mu, kT, a, b, kernel)
+    else:
+        coefficients = np.array([fermi_coefficients(N, mu, kT, a, b, kernel),
+            chebyshev_coefficients(lambda E: fermi_derivative(E, mu, kT), N, a, b,
+                                   kernel)])
+
+    if isinstance(vectors, np.ndarray):
+        if block_size is None or vectors.ndim == 1:
+            return diagonal(H, coefficients, a, b, vectors)
+        vectors = [vectors[:, i:i + block_size]
+                   for i in xrange(0, vectors.shape[-1], block_size)]
+    result = 0.
+    for block in vectors:
+        result = result + diagonal(H, coefficients, a, b, block)
+    return result
+
+
+def converged_probing_colors(H, mu, kT, tolerance=10**(-3), N=None, bounds=None,
+                             distance=2, coords=None, derivative=False,
+                             block_size=16, kernel=None):
+    """
+    Probing colors for the occupation of each site, diag(f(H)), converged
+    with respect to the probing distance.
+
+    The number of moments is chosen by fermi_moments() (error below
+    tolerance / 10) for kT > 0; at kT = 0 the Jackson kernel is used with
+    N = 10000 moments, or N. The probing distance is doubled until the
+    occupations of two successive distances differ by at most tolerance
+    on every site; the error of the result is typically much smaller than
+    this difference, as the neglected matrix elements of f(H) decay
+    exponentially with the distance. They decay within about
+    a / (pi * kT) hoppings (a: half width of the spectrum) for metals, so
+    at low temperatures the probing vectors can get as many as the sites;
+    once they are more than half of the sites, the unit vectors of all
+    sites are used (unit_blocks()), which is exact up to the truncation of
+    the expansion but costs one Chebyshev recursion per site.
+
+    Only the occupation is checked, not the derivative.
+
+    distance: initial probing distance in hoppings
+    coords: coordinates of the sites for lattice_colors() (fast coloring)
+    derivative: also return diag(-f'(H)), see fermi_density()
+    kernel: use the Jackson kernel, default only for kT = 0
+
+    Return:
+    colors (None for the unit vectors of all sites), density (array (N,),
+    or array (2, N) of density and derivative)
+    """
+    if bounds is None:
+        bounds = spectral_bounds(H)
+    a, b = bounds
+    Ntot = H.shape[0]
+    if kernel is None:
+        kernel = kT == 0
+    if N is None:
+        N = 10000 if kernel else fermi_moments(mu, kT, a, b, tolerance / 10.)
+
+    previous = None
+    while True:
+        colors = probing_colors(H, distance, coords)
+        if 2 * (colors.max() + 1) > Ntot:
+            return None, fermi_density(H, mu, kT, N,
+                                       unit_blocks(np.arange(Ntot), Ntot, block_size),
+                                       bounds, derivative, kernel=kernel)
+        density = fermi_density(H, mu, kT, N, probing_blocks(colors, block_size),
+                                bounds, derivative, kernel=kernel)
+        occupation = density[0] if derivative else density
+        if previous is not None and np.abs(occupation - previous).max() <= tolerance:
+            return colors, density
+        previous = occupation
+        distance *= 2
+
+
+def converged_fermi_density(H, mu, kT, tolerance=10**(-3), N=None, bounds=None,
+                            distance=2, coords=None, derivative=False,
+                            block_size=16, kernel=None):
+    """
+    Occupation of each site, diag(f(H)), by the kernel polynomial method
+    with probing vectors, converged with respect to the probing distance
+    (see converged_probing_colors()).
+
+    Return:
+    density (array (N,)), or array (2, N) of density and derivative
+    """
+    return converged_probing_colors(H, mu, kT, tolerance, N, bounds, distance,
+                                    coords, derivative, block_size, kernel)[1]
@@ -0,0 +1,276 @@
+import numpy as np
+import copy
+import scipy.sparse
+import scipy.spatial
+import hamiltonian
+import make_matrix_graphene as mmg
+
+
+class UnitCell(object):
+    """
+    Unit cell of a two-dimensional lattice: lattice vectors, positions of
+    the basis sites and the hopping of the n-th nearest neighbours (by
+    distance shell, n = 0 is the on-site energy).
+    """
+
+    def __init__(self, latticevecs, basis, hopping):
+        """
+        latticevecs: the two lattice vectors, array (2, 2) (further
+                     components, e.g. z, are ignored)
+        basis: positions of the sites in the unit cell, array (nbasis, 2)
+        hopping: dictionary {n: hopping of the n-th neighbours}
+        """
+        self.latticevecs = np.asarray(latticevecs, dtype=float)[:2, :2]
+        self.basis = np.atleast_2d(np.asarray(basis, dtype=float))[:, :2]
+        self.hopping = dict(hopping)
+        self.shells = None
+
+    @classmethod
+    def graphene(cls, a=mmg.a, e0=-0.126, g1=-3.145, g2=-0.042, g3=-0.35):
+        """
+        Graphene with the hoppings and the orientation (zigzag edges along
+        y) of HamiltonianGraphene, up to 3rd neighbours.
+        a: carbon-carbon distance
+        """
+        latticevecs = [[np.sqrt(3) * a, 0.0], [np.sqrt(3) / 2. * a, 1.5 * a]]
+        basis = [[0.0, 0.0], [np.sqrt(3) / 2. * a, 0.5 * a]]
+        return cls(latticevecs, basis, {0: e0, 1: g1, 2: g2, 3: g3})
+
+    @classmethod
+    def square(cls, a=1.0, t=-1.0, e0=0.0):
+        return cls([[a, 0.0], [0.0, a]], [[0.0, 0.0]], {0: e0, 1: t})
+
+    @classmethod
+    def from_nth_nn_list(cls, nnfile, customhopping=None):
+        """
+        The unit cell of an nth-nearest-neighbour file as used by
+        w90hamiltonian.Hamiltonian.from_nth_nn_list() (lattice vectors,
+        orbital positions, default hoppings and the neighbour list). The
+        distance shells of the neighbour orders are taken from the
+        neighbour list.
+
+        customhopping: dictionary overriding the hoppings of the file
+        """
+        import envtb.general as general
+        latticevecs, orbdata, hoppingdata, nndata = general.split_by_empty_lines(
+            general.read_file_as_table(nnfile), True)
+        latticevecs = np.array(latticevecs, dtype=float)
+        basis = np.array([line[1:] for line in orbdata], dtype=float)
+        hopping = dict((int(line[0]), float(line[1])) for line in hoppingdata)
+        if customhopping is not None:
+            hopping.update(customhopping)
+        self = cls(latticevecs, basis, hopping)
+
+        nndata = np.array(nndata, dtype=int)
+        cells = np.dot(nndata[:, :3], np.asarray(latticevecs, dtype=float))
+        distances = np.sqrt(np.sum((cells[:, :2] + self.basis[nndata[:, 4]] -
+                                    self.basis[nndata[:, 3]])**2, axis=1))
+        self.shells = dict((n, np.mean(distances[nndata[:, 5] == n]))
+                           for n in np.unique(nndata[:, 5]) if n > 0)
+        return self
+
+    def neighbour_shells(self, nmax):
+        """
+        The distances of the neighbour shells 1 ... nmax.
+
+        Return:
+        dictionary {n: distance}
+        """
+        if self.shells is not None and all(n in self.shells for n in xrange(1, nmax + 1)):
+            return dict((n, self.shells[n]) for n in xrange(1, nmax + 1))
+        n = np.arange(-nmax - 1, nmax + 2)
+        n1, n2 = [x.ravel() for x in np.meshgrid(n, n)]
+        cells = np.outer(n1, self.latticevecs[0]) + np.outer(n2, self.latticevecs[1])
+        points = (cells[:, np.newaxis, :] + self.basis[np.newaxis, :, :]).reshape(-1, 2)
+        distances = np.sqrt(np.sum((points[np.newaxis, :, :] -
+                                    self.basis[:, np.newaxis, :])**2, axis=2))
+        shells = []
+        for d in np.sort(distances[distances > 10**(-8)]):
+            if len(shells) == 0 or d > shells[-1] * (1. + 10**(-6)):
+                shells.append(d)
+            if len(shells) == nmax:
+                break
+        return dict((k + 1, d) for k, d in enumerate(shells))
+
+    def sites(self, xlim, ylim):
+        """
+        The sites of all unit cells overlapping the box xlim x ylim.
+
+        Return:
+        coordinates (N, 2), index of the basis site (N,)
+        """
+        corners = np.array([[x, y] for x in xlim for y in ylim])
+        # cell indices of the corners (with a margin of one cell)
+        n = np.dot(corners - self.basis[0], np.linalg.inv(self.latticevecs))
+        n_min = np.floor(n.min(axis=0)).astype(int) - 1
+        n_max = np.ceil(n.max(axis=0)).astype(int) + 1
+        n1, n2 = [x.ravel() for x in np.meshgrid(np.arange(n_min[0], n_max[0] + 1),
+                                                  np.arange(n_min[1], n_max[1] + 1),
+                                                  indexing='ij')]
+        cells = np.outer(n1, self.latticevecs[0]) + np.outer(n2, self.latticevecs[1])
+        coords = (cells[:, np.newaxis, :] + self.basis[np.newaxis, :, :]).reshape(-1, 2)
+        sublattice = np.tile(np.arange(len(self.basis)), len(cells))
+        inside = (coords[:, 0] >= xlim[0]) & (coords[:, 0] <= xlim[1]) & \
+                 (coords[:, 1] >= ylim[0]) & (coords[:, 1] <= ylim[1])
+        return coords[inside], sublattice[inside]
+
+# end class UnitCell
+
+
+class Shape(object):
+    """
+    Shape of a flake: shape(coords) is True for the sites (array (N, 2))
+    inside. bounds = (xlim, ylim) is the bounding box.
+    """
+    bounds = None
+
+    def __call__(self, coords):
+        raise NotImplementedError
+
+# end class Shape
+
+
+class Disk(Shape):
+
+    def __init__(self, radius, center=(0.0, 0.0)):
+        self.radius = radius
+        self.center = np.asarray(center, dtype=float)
+        self.bounds = ([center[0] - radius, center[0] + radius],
+                       [center[1] - radius, center[1] + radius])
+
+    def __call__(self, coords):
+        return np.sum((coords - self.center)**2, axis=1) <= self.radius**2
+
+# end class Disk
+
+
+class Rectangle(Shape):
+
+    def __init__(self, xlim, ylim):
+        self.bounds = (list(xlim), list(ylim))
+
+    def __call__(self, coords):
+        xlim, ylim = self.bounds
+        return (coords[:, 0] >= xlim[0]) & (coords[:, 0] <= xlim[1]) & \
+               (coords[:, 1] >= ylim[0]) & (coords[:, 1] <= ylim[1])
+
+# end class Rectangle
+
+
+class Polygon(Shape):
+    """
+    Polygon with the vertices (array (M, 2)), inside by the even-odd rule.
+    """
+
+    def __init__(self, vertices):
+        self.vertices = np.asarray(vertices, dtype=float)
+        self.bounds = ([self.vertices[:, 0].min(), self.vertices[:, 0].max()],
+                       [self.vertices[:, 1].min(), self.vertices[:, 1].max()])
+
+    def __call__(self, coords):
+        x, y = coords[:, 0], coords[:, 1]
+        inside = np.zeros(len(coords), dtype=bool)
+        v = self.vertices
+        for (x1, y1), (x2, y2) in zip(v, np.roll(v, -1, axis=0)):
+            if y1 == y2:
+                continue
+            crosses = (y1 > y) != (y2 > y)
+            x_cross = x1 + (y - y1) * (x2 - x1) / (y2 - y1)
+            inside ^= crosses & (x < x_cross)
+        return inside
+
+# end class Polygon
+
+
+class Mask(Shape):
+    """
+    Shape given by a boolean image mask[i, j] (i: x, j: y) covering the
+    box xlim x ylim.
+    """
+
+    def __init__(self, mask, xlim, ylim):
+        self.mask = np.asarray(mask, dtype=bool)
+        self.bounds = (list(xlim), list(ylim))
+
+    def __call__(self, coords):
+        (x0, x1), (y0, y1) = self.bounds
+        nx, ny = self.mask.shape
+        i = np.floor((coords[:, 0] - x0) / (x1 - x0) * nx).astype(int)
+        j = np.floor((coords[:, 1] - y0) / (y1 - y0) * ny).astype(int)
+        valid = (i >= 0) & (i < nx) & (j >= 0) & (j < ny)
+        inside = np.zeros(len(coords), dtype=bool)
+        inside[valid] = self.mask[i[valid], j[valid]]
+        return inside
+
+# end class Mask
+
+
+class LatticeHamiltonian(hamiltonian.GeneralHamiltonian):
+    """
+    Tight-binding hamiltonian of a flake of arbitrary shape, built by
+    build_hamiltonian_from_lattice(). mtot (csr) and coords (array (N, 2))
+    are set, so the instance can be used like the ribbon hamiltonians,
+    e.g. with apply_potential(), apply_vector_potential(), kpm and the
+    time propagators. There are no slices (Nx = 1, Ny = N).
+    """
+
+    def __init__(self, mtot, coords, sublattice=None):
+        hamiltonian.GeneralHamiltonian.__init__(self, Nx=1, Ny=mtot.shape[0],
+                                                coords=coords)
+        self.mtot = mtot
+        self.sublattice = sublattice
+
+    def build_hamiltonian(self):
+        return None
+
+    def copy_ins_with_new_matrix(self, mtot):
+        ins = copy.copy(self)
+        ins.mtot = mtot
+        return ins
+
+# end class LatticeHamiltonian
+
+
+def build_hamiltonian_from_lattice(cell, shape, neighbours=3, tolerance=10**(-3)):
+    """
+    The hamiltonian of the sites of the lattice inside the shape. The
+    neighbours up to the given order are found with a KD-tree and matched
+    with the distance shells of the unit cell.
+
+    cell: UnitCell
+    shape: Shape (e.g. Disk, Polygon, Mask), or a function coords -> bool
+           array with a bounds attribute
+    neighbours: largest neighbour order (hoppings without value in
+                cell.hopping are zero)
+    tolerance: relative tolerance of the shell distances
+
+    Return:
+    LatticeHamiltonian
+    """
+    xlim, ylim = shape.bounds
+    coords, sublattice = cell.sites(xlim, ylim)
+    inside = shape(coords)
+    coords = coords[inside]
+    sublattice = sublattice[inside]
+    N = len(coords)
+
+    shells = cell.neighbour_shells(neighbours)
+    orders = np.array(sorted(shells))
+    distances = np.array([shells[n] for n in orders])
+    hopping = np.array([cell.hopping.get(n, 0.0) for n in orders])
+
+    tree = scipy.spatial.cKDTree(coords)
+    pairs = tree.query_pairs(distances.max() * (1. + tolerance), output_type='ndarray')
+    d = np.sqrt(np.sum((coords[pairs[:, 0]] - coords[pairs[:, 1]])**2, axis=1))
+    shell = np.argmin(np.abs(d[:, np.newaxis] - distances[np.newaxis, :]), axis=1)
+    matched = np.abs(d - distances[shell]) <= tolerance * distances[shell]
+    pairs = pairs[matched]
+    values = hopping[shell[matched]]
+
+    rows = np.concatenate([pairs[:, 0], pairs[:, 1], np.arange(N)])
+    cols = np.concatenate([pairs[:, 1], pairs[:, 0], np.arange(N)])
+    data = np.concatenate([values, values, cell.hopping.get(0, 0.0) * np.ones(N)])
+    mtot = scipy.sparse.csr_matrix((data.astype(complex), (rows, cols)), shape=(N, N))
+    mtot.eliminate_zeros()
+
+    return LatticeHamiltonian(mtot, coords, sublattice)
@@ -0,0 +1,176 @@
+import numpy as np
+import scipy.sparse
+
+
+class DiagonalTerm(object):
+    """
+    Adds values (array (N,)) to the diagonal, e.g. a potential.
+    """
+
+    def __init__(self, values):
+        self.values = np.asarray(values)
+
+# end class DiagonalTerm
+
+
+class SparseTerm(object):
+    """
+    Adds a sparse matrix, e.g. the corner blocks of a periodic wrap.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = scipy.sparse.csr_matrix(matrix)
+
+# end class SparseTerm
+
+
+class ElementFactor(object):
+    """
+    Multiplies every element H_ij by function(i, j) (arrays of row and
+    column indices -> array of factors), e.g. Peierls phases.
+    """
+
+    def __init__(self, function):
+        self.function = function
+
+# end class ElementFactor
+
+
+class LazyMatrix(object):
+    """
+    A sparse matrix given as a base matrix and a stack of modifiers
+    (DiagonalTerm, SparseTerm, ElementFactor). Adding a modifier creates a
+    new LazyMatrix sharing the base and the previous modifiers, so chains of
+    modifiers do not copy the matrix. The modifiers are evaluated once into
+    components (the scaled data of the base pattern, the diagonal and the
+    added sparse terms), from which products are calculated directly;
+    tocsr() sums them into a single csr matrix, only when it is needed.
+    """
+
+    def __init__(self, base, modifiers=()):
+        self.base = scipy.sparse.csr_matrix(base)
+        self.modifiers = tuple(modifiers)
+        self.shape = self.base.shape
+        self.__components = None
+        self.__csr = None
+
+    def modified(self, modifier):
+        """
+        A new LazyMatrix with the additional modifier.
+        """
+        return LazyMatrix(self.base, self.modifiers + (modifier,))
+
+    def add_diagonal(self, values):
+        return self.modified(DiagonalTerm(values))
+
+    def add(self, matrix):
+        return self.modified(SparseTerm(matrix))
+
+    def multiply_elements(self, function):
+        return self.modified(ElementFactor(function))
+
+    def __fold(self, start, stop):
+        """
+        The components of the rows start ... stop - 1:
+        data of the base pattern, diagonal (or None), list of sparse terms.
+        """
+        base = self.base
+        if (start, stop) != (0, self.shape[0]):
+            base = base[start:stop]
+        data = base.data
+        diagonal = None
+        terms = []
+        rows = None
+        ndiagonal = max(0, min(stop, self.shape[1]) - start)
+        for modifier in self.modifiers:
+            if isinstance(modifier, DiagonalTerm):
+                values = modifier.values[start:start + ndiagonal]
+                diagonal = values if diagonal is None else diagonal + values
+            elif isinstance(modifier, SparseTerm):
+                matrix = modifier.matrix
+                if (start, stop) != (0, self.shape[0]):
+                    matrix = matrix[start:stop]
+                terms.append(matrix)
+            elif isinstance(modifier, ElementFactor):
+                if rows is None:
+                    rows = np.repeat(np.arange(start, stop), np.diff(base.indptr))
+                data = data * modifier.function(rows, base.indices)
+                if diagonal is not None:
+                    sites = np.arange(start, start + ndiagonal)
+                    diagonal = diagonal * modifier.function(sites, sites)
+                scaled = []
+                for term in terms:
+                    term = term.tocsr()
+                    term_rows = np.repeat(np.arange(start, stop), np.diff(term.indptr))
+                    scaled.append(scipy.sparse.csr_matrix(
+                        (term.data * modifier.function(term_rows, term.indices),
+                         term.indices, term.indptr), shape=term.shape))
+                terms = scaled
+            else:
+                raise TypeError('unknown modifier %s' % modifier.__class__.__name__)
+        return base, data, diagonal, terms
+
+    def __assemble(self, base, data, diagonal, terms):
+        shape = (base.shape[0], self.shape[1])
+        matrix = scipy.sparse.csr_matrix((data, base.indices, base.indptr), shape=shape)
+        for term in terms:
+            matrix = matrix + term
+        if diagonal is not None:
+            matrix = matrix + scipy.sparse.diags(diagonal, 0, shape=shape, format='csr')
+        return matrix.tocsr()
+
+    def components(self):
+        """
+        base pattern with the modified data (csr, sharing the index arrays
+        of the base), diagonal (array or None), list of sparse terms
+        """
+        if self.__components is None:
+            base, data, diagonal, terms = self.__fold(0, self.shape[0])
+            if data is not base.data:
+                base = scipy.sparse.csr_matrix((data, base.indices, base.indptr),
+                                               shape=self.shape, copy=False)
+            self.__components = (base, diagonal, terms)
+        return self.__components
+
+    def dot(self, x):
+        """
+        The product with a vector or a block of vectors (N, M), calculated
+        from the components.
+        """
+        if self.__csr is not None:
+            return self.__csr.dot(x)
+        base, diagonal, terms = self.components()
+        y = base.dot(x)
+        for term in terms:
+            y = y + term.dot(x)
+        if diagonal is not None:
+            x = np.asarray(x)
+            y = y + (diagonal if x.ndim == 1 else diagonal[:, np.newaxis]) * x
+        return y
+
+    def tocsr(self):
+        """
+        The matrix as single csr matrix (cached).
+        """
+        if self.__csr is None:
+            base, diagonal, terms = self.components()
+            self.__csr = self.__assemble(base, base.data, diagonal, terms)
+        return self.__csr
+
+    def block(self, rows, cols):
+        """
+        The submatrix [rows[0]:rows[1], cols[0]:cols[1]] (csr), assembled
+        from the modified rows only.
+        """
+        if self.__csr is not None:
+            return self.__csr[rows[0]:rows[1], cols[0]:cols[1]]
+        base, data, diagonal, terms = self.__fold(rows[0], rows[1])
+        if diagonal is not None:
+            # shift the diagonal of the row block to the columns rows[0] ...
+            ndiagonal = len(diagonal)
+            terms = terms + [scipy.sparse.csr_matrix(
+                (diagonal, (np.arange(ndiagonal), np.arange(rows[0], rows[0] + ndiagonal))),
+                shape=(base.shape[0], self.shape[1]))]
+        return self.__assemble(base, data, None, terms)[:, cols[0]:cols[1]]
+
+# end class LazyMatrix
@@ -17,30 +17,25 @@ def make_HI(n, t):
     return -t * scipy.sparse.eye(n, n, dtype = complex, format="lil")
 
 def make_H(H0, HI, nx):
+    """
+    The block tridiagonal hamiltonian of nx slices with the intra-slice
+    matrix H0 and the coupling HI to the next slice, assembled from
+    Kronecker products:
 
+    H = 1 x H0 + S x HI + S^T x HI^H  (S: shift by one slice)
+    """
     ny = H0.shape[0]
     print ny
-    #print H0
-    #H = np.zeros((nx*ny,nx*ny), dtype = complex)
-    H = scipy.sparse.lil_matrix((nx*ny,nx*ny), dtype=complex)
 
+    H0 = scipy.sparse.csr_matrix(H0)
+    HI = scipy.sparse.csr_matrix(HI)
     HIT = HI.transpose().conjugate()
 
-    for i in xrange(nx):
-        j = i * ny
+    H = scipy.sparse.kron(scipy.sparse.identity(nx), H0) + \
+        scipy.sparse.kron(scipy.sparse.eye(nx, nx, k=1), HI) + \
+        scipy.sparse.kron(scipy.sparse.eye(nx, nx, k=-1), HIT)
 
-        H[j:j+ny,j:j+ny] = H0[:,:]
-
-        try:
-            H[j:j+ny,j+ny:j+2*ny] = HI[:,:]
-        except:
-            None
-        try:
-            H[j+ny:j+2*ny,j:j+ny] = HIT[:,:]
-        except:
-            continue
-    
-    return H.tocsr()
+    return H.tocsr().astype(complex)
 
 
 def block_matrix(m, n):
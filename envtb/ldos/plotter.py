@@ -5,6 +5,80 @@ except:
     print 'Warning(plotter): no module matplotlib'
     pass
 
+
+def _limits(values, minel, maxel):
+    """
+    Position of the values between minel (0) and maxel (1), clipped.
+    """
+    if maxel == minel:
+        return np.zeros(len(values))
+    return np.clip((values - minel) / (maxel - minel), 0.0, 1.0)
+
+
+def density_colors(vector, maxel, minel):
+    """
+    Marker sizes (in points) and RGB colors (green for minel to red for
+    maxel) of the density plot.
+    """
+    vector = np.asarray(vector).real
+    colors = np.zeros((len(vector), 3))
+    if maxel == minel:
+        return np.zeros(len(vector)), colors
+    sizes = np.abs(vector) * 180. / np.sqrt(np.sqrt(len(vector))) / (maxel - minel)
+    x = _limits(vector, minel, maxel)
+    colors[:, 0] = np.where(x >= 1.0, 1.0, 0.999 * x)
+    colors[:, 1] = np.where(x <= 0.0, 1.0, 0.999 * (1.0 - x))
+    colors[:, 1] = np.where(x >= 1.0, 0.0, colors[:, 1])
+    colors[:, 0] = np.where(x <= 0.0, 0.0, colors[:, 0])
+    return sizes, colors
+
+
+def potential_colors(m, maxel, minel):
+    """
+    RGB colors (blue for minel to green for maxel) of the potential plot.
+    """
+    x = _limits(np.asarray(m).real, minel, maxel)
+    colors = np.zeros((len(x), 3))
+    colors[:, 1] = np.where(x >= 1.0, 1.0, 0.999 * x)
+    colors[:, 2] = np.where(x <= 0.0, 1.0, 0.999 * (1.0 - x))
+    colors[:, 2] = np.where(x >= 1.0, 0.0, colors[:, 2])
+    colors[:, 1] = np.where(x <= 0.0, 0.0, colors[:, 1])
+    return colors
+
+
+def rasterize(coords, values, resolution=400, bounds=None):
+    """
+    Bins the values of the sites onto a pixel grid (the maximum of the
+    sites in each pixel) for plotting with imshow.
+
+    coords: array (N, >= 2)
+    resolution: number of pixels along x (the pixels are square)
+    bounds: (xmin, xmax, ymin, ymax), default the bounding box of the sites
+
+    Return:
+    image (ny, nx) with NaN for pixels without sites, extent for imshow,
+    pixel indices of the sites (to rasterize further frames with
+    np.maximum.at)
+    """
+    coords = np.asarray(coords, dtype=float)
+    if bounds is None:
+        bounds = (coords[:, 0].min(), coords[:, 0].max(),
+                  coords[:, 1].min(), coords[:, 1].max())
+    xmin, xmax, ymin, ymax = bounds
+    pixel = max(xmax - xmin, ymax - ymin, 10**(-12)) / float(resolution)
+    nx = int(np.floor((xmax - xmin) / pixel)) + 1
+    ny = int(np.floor((ymax - ymin) / pixel)) + 1
+    i = np.clip(((coords[:, 0] - xmin) / pixel).astype(int), 0, nx - 1)
+    j = np.clip(((coords[:, 1] - ymin) / pixel).astype(int), 0, ny - 1)
+    index = j * nx + i
+    image = np.empty(nx * ny)
+    image.fill(-np.inf)
+    np.maximum.at(image, index, np.asarray(values).real)
+    image[np.isinf(image)] = np.nan
+    extent = (xmin, xmin + nx * pixel, ymin, ymin + ny * pixel)
+    return image.reshape(ny, nx), extent, index
+
+
 class Plotter:
     
     def __init__(self, xval=None, yval=None):
@@ -26,131 +100,184 @@ class Plotter:
         plt.colorbar()
         return None
 
-    def plot_density(self, vector, coords, max_el=1.0, min_el=0.0, **kwrds):
+    def plot_density(self, vector, coords, max_el=1.0, min_el=0.0,
+                     mode='scatter', resolution=400, **kwrds):
+        """
+        Plots a density on the sites: one scatter plot of all sites with
+        sizes and colors (green to red) from the values (mode='scatter'),
+        or an image of the values rasterized onto a pixel grid
+        (mode='raster', see rasterize()), for large systems.
 
+        max_el, min_el: the colors saturate at max_el * max(vector) and
+                        min_el * max(vector)
+        **kwrds: keywords for scatter (or imshow)
+
+        Return:
+        the artist (PathCollection or AxesImage)
+        """
+        vector = np.asarray(vector).real
+        if max_el is None:
+            max_el = 1.0
         maxel = max_el*np.max(vector)
         minel = min_el*np.max(vector)
         print maxel, minel
-        xmin = 0.0
-        xmax = 0.0
-        ymin = 0.0
-        ymax = 0.0
-
-        for i in xrange(len(vector)):
-
-            if maxel != minel:
-                msize = vector[i] * 180. / np.sqrt(np.sqrt(len(vector))) / (maxel-minel)
-                #R = 1/(maxel) * (density1d[i].real)
-                #G = 1/(maxel) * (maxel - density1d[i].real)
-                if vector[i] >= maxel:
-                    R = 1
-                    G = 0
-                elif vector[i] <= minel:
-                    G = 1
-                    R = 0
-                else:
-                    R = 0.999 / (maxel - minel) * (vector[i].real - minel)
-                    G = 0.999 / (maxel - minel) * (maxel - vector[i].real)
-
-                B = 0.0
-            else:
-                msize = 0.0
-                R = 0.0
-                G = 0.0
-                B = 0.0
-
-            plt.plot(coords[i][0], coords[i][1], 'o', mfc='k', ms=2)
-            plt.plot(coords[i][0], coords[i][1], 'o', mfc=(R,G,B), ms=msize, **kwrds)
-
-            if coords[i][0] < xmin:
-                xmin = coords[i][0]
-            elif coords[i][0] > xmax:
-                xmax = coords[i][0]
-            elif coords[i][1] < ymin:
-                ymin = coords[i][0]
-            elif coords[i][1] > ymax:
-                ymax = coords[i][1]
+        coords = np.asarray(coords, dtype=float)
 
-        dx = (xmax-xmin) / 10.
-        dy = (ymax-ymin) / 10.
-            
-        plt.xlim(xmin - 0.5*dx, xmax + 0.5*dx)
-        plt.ylim(ymin - 0.5*dy, ymax + 0.5*dy)
-        
+        if mode == 'raster':
+            image, extent, index = rasterize(coords, vector, resolution)
+            rgb = np.zeros(image.shape + (4,))
+            valid = ~np.isnan(image)
+            rgb[valid, :3] = density_colors(image[valid], maxel, minel)[1]
+            rgb[valid, 3] = 1.0
+            artist = plt.imshow(rgb, extent=extent, origin='lower',
+                                interpolation='nearest', **kwrds)
+        elif mode == 'scatter':
+            sizes, colors = density_colors(vector, maxel, minel)
+            plt.scatter(coords[:, 0], coords[:, 1], s=4, c='k', marker='o')
+            artist = plt.scatter(coords[:, 0], coords[:, 1], s=sizes**2, c=colors,
+                                 marker='o', **kwrds)
+        else:
+            raise ValueError('unknown mode %s' % mode)
+
+        self.__set_limits(coords, 0.5)
         plt.xlabel(r'$x$', fontsize = 26)
         plt.ylabel(r'$y$', fontsize = 26)
         plt.tick_params(labelsize=22)
         #plt.axes().set_aspect('equal')
-        return None    
-    
+        return artist
+
     def plot_potential(self, ham_mit_pot, ham_bare=None, maxel=None, minel=None, plot_real=True, **kwrds):
-        
-        xmin = 0.0
-        xmax = 0.0
-        ymin = 0.0
-        ymax = 0.0
-        
+        """
+        Plots the on-site potential (the diagonal of the hamiltonian, minus
+        that of ham_bare) as one scatter plot, blue (minel) to green (maxel).
+        """
         if ham_bare is None:
             m = np.array(ham_mit_pot.mtot.diagonal())
         else:
             m = np.array(ham_mit_pot.mtot.diagonal() - ham_bare.mtot.diagonal())
-        
+
         if plot_real:
             m = m.real
         else:
             m = m.imag
-        
+
         if minel is None:
             minel = np.min(m)
         if maxel is None:
             maxel = np.max(m)
-        
+
         print np.min(m), np.max(m)
-                              
-        for i in xrange(len(m)):
-                        
-            #if maxel != 0.0:
-            msize = 500. / np.sqrt(len(m))
-            if  m[i].real >= maxel:
-                G = 1
-                B = 0
-            elif m[i].real <= minel:
-                G = 0
-                B = 1
-            else:
-                G = 0.999 / (maxel - minel) * (m[i] - minel)
-                B = 0.999 / (maxel - minel) * (maxel - m[i])
-                                        
-            R = 0.0
-            #else: 
-            #    msize = 0.0
-            #    R = 0.0
-            #    G = 0.0
-            #    B = 0.0
-                    
-            plt.plot(ham_mit_pot.coords[i][0], ham_mit_pot.coords[i][1], 'o', mfc='k', ms=2)
-            plt.plot(ham_mit_pot.coords[i][0], ham_mit_pot.coords[i][1], 'o', mfc=(R,G,B), ms=msize, **kwrds)
-            
-            if ham_mit_pot.coords[i][0] < xmin:
-                xmin = ham_mit_pot.coords[i][0]
-            elif ham_mit_pot.coords[i][0] > xmax:
-                xmax = ham_mit_pot.coords[i][0]
-            elif ham_mit_pot.coords[i][1] < ymin:
-                ymin = ham_mit_pot.coords[i][0]
-            elif ham_mit_pot.coords[i][1] > ymax:
-                ymax = ham_mit_pot.coords[i][1]
-        
-        dx = (xmax-xmin) / 10.
-        dy = (ymax-ymin) / 10.      
-        plt.xlim(xmin - dx, xmax + dx)
-        plt.ylim(ymin - dy, ymax + dy)
+
+        coords = np.asarray(ham_mit_pot.coords, dtype=float)[:len(m)]
+        msize = 500. / np.sqrt(len(m))
+        plt.scatter(coords[:, 0], coords[:, 1], s=4, c='k', marker='o')
+        artist = plt.scatter(coords[:, 0], coords[:, 1], s=msize**2,
+                             c=potential_colors(m, maxel, minel), marker='o', **kwrds)
+
+        self.__set_limits(coords, 1.0)
         plt.xlabel(r'$x$', fontsize = 24)
         plt.ylabel(r'$y$', fontsize = 24)
         #plt.axes().set_aspect('equal')
-        return None     
-        
-        
-    
+        return artist
+
+    def __set_limits(self, coords, margin):
+        xmin, xmax = coords[:, 0].min(), coords[:, 0].max()
+        ymin, ymax = coords[:, 1].min(), coords[:, 1].max()
+        dx = (xmax-xmin) / 10.
+        dy = (ymax-ymin) / 10.
+        plt.xlim(xmin - margin*dx, xmax + margin*dx)
+        plt.ylim(ymin - margin*dy, ymax + margin*dy)
+
+
+class DensityFrames:
+    """
+    Frame-batch plotting of densities on fixed sites, e.g. the frames of
+    a wave function movie: the figure and the artists are created once,
+    for every frame only the sizes and colors (or the image data) are
+    updated before saving.
+
+    Usage:
+
+        frames = DensityFrames(wf.coords, mode='scatter')
+        for n, wf in enumerate(wave_functions):
+            frames.save(np.abs(wf.wf1d), 'frame%04i.png' % n)
+        frames.close()
+    """
+
+    def __init__(self, coords, max_el=1.0, min_el=0.0, mode='scatter',
+                 resolution=400, figsize=(20, 10), dpi=None, **kwrds):
+        """
+        coords: coordinates of the sites
+        max_el, min_el: as in Plotter.plot_density(), relative to the
+                        maximum of every frame
+        mode: 'scatter' or 'raster'
+        """
+        if mode not in ('scatter', 'raster'):
+            raise ValueError('unknown mode %s' % mode)
+        self.coords = np.asarray(coords, dtype=float)
+        self.max_el = max_el
+        self.min_el = min_el
+        self.mode = mode
+        self.dpi = dpi
+        self.figure = plt.figure(figsize=figsize)
+        self.axes = self.figure.add_subplot(111)
+        N = len(self.coords)
+
+        if mode == 'raster':
+            image, extent, self.index = rasterize(self.coords, np.zeros(N), resolution)
+            self.shape = image.shape
+            self.artist = self.axes.imshow(np.zeros(self.shape + (4,)), extent=extent,
+                                           origin='lower', interpolation='nearest',
+                                           **kwrds)
+        else:
+            self.axes.scatter(self.coords[:, 0], self.coords[:, 1], s=4, c='k',
+                              marker='o')
+            self.artist = self.axes.scatter(self.coords[:, 0], self.coords[:, 1],
+                                            s=np.zeros(N), c=np.zeros((N, 3)),
+                                            marker='o', **kwrds)
+
+        xmin, xmax = self.coords[:, 0].min(), self.coords[:, 0].max()
+        ymin, ymax = self.coords[:, 1].min(), self.coords[:, 1].max()
+        dx = (xmax - xmin) / 20.
+        dy = (ymax - ymin) / 20.
+        self.axes.set_xlim(xmin - dx, xmax + dx)
+        self.axes.set_ylim(ymin - dy, ymax + dy)
+        self.axes.set_aspect('equal')
+        self.axes.set_xlabel(r'$x$', fontsize = 26)
+        self.axes.set_ylabel(r'$y$', fontsize = 26)
+        self.axes.tick_params(labelsize=22)
+
+    def update(self, vector):
+        """
+        Sets the data of the next frame.
+        """
+        vector = np.asarray(vector).real
+        maxel = self.max_el * np.max(vector)
+        minel = self.min_el * np.max(vector)
+        if self.mode == 'raster':
+            image = np.empty(self.shape[0] * self.shape[1])
+            image.fill(-np.inf)
+            np.maximum.at(image, self.index, vector)
+            valid = ~np.isinf(image)
+            rgba = np.zeros((len(image), 4))
+            rgba[valid, :3] = density_colors(image[valid], maxel, minel)[1]
+            rgba[valid, 3] = 1.0
+            self.artist.set_data(rgba.reshape(self.shape + (4,)))
+        else:
+            sizes, colors = density_colors(vector, maxel, minel)
+            self.artist.set_sizes(sizes**2)
+            self.artist.set_facecolors(colors)
+        return self.artist
+
+    def save(self, vector, filename):
+        self.update(vector)
+        self.figure.savefig(filename, dpi=self.dpi)
+
+    def close(self):
+        plt.close(self.figure)
+
+# end class DensityFrames
+
 
 class PlotterElectronDensity(Plotter):
     
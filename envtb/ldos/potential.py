@@ -1,6 +1,54 @@
+"""
+All potentials are vectorized: a Potential1D is called with a coordinate
+x or an array of shape (N,), a Potential2D (and SoftConfinmentPotential,
+SuperLatticePotential) with r = [x, y] or an array of shape (N, 2). For
+arrays, the values are returned as array of shape (N,).
+"""
+
 import numpy as np
 import random
 from scipy.ndimage.filters import gaussian_filter
+from scipy.ndimage import map_coordinates
+
+def on_sites(U, points):
+    """
+    The potential U at all points (array of shape (N,) or (N, 2)) in one
+    call. Potentials which only accept single points (user defined classes)
+    are evaluated point by point.
+
+    Return:
+    array of shape (N,)
+    """
+    points = np.asarray(points, dtype=float)
+    try:
+        values = np.asarray(U(points))
+        if values.shape == (len(points),):
+            return values
+    except (TypeError, ValueError, IndexError):
+        pass
+    return np.array([U(r) for r in points])
+
+def _vectorized_function(f, *args):
+    """
+    f(*args) for arrays args; functions written for scalars (e.g. with if
+    statements or math functions) are vectorized.
+    """
+    try:
+        return np.asarray(f(*args)) * np.ones(np.shape(args[0]))
+    except (TypeError, ValueError):
+        return np.vectorize(f)(*args)
+
+def _xy(r):
+    r = np.asarray(r, dtype=float)
+    return r[..., 0], r[..., 1]
+
+def _value(value):
+    """
+    scalar for a single point
+    """
+    if np.ndim(value) == 0:
+        return value[()]
+    return value
 
 class Potential1D:
 
@@ -28,9 +76,11 @@ class Potential1DFromFunction(Potential1D):
 
     def __call__(self,x):
         """
-        Returns the value of the potential at x.
+        Returns the value of the potential at x (number or array).
         """
-        return self.potential(x)
+        if np.ndim(x) == 0:
+            return self.potential(x)
+        return _vectorized_function(self.potential, np.asarray(x, dtype=float))
 
     def __init__(self, f):
         """
@@ -51,8 +101,8 @@ class Potential1DOnGrid(Potential1D):
         Returns the value of the potential at r.
         r is a list of [x,y]
         """
-        ix = int(r/self.dx)
-        return self.potential[ix]
+        ix = (np.asarray(r, dtype=float) / self.dx).astype(int)
+        return _value(np.asarray(self.potential)[ix])
 
     def __init__(self, array, dx=1.0, dy=1.0):
         """
@@ -90,9 +140,10 @@ class Potential2DOnGrid(Potential2D):
         Returns the value of the potential at r.
         r is a list of [x,y]
         """
-        ix = int(r[0]/self.dx)
-        iy = int(r[1]/self.dy)
-        return self.potential[ix,iy]
+        x, y = _xy(r)
+        ix = (x / self.dx).astype(int)
+        iy = (y / self.dy).astype(int)
+        return _value(np.asarray(self.potential)[ix, iy])
 
     def __init__(self, array, dx=1.0, dy=1.0):
         """
@@ -113,9 +164,12 @@ class Potential2DFromFunction(Potential2D):
     def __call__(self,r):
         """
         Returns the value of the potential at r.
-        r is a list of [x,y]
+        r is a list of [x,y] or an array of shape (N, 2)
         """
-        return self.potential(r[0], r[1])
+        if np.ndim(r) == 1:
+            return self.potential(r[0], r[1])
+        x, y = _xy(r)
+        return _vectorized_function(self.potential, x, y)
 
     def __init__(self, f):
         """
@@ -130,8 +184,8 @@ class RandomSmoothPotential2D(Potential2D):
         """
         self.Ly = ham.coords[ham.Ny-1][1]
         self.Lx = ham.coords[-2][0]
-        self.sx = int(self.Lx)*2.0
-        self.sy = int(self.Ly)*2.0
+        self.sx = int(self.Lx)*2
+        self.sy = int(self.Ly)*2
         np.random.seed(randseed)
         self.cor = self.sx*cor/self.Lx
         print self.cor
@@ -139,23 +193,23 @@ class RandomSmoothPotential2D(Potential2D):
         self.rand_pot = (gaussian_filter(z.reshape(self.sx, self.sy), sigma=self.cor/np.sqrt(2))*self.cor)
 
     def __call__(self, r):
-        dx0 = self.Lx/self.sx
-        dy0 = self.Lx/self.sx
-        x0 = np.linspace(0.0, self.Lx, self.sx)
-        y0 = np.linspace(0.0, self.Ly, self.sy)
-        i0 = np.where(x0 >= r[0])[0][0]
-        j0 = np.where(y0 >= r[1])[0][0]
-        deltax = r[0] - x0[i0]
-        deltay = r[1] - y0[j0]
-        if i0 < len(x0)-1 and j0 < len(y0)-1:
-            return self.rand_pot[i0, j0] + deltax * (self.rand_pot[i0+1, j0] - self.rand_pot[i0, j0]) /dx0 + deltay * (self.rand_pot[i0, j0+1] - self.rand_pot[i0, j0]) /dy0
-        else: 
-           return self.rand_pot[i0, j0]
+        """
+        Bilinear interpolation of the random potential on the grid
+        linspace(0, Lx, sx) x linspace(0, Ly, sy), constant continuation
+        outside of the grid.
+        """
+        x, y = _xy(r)
+        i = x / self.Lx * (self.sx - 1)
+        j = y / self.Ly * (self.sy - 1)
+        values = map_coordinates(self.rand_pot, [np.atleast_1d(i), np.atleast_1d(j)],
+                                 order=1, mode='nearest')
+        return _value(values.reshape(np.shape(x)))
 
 #end class Potential2DFromFunction
 
 class SoftConfinmentPotential:
-    def __init__(self, da=3., side='All', max_x=100., max_y=100., amplitude=10.0):
+    def __init__(self, da=3., side='All', max_x=100., max_y=100., amplitude=10.0,
+                 imaginary=False):
         '''
         The SoftConfinmentPotential gives an exponential decaying function of width da 
         at the boundaries of the flake. One can apply this potential to any boundary by
@@ -165,7 +219,9 @@ class SoftConfinmentPotential:
                        "armchir" - for making potential at the armchair edge
                        "zigzag" - for making potential at the zigzag edge
 
-        imaginary - bool; whether potential is imaginary or not
+        imaginary - bool; whether potential is imaginary or not. The imaginary
+                    potential -i*U absorbs the wave function at the
+                    boundaries (propagate with arnoldi.ArnoldiPropagator)
 
         TODO:
         Note: not applicable for any boundary
@@ -184,96 +240,127 @@ class SoftConfinmentPotential:
         self.max_x = max_x
         self.max_y = max_y
         self.amplitude = amplitude
+        self.imaginary = imaginary
 
 
     def __call__(self, r):
         """
         Returns the value of the potential at r.
-        r is a list of [x,y]
+        r is a list of [x,y] or an array of shape (N, 2)
         i counter in hamiltonian array (corresponds to position on diagonal of ham matrix with coordinate r)
         """
+        if self.imaginary:
+            return _value(-1j * self.__real_potential(r))
+        return _value(self.__real_potential(r))
 
-        pot_edge = self.__calculate_edge_potential(r)
+    def __real_potential(self, r):
+
+        x, y = _xy(r)
+        pot_edge = self.__calculate_edge_potential(x, y)
 
         if self.side == 0:
-            pot_corner = self.__calculate_corner_potential(r)
-            if pot_corner < 1.0:
-                return (1.0 + (-1) * pot_corner) * self.amplitude
-            else: return (1.0 + (-1) * pot_edge) * self.amplitude
-        elif self.side == 12 or self.side == 34:
-            #if pot_edge < 1.0:
-            return (1.0 + (-1) * pot_edge) * self.amplitude
-            #else:
-            #    return (1.0+(-1)*pot_edge)*10.0
+            pot_corner = self.__calculate_corner_potential(x, y)
+            return np.where(pot_corner < 1.0, 1.0 + (-1) * pot_corner,
+                            1.0 + (-1) * pot_edge) * self.amplitude
+        #elif self.side == 12 or self.side == 34:
+        return (1.0 + (-1) * pot_edge) * self.amplitude
 
     def __smooth_function(self, x):
         return abs(np.cos((x + self.da) / self.da * np.pi / 2.))
 
-    def __calculate_edge_potential(self, r):
-        x = r[0]
-        y = r[1]
-
-        pot_amp = 1.0
-
-        if x > self.max_x - self.da:
-            if self.side == 0 or self.side == 12:
-                x = x - self.max_x
-                pot_amp = self.__smooth_function(x)
-            else:
-                if y > self.max_y - self.da:
-                    y = y - self.max_y
-                    pot_amp = self.__smooth_function(y)
-                elif y < self.da:
-                    pot_amp = self.__smooth_function(y)
-        elif x < self.da:
-            if self.side == 0 or self.side == 12:
-                pot_amp = self.__smooth_function(x)
-            else:
-                 if y > self.max_y - self.da:
-                    y = y - self.max_y
-                    pot_amp = self.__smooth_function(y)
-                 elif y < self.da:
-                    pot_amp = self.__smooth_function(y)
-
-        elif y > self.max_y - self.da:
-            if self.side == 0 or self.side == 34:
-                y = y - self.max_y
-                pot_amp = self.__smooth_function(y)
-
-        elif y < self.da:
-            if self.side == 0 or self.side == 34:
-                pot_amp = self.__smooth_function(y)
-
-        return pot_amp
-
-    def __calculate_corner_potential(self,r):
-
-            x = r[0]
-            y = r[1]
-            if x >= self.max_x - self.da and y >= self.max_y - self.da:
-                x = x - self.max_x
-                y = y - self.max_y
-                #pot_amp = 0.0001 * (self.da - x)
-            elif x <= self.da and y >= self.max_y - self.da:
-                x = x
-                y = y - self.max_y
-                #pot_amp = 0.0001 * (self.da - x)
-            elif x <= self.da and y <= self.da:
-                x = x
-                y = y
-                #pot_amp = 0.0001 * (self.da - x)
-            elif x >= self.max_x-self.da and y <= self.da:
-                x = x - self.max_x
-                y = y
-                #pot_amp = 0.0001 * (self.da - x)
-            else:
-                return 1.0
-
-            pot_amp = self.__smooth_function(x) * self.__smooth_function(y)
-            return pot_amp
+    def __calculate_edge_potential(self, x, y):
+        """
+        1 inside the flake, the smooth function in the layers of width da at
+        the edges (the armchair edges for x, the zigzag edges for y).
+        """
+        in_x = np.logical_or(x > self.max_x - self.da, x < self.da)
+        pot_x = self.__smooth_function(np.where(x > self.max_x - self.da,
+                                                x - self.max_x, x))
+        pot_y = np.where(y > self.max_y - self.da,
+                         self.__smooth_function(y - self.max_y),
+                         np.where(y < self.da, self.__smooth_function(y), 1.0))
+
+        if self.side == 34:
+            return pot_y
+        elif self.side == 12:
+            return np.where(in_x, pot_x, 1.0)
+        return np.where(in_x, pot_x, pot_y)
+
+    def __calculate_corner_potential(self, x, y):
+        """
+        Product of the smooth functions in the corners, 1 elsewhere.
+        """
+        right = x >= self.max_x - self.da
+        left = x <= self.da
+        top = y >= self.max_y - self.da
+        bottom = y <= self.da
+        corners = [right & top, left & top, left & bottom, right & bottom]
+        xc = np.select(corners, [x - self.max_x, x, x, x - self.max_x], 0.0)
+        yc = np.select(corners, [y - self.max_y, y - self.max_y, y, y], 0.0)
+
+        pot_amp = self.__smooth_function(xc) * self.__smooth_function(yc)
+        return np.where(np.any(corners, axis=0), pot_amp, 1.0)
 
 #end class SoftConfinmentPotential
 
+class ComplexAbsorbingPotential(Potential2D):
+    """
+    Complex absorbing potential -i*W(r) in layers of width `width` at the
+    boundaries of the flake:
+
+    W = amplitude * (d / width)**power,
+
+    d is the distance from the inner edge of the layer (zero inside the
+    flake). Outgoing wave packets are absorbed instead of being reflected
+    at the edges, the hamiltonian is not hermitian (propagate with
+    arnoldi.ArnoldiPropagator). Reflections are small if the layer is
+    longer than the wave length and amplitude is of the order of the
+    kinetic energy.
+    """
+    def __init__(self, width=20., amplitude=1.0, coords=None, xlim=None,
+                 ylim=None, sides='xy', power=2):
+        """
+        coords: coordinates of the sites, the boundaries xlim, ylim are
+                taken from their bounding box if not given
+        xlim, ylim: [min, max] of the flake
+        sides: 'x' absorbs at the ends in x direction (e.g. open ribbons),
+               'y' in y direction, 'xy' at all boundaries
+        """
+        if xlim is None or ylim is None:
+            r = np.asarray(coords, dtype=float)
+            if xlim is None:
+                xlim = [r[:, 0].min(), r[:, 0].max()]
+            if ylim is None:
+                ylim = [r[:, 1].min(), r[:, 1].max()]
+        self.width = width
+        self.amplitude = amplitude
+        self.xlim = xlim
+        self.ylim = ylim
+        self.sides = sides
+        self.power = power
+
+    def range(self):
+        return self.xlim, self.ylim
+
+    def __depth(self, x, lim):
+        return np.maximum(np.maximum(lim[0] + self.width - x,
+                                     x - lim[1] + self.width), 0.0)
+
+    def __call__(self, r):
+        """
+        Returns the value of the potential at r.
+        r is a list of [x,y] or an array of shape (N, 2)
+        """
+        x, y = _xy(r)
+        d = np.zeros(np.shape(x))
+        if 'x' in self.sides:
+            d = np.maximum(d, self.__depth(x, self.xlim))
+        if 'y' in self.sides:
+            d = np.maximum(d, self.__depth(y, self.ylim))
+        return _value(-1j * self.amplitude * (d / self.width)**self.power)
+
+#end class ComplexAbsorbingPotential
+
 class SuperLatticePotential:
 
     def __init__(self, Nx, Ny, pot, coords):
@@ -287,30 +374,24 @@ class SuperLatticePotential:
 
     def __call__(self, r):
         '''
-            r is a list with coords [x, y]
+            r is a list with coords [x, y] or an array of shape (N, 2)
         '''
         a = 1.42
 
-        iy_main = int(r[1] / 3. / a * 4)
-
-        irest = np.mod(r[1], 3.*a)
-        if abs(irest) <= a/2 + 0.00001:
-            iy = iy_main + 1
-        elif abs(irest) <= 3.*a/2. + 0.00001:
-            iy = iy_main + 2
-        elif abs(irest) <= 2. * a + 0.00001:
-            iy = iy_main + 3
-        else:
-            iy = iy_main
+        x, y = _xy(r)
+        iy_main = (y / 3. / a * 4).astype(int)
 
-        ix = int(r[0] / np.sqrt(3) /a)
+        irest = np.abs(np.mod(y, 3.*a))
+        iy = np.select([irest <= a/2 + 0.00001,
+                        irest <= 3.*a/2. + 0.00001,
+                        irest <= 2. * a + 0.00001],
+                       [iy_main + 1, iy_main + 2, iy_main + 3], iy_main)
 
-        while iy > self.Ny-1:
-            iy = iy - self.Ny
+        ix = (x / np.sqrt(3) /a).astype(int)
 
-        while ix > self.Nx-1:
-            ix = ix - self.Nx
+        iy = np.where(iy > self.Ny-1, np.mod(iy, self.Ny), iy)
+        ix = np.where(ix > self.Nx-1, np.mod(ix, self.Nx), ix)
 
         index = ix * self.Ny + iy
 
-        return self.pot[index]
+        return _value(np.asarray(self.pot)[index])
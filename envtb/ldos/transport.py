@@ -0,0 +1,252 @@
+import numpy as np
+import os
+import multiprocessing
+import scipy.sparse
+
+# system of TransportSystem.transmission_spectrum(), inherited by the forked worker processes
+_active_system = None
+
+
+def _transmission(E):
+    return _active_system.transmission(E)
+
+
+def surface_greens_function(E, m0, mI, side='right', eta=10**(-9),
+                            tolerance=10**(-12), maxiter=200):
+    """
+    Surface Green's function of a semi-infinite lead of slices with the
+    intra-slice matrix m0 and the coupling mI from slice n to slice n + 1
+    (H[n, n + 1] = mI, as in make_matrix.make_H), by the Sancho-Rubio
+    decimation.
+
+    side: 'right', the lead extends to +infinity (the surface is its first
+          slice), or 'left', the lead extends to -infinity
+    eta: imaginary part of the energy
+
+    Return:
+    dense array (Ny, Ny)
+    """
+    m0 = np.asarray(scipy.sparse.csr_matrix(m0).todense(), dtype=complex)
+    mI = np.asarray(scipy.sparse.csr_matrix(mI).todense(), dtype=complex)
+    z = (E + 1j * eta) * np.identity(m0.shape[0])
+
+    if side == 'right':
+        alpha, beta = mI, np.conjugate(mI.T)
+    elif side == 'left':
+        alpha, beta = np.conjugate(mI.T), mI
+    else:
+        raise ValueError('unknown side %s' % side)
+    epsilon_s = m0.copy()
+    epsilon = m0.copy()
+
+    for i in xrange(maxiter):
+        g = np.linalg.inv(z - epsilon)
+        agb = np.dot(alpha, np.dot(g, beta))
+        bga = np.dot(beta, np.dot(g, alpha))
+        epsilon_s = epsilon_s + agb
+        epsilon = epsilon + agb + bga
+        alpha = np.dot(alpha, np.dot(g, alpha))
+        beta = np.dot(beta, np.dot(g, beta))
+        if np.abs(alpha).max() < tolerance and np.abs(beta).max() < tolerance:
+            break
+
+    return np.linalg.inv(z - epsilon_s)
+
+
+class Lead(object):
+    """
+    Semi-infinite lead given by the slice matrices m0, mI. The self-energy
+    on the adjacent slice of the device is cached per energy.
+    """
+
+    def __init__(self, m0, mI, side, eta=10**(-9)):
+        """
+        side: 'left' (the lead couples to the first slice of the device)
+              or 'right' (to the last slice)
+        """
+        self.m0 = scipy.sparse.csr_matrix(m0)
+        self.mI = scipy.sparse.csr_matrix(mI)
+        self.side = side
+        self.eta = eta
+        self.__cache = {}
+
+    def self_energy(self, E):
+        """
+        The self-energy (dense, Ny x Ny) on the adjacent device slice:
+        mI^H g mI for the left lead, mI g mI^H for the right lead.
+        """
+        if E not in self.__cache:
+            g = surface_greens_function(E, self.m0, self.mI, self.side, self.eta)
+            mI = np.asarray(self.mI.todense())
+            if self.side == 'left':
+                sigma = np.dot(np.conjugate(mI.T), np.dot(g, mI))
+            else:
+                sigma = np.dot(mI, np.dot(g, np.conjugate(mI.T)))
+            self.__cache[E] = sigma
+        return self.__cache[E]
+
+    def broadening(self, E):
+        """
+        Gamma = i (Sigma - Sigma^H)
+        """
+        sigma = self.self_energy(E)
+        return 1j * (sigma - np.conjugate(sigma.T))
+
+    def clear_cache(self):
+        self.__cache = {}
+
+# end class Lead
+
+
+class TransportSystem(object):
+    """
+    Two-terminal transport through the Nx slices of a ribbon hamiltonian
+    (e.g. with a potential or disorder applied) attached to semi-infinite
+    leads, by the recursive Green's function method: the slices are
+    processed one by one, so the cost is O(Nx Ny^3) instead of a solve of
+    the full matrix.
+
+    Usage:
+
+        system = TransportSystem(ham.apply_potential(U))
+        T = system.transmission_spectrum(energies)
+        J = system.local_currents(E)
+    """
+
+    def __init__(self, ham, lead_left=None, lead_right=None, eta=10**(-9)):
+        """
+        ham: hamiltonian instance with slices (Nx, Ny, mtot)
+        lead_left, lead_right: Lead instances, default the continuation of
+                               the clean ribbon (ham.m0, ham.mI)
+        """
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        self.ham = ham
+        self.Nx = ham.Nx
+        self.Ny = ham.Ny
+        self.eta = eta
+        if lead_left is None:
+            lead_left = Lead(ham.m0, ham.mI, 'left', eta)
+        if lead_right is None:
+            lead_right = Lead(ham.m0, ham.mI, 'right', eta)
+        self.lead_left = lead_left
+        self.lead_right = lead_right
+
+        mtot = ham.mtot.tocsr()
+        Ny = self.Ny
+        self.diagonal_blocks = [
+            np.asarray(mtot[n * Ny:(n + 1) * Ny, n * Ny:(n + 1) * Ny].todense())
+            for n in xrange(self.Nx)]
+        self.coupling_blocks = [
+            np.asarray(mtot[n * Ny:(n + 1) * Ny, (n + 1) * Ny:(n + 2) * Ny].todense())
+            for n in xrange(self.Nx - 1)]
+
+    def __inverse_block(self, E, n, sigma=None):
+        M = (E + 1j * self.eta) * np.identity(self.Ny) - self.diagonal_blocks[n]
+        if sigma is not None:
+            M = M - sigma
+        return M
+
+    def __right_connected(self, E):
+        """
+        The Green's functions g_n of the slices n ... Nx - 1 with the right
+        lead, for n = 1 ... Nx - 1 (index n).
+        """
+        g = [None] * self.Nx
+        sigma = self.lead_right.self_energy(E)
+        for n in xrange(self.Nx - 1, 0, -1):
+            g[n] = np.linalg.inv(self.__inverse_block(E, n, sigma))
+            C = self.coupling_blocks[n - 1]
+            sigma = np.dot(C, np.dot(g[n], np.conjugate(C.T)))
+        return g, sigma
+
+    def first_column(self, E):
+        """
+        The blocks G_{n,0} of the retarded Green's function, n = 0 ... Nx-1.
+        """
+        g, sigma = self.__right_connected(E)
+        if self.Nx == 1:
+            sigma = self.lead_right.self_energy(E)
+        G = [np.linalg.inv(self.__inverse_block(E, 0, sigma + self.lead_left.self_energy(E)))]
+        for n in xrange(1, self.Nx):
+            C = self.coupling_blocks[n - 1]
+            G.append(np.dot(g[n], np.dot(np.conjugate(C.T), G[-1])))
+        return G
+
+    def transmission(self, E):
+        """
+        T(E) = Tr[Gamma_R G_{Nx-1,0} Gamma_L G_{Nx-1,0}^H], by a sweep of
+        left-connected Green's functions from the left to the right lead.
+        """
+        sigma = self.lead_left.self_energy(E)
+        if self.Nx == 1:
+            sigma = sigma + self.lead_right.self_energy(E)
+        G = np.linalg.inv(self.__inverse_block(E, 0, sigma))
+        g = G
+        for n in xrange(1, self.Nx):
+            C = self.coupling_blocks[n - 1]
+            sigma = np.dot(np.conjugate(C.T), np.dot(g, C))
+            if n == self.Nx - 1:
+                sigma = sigma + self.lead_right.self_energy(E)
+            g = np.linalg.inv(self.__inverse_block(E, n, sigma))
+            G = np.dot(g, np.dot(np.conjugate(C.T), G))
+        gamma_L = self.lead_left.broadening(E)
+        gamma_R = self.lead_right.broadening(E)
+        return np.trace(np.dot(gamma_R, np.dot(G, np.dot(gamma_L, np.conjugate(G.T))))).real
+
+    def transmission_spectrum(self, energies, processes=1):
+        """
+        T(E) for all energies.
+
+        processes: number of worker processes, None means one per CPU. The
+                   workers are forked (not available on Windows, where the
+                   energies are calculated serially).
+        """
+        global _active_system
+
+        energies = np.atleast_1d(energies)
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if not hasattr(os, 'fork'):
+            processes = 1
+        if processes == 1 or len(energies) < 2:
+            return np.array([self.transmission(E) for E in energies])
+
+        _active_system = self
+        pool = multiprocessing.Pool(processes)
+        try:
+            return np.array(pool.map(_transmission, energies))
+        finally:
+            pool.close()
+            pool.join()
+            _active_system = None
+
+    def conductance(self, energies, processes=1):
+        """
+        Conductance (in units of e^2/h, per spin) at zero temperature.
+        """
+        return self.transmission_spectrum(energies, processes)
+
+    def local_currents(self, E):
+        """
+        Bond currents of the states incoming from the left lead,
+        J_ij = 2 Im(H_ij A_ji) with A = G Gamma_L G^H (per energy, in units
+        of e/h: summed over a cross section of the ribbon, they give T(E)).
+        The convention is that of observables.bond_currents, i.e. J_ij is
+        the flow from site j to site i.
+
+        Return:
+        scipy.sparse.csr_matrix with the sparsity pattern of H
+        """
+        G = np.concatenate(self.first_column(E))
+        gamma_L = self.lead_left.broadening(E)
+        H = self.ham.mtot.tocsr()
+        rows = np.repeat(np.arange(H.shape[0]), np.diff(H.indptr))
+        cols = H.indices
+        # A_ji = sum_kl G_jk Gamma_kl G_il^*
+        GL = np.dot(G, gamma_L)
+        A_ji = np.sum(GL[cols] * np.conjugate(G[rows]), axis=1)
+        data = 2. * (H.data * A_ji).imag
+        return scipy.sparse.csr_matrix((data, H.indices, H.indptr), shape=H.shape)
+
+# end class TransportSystem
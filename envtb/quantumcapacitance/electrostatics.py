@@ -51,6 +51,10 @@ class Element:
     fermi_energy_charge_dependence=0
     #: Dependence of charge on Fermi energy
     charge_fermi_energy_dependence=None
+    #: Derivative of fermi_energy_charge_dependence with respect to the charge
+    fermi_energy_charge_dependence_derivative=None
+    #: Derivative of charge_fermi_energy_dependence with respect to the Fermi energy
+    charge_fermi_energy_dependence_derivative=None
     #: Electrochemical potential of Element
     fermi_energy=0
     #: Dielectric constant of Element
@@ -58,7 +62,8 @@ class Element:
     #: Neumann boundary condition of Element
     neumannbc=None
     
-    def __init__(self,rect,i,j,potential=None,charge=0,epsilon=1,fermi_energy_charge_dependence=None,fermi_energy=None,neumannbc=None,charge_fermi_energy_dependence=None):
+    def __init__(self,rect,i,j,potential=None,charge=0,epsilon=1,fermi_energy_charge_dependence=None,fermi_energy=None,neumannbc=None,charge_fermi_energy_dependence=None,
+                 fermi_energy_charge_dependence_derivative=None,charge_fermi_energy_dependence_derivative=None):
         """
         i: Row index
         j: Column index
@@ -69,6 +74,9 @@ class Element:
         fermi_energy_charge_dependence: How the fermi energy of the material depends on the charge. Default is None.
                                         Mind that this setting assumes that the element is in a homogeneous environment.
         charge_fermi_energy_dependence: Like the former, but the other way round.
+        fermi_energy_charge_dependence_derivative, charge_fermi_energy_dependence_derivative:
+                    Derivatives of the two dependences. If given, QuantumCapacitanceSolver
+                    uses an analytic Jacobian. Default is None.
         fermi_energy: If the Fermi energy depends on the number of charge carriers, the fermi energy (=applied voltage e.g. by a battery)
                       can be different from the electrostatic potential. fermi_energy_charge_dependence has to be defined in this case.
                       Then you can calculate the quantum capacitance of the system.
@@ -87,6 +95,8 @@ class Element:
         self.charge=charge
         self.fermi_energy_charge_dependence=fermi_energy_charge_dependence
         self.charge_fermi_energy_dependence=charge_fermi_energy_dependence
+        self.fermi_energy_charge_dependence_derivative=fermi_energy_charge_dependence_derivative
+        self.charge_fermi_energy_dependence_derivative=charge_fermi_energy_dependence_derivative
         self.fermi_energy=fermi_energy
         if fermi_energy==None:
             fermi_energy=potential
@@ -373,6 +383,96 @@ class Rectangle:
             inhomogeneity[element.index()]=inhom
         return inhomogeneity
     
+def _datamatrix_layout(rectangle_list,rectangle_connections,rectangle_elementnumbers_range):
+    """
+    Calculate where the entries of a solution vector go in the data matrix
+    (see vector_to_datamatrix() of the containers).
+    
+    Return:
+    source: indices in the solution vector
+    target: flat indices in the data matrix (same length as source)
+    shape: shape of the data matrix
+    extent: Plot range parameter for imshow().
+    """
+    abs_pos={rectangle_list[0]:(0,0)}
+    
+    imin,imax,jmin,jmax=0,0,0,0
+    
+    for rect in rectangle_list:
+        for other_rect,offsets in rectangle_connections[rect].items():
+            offset=offsets[0] #Only "first" position of each rectangle will be considered for plot
+            abs_pos[other_rect]=abs_pos[rect][0]+offset[0],abs_pos[rect][1]+offset[1]
+    
+    for rect,pos in abs_pos.items():
+        imin,imax=min(imin,pos[0]),max(imax,pos[0]+rect.m)
+        jmin,jmax=min(jmin,pos[1]),max(jmax,pos[1]+rect.n)
+        
+    extent=jmin,jmax,imax,imin
+    shape=imax-imin,jmax-jmin
+    
+    source=[]
+    target=[]
+    for rect,pos in abs_pos.items():
+        elements=rectangle_elementnumbers_range[rect]
+        i,j=numpy.mgrid[pos[0]-imin:pos[0]-imin+rect.m,pos[1]-jmin:pos[1]-jmin+rect.n]
+        source.append(numpy.arange(elements[0],elements[1]))
+        target.append((i*shape[1]+j).ravel())
+    source=numpy.concatenate(source)
+    target=numpy.concatenate(target)
+    
+    #overlapping rectangles: the last one wins, as for a sequence of assignments
+    target,last=numpy.unique(target[::-1],return_index=True)
+    source=source[::-1][last]
+    
+    return source,target,shape,extent
+
+def _vectors_to_datamatrices(layout,vecs):
+    source,target,shape,extent=layout
+    vecs=numpy.asarray(vecs)
+    datamatrices=numpy.empty((len(vecs),shape[0]*shape[1]),dtype=numpy.result_type(vecs.dtype,float))
+    datamatrices.fill(numpy.nan)
+    datamatrices[:,target]=vecs[:,source]
+    return datamatrices.reshape((len(vecs),)+shape)
+
+def _export_datamatrices(layout,filename,vecs,number=None,chunksize=64):
+    """
+    See export_datamatrices() of the containers.
+    """
+    shape=layout[2]
+    if number==None:
+        number=len(vecs)
+    
+    def chunks():
+        chunk=[]
+        for vec in vecs:
+            chunk.append(vec)
+            if len(chunk)==chunksize:
+                yield _vectors_to_datamatrices(layout,chunk)
+                chunk=[]
+        if len(chunk)>0:
+            yield _vectors_to_datamatrices(layout,chunk)
+    
+    if filename.endswith('.h5') or filename.endswith('.hdf5'):
+        import h5py
+        with h5py.File(filename,'w') as f:
+            dataset=f.create_dataset('datamatrices',shape=(number,)+shape,dtype='f8',
+                                     chunks=(1,)+shape,compression='gzip')
+            dataset.attrs['extent']=layout[3]
+            ctr=0
+            for chunk in chunks():
+                dataset[ctr:ctr+len(chunk)]=chunk
+                ctr+=len(chunk)
+    else:
+        out=numpy.lib.format.open_memmap(filename,mode='w+',dtype='f8',shape=(number,)+shape)
+        ctr=0
+        for chunk in chunks():
+            out[ctr:ctr+len(chunk)]=chunk
+            ctr+=len(chunk)
+        out.flush()
+        del out
+    if ctr!=number:
+        raise ValueError("Got %d vectors instead of %d." % (ctr,number))
+    
 class PeriodicContainer:
     """
     Contains a single rectangle which is periodically repeated in one direction.
@@ -380,6 +480,7 @@ class PeriodicContainer:
     """
     rectangle_list=None
     rectangle_connections=None
+    __layout=None
     
     def __init__(self,rectangle,mode='x'):
         """
@@ -394,6 +495,7 @@ class PeriodicContainer:
         
     def connect(self,mode):
         rectangle=self.rectangle_list[0]
+        self.__layout=None
         
         self.rectangle_connections=collections.defaultdict(collections.defaultdict)
         self.rectangle_connections[rectangle][rectangle]=[[0,0]]
@@ -441,6 +543,22 @@ class PeriodicContainer:
         """
         return numpy.concatenate([rec.createinhomogeneity() for rec in self.rectangle_list])  
     
+    def datamatrix_layout(self):
+        """
+        Layout of the data matrix (see vector_to_datamatrix()). It is
+        calculated once and cached until the rectangles are connected anew.
+        
+        Return:
+        source: indices in the solution vector
+        target: flat indices in the data matrix (same length as source)
+        shape: shape of the data matrix
+        extent: Plot range parameter for imshow().
+        """
+        if self.__layout==None:
+            self.__layout=_datamatrix_layout(self.rectangle_list,self.rectangle_connections,
+                                             self.rectangle_elementnumbers_range())
+        return self.__layout
+    
     def vector_to_datamatrix(self,vec):
         """
         Creates a data matrix out of a solution vector of this system that can be plotted
@@ -456,31 +574,35 @@ class PeriodicContainer:
         datamatrix,extent = my_container.vector_to_datamatrix(vec)
         imshow(data,extent=extent)
         """
+        return self.vectors_to_datamatrices([vec])[0][0],self.datamatrix_layout()[3]
+    
+    def vectors_to_datamatrices(self,vecs):
+        """
+        Like vector_to_datamatrix(), but for many solution vectors at once
+        (e.g. one per voltage).
         
-        abs_pos={self.rectangle_list[0]:(0,0)}
-        
-        imin,imax,jmin,jmax=0,0,0,0
-        
-        for rect in self.rectangle_list:
-            for other_rect,offsets in self.rectangle_connections[rect].items():
-                offset=offsets[0] #Only "first" position of each rectangle will be considered for plot
-                abs_pos[other_rect]=abs_pos[rect][0]+offset[0],abs_pos[rect][1]+offset[1]
-        
-        for rect,pos in abs_pos.items():
-            imin,imax=min(imin,pos[0]),max(imax,pos[0]+rect.m)
-            jmin,jmax=min(jmin,pos[1]),max(jmax,pos[1]+rect.n)
-            
-        extent=jmin,jmax,imax,imin
-        
-        datamatrix=numpy.ones((imax-imin,jmax-jmin))*numpy.nan
+        vecs: array of shape (number of vectors, length of solution vector).
         
-        rectangle_elementnumbers_range=self.rectangle_elementnumbers_range()
-        for rect,pos in abs_pos.items():
-            elements=rectangle_elementnumbers_range[rect]
-            datamatrix[pos[0]-imin:pos[0]-imin+rect.m,
-                       pos[1]-jmin:pos[1]-jmin+rect.n]=vec[elements[0]:elements[1]].reshape(rect.m,rect.n)
+        Return:
+        datamatrices: array of shape (number of vectors, rows, columns).
+        extent: Plot range parameter for imshow().
+        """
+        layout=self.datamatrix_layout()
+        return _vectors_to_datamatrices(layout,vecs),layout[3]
+    
+    def export_datamatrices(self,filename,vecs,number=None,chunksize=64):
+        """
+        Write the data matrices of many solution vectors to a file, chunk by
+        chunk, without holding all of them in memory.
         
-        return datamatrix,extent
+        filename: .npy file (numpy.load(filename,mmap_mode='r') reads it
+                  lazily) or .h5/.hdf5 file (dataset 'datamatrices' with the
+                  attribute 'extent', needs h5py).
+        vecs: array or iterable (e.g. generator) of solution vectors.
+        number: number of vectors. Only needed if vecs has no len().
+        chunksize: number of vectors converted at once.
+        """
+        _export_datamatrices(self.datamatrix_layout(),filename,vecs,number,chunksize)
     
     def simple_plot(self,vec):
         """
@@ -582,6 +704,7 @@ class Container:
     """
     rectangle_list=0
     rectangle_connections=0
+    __layout=None
     
     def connect(self,rect,other_rect,align='top',position='right',offset=(0,0),viceversa=True):
         """
@@ -624,6 +747,7 @@ class Container:
         totaloffset[1]+=offset[1]
             
         self.rectangle_connections[rect][other_rect]=[totaloffset]
+        self.__layout=None
         
         if viceversa:
             if position=='top':
@@ -658,6 +782,7 @@ class Container:
         self.rectangle_list.append(rect)
         self.rectangle_connections[rect][rect]=[[0,0]]
         rect.container=self
+        self.__layout=None
         
     def rectangle_elementnumbers_range(self):
         nrrange={}
@@ -687,6 +812,22 @@ class Container:
         """
         return numpy.concatenate([rec.createinhomogeneity() for rec in self.rectangle_list])  
     
+    def datamatrix_layout(self):
+        """
+        Layout of the data matrix (see vector_to_datamatrix()). It is
+        calculated once and cached until the rectangles are connected anew.
+        
+        Return:
+        source: indices in the solution vector
+        target: flat indices in the data matrix (same length as source)
+        shape: shape of the data matrix
+        extent: Plot range parameter for imshow().
+        """
+        if self.__layout==None:
+            self.__layout=_datamatrix_layout(self.rectangle_list,self.rectangle_connections,
+                                             self.rectangle_elementnumbers_range())
+        return self.__layout
+    
     def vector_to_datamatrix(self,vec):
         """
         Creates a data matrix out of a solution vector of this system that can be plotted
@@ -702,31 +843,35 @@ class Container:
         datamatrix,extent = my_container.vector_to_datamatrix(vec)
         imshow(data,extent=extent)
         """
+        return self.vectors_to_datamatrices([vec])[0][0],self.datamatrix_layout()[3]
+    
+    def vectors_to_datamatrices(self,vecs):
+        """
+        Like vector_to_datamatrix(), but for many solution vectors at once
+        (e.g. one per voltage).
         
-        abs_pos={self.rectangle_list[0]:(0,0)}
-        
-        imin,imax,jmin,jmax=0,0,0,0
-        
-        for rect in self.rectangle_list:
-            for other_rect,offsets in self.rectangle_connections[rect].items():
-                offset=offsets[0] #Only "first" position of each rectangle will be considered for plot
-                abs_pos[other_rect]=abs_pos[rect][0]+offset[0],abs_pos[rect][1]+offset[1]
-        
-        for rect,pos in abs_pos.items():
-            imin,imax=min(imin,pos[0]),max(imax,pos[0]+rect.m)
-            jmin,jmax=min(jmin,pos[1]),max(jmax,pos[1]+rect.n)
-            
-        extent=jmin,jmax,imax,imin
-        
-        datamatrix=numpy.ones((imax-imin,jmax-jmin))*numpy.nan
+        vecs: array of shape (number of vectors, length of solution vector).
         
-        rectangle_elementnumbers_range=self.rectangle_elementnumbers_range()
-        for rect,pos in abs_pos.items():
-            elements=rectangle_elementnumbers_range[rect]
-            datamatrix[pos[0]-imin:pos[0]-imin+rect.m,
-                       pos[1]-jmin:pos[1]-jmin+rect.n]=vec[elements[0]:elements[1]].reshape(rect.m,rect.n)
+        Return:
+        datamatrices: array of shape (number of vectors, rows, columns).
+        extent: Plot range parameter for imshow().
+        """
+        layout=self.datamatrix_layout()
+        return _vectors_to_datamatrices(layout,vecs),layout[3]
+    
+    def export_datamatrices(self,filename,vecs,number=None,chunksize=64):
+        """
+        Write the data matrices of many solution vectors to a file, chunk by
+        chunk, without holding all of them in memory.
         
-        return datamatrix,extent
+        filename: .npy file (numpy.load(filename,mmap_mode='r') reads it
+                  lazily) or .h5/.hdf5 file (dataset 'datamatrices' with the
+                  attribute 'extent', needs h5py).
+        vecs: array or iterable (e.g. generator) of solution vectors.
+        number: number of vectors. Only needed if vecs has no len().
+        chunksize: number of vectors converted at once.
+        """
+        _export_datamatrices(self.datamatrix_layout(),filename,vecs,number,chunksize)
     
     def simple_plot(self,vec):
         """
@@ -1,11 +1,13 @@
 #TODO: BulkGrapheneWithTemperature.Ef_interp auf genauigkeit testen! min/maxEf parametrisieren
 
-import sympy.mpmath
 import scipy.optimize
 from .common import Constants
+from .utilities import MonotoneCubicInterpolation1D
 import numpy
 import math
 import scipy.interpolate
+import os
+import tempfile
 
 class QuantumCapacitanceSelfConsistency:
     """
@@ -84,6 +86,8 @@ class QuantumCapacitanceSolver:
     
     withnopot=None
     m=None
+    __last_solution=None
+    __fermivec=None
     
     def __init__(self,container,solver,elements,charge_operator,equation='potential',nonlocal_charge_potential_function=None):
         """
@@ -92,7 +96,9 @@ class QuantumCapacitanceSolver:
         my_container.lu_solver().
         elements: the elements (from the system described by container) that 
         participate in the calculation. The property 
-        fermi_energy_charge_dependence needs to be set.
+        fermi_energy_charge_dependence needs to be set. The dependence
+        functions are called with arrays (all elements sharing the same
+        function at once), so they have to accept arrays.
         charge_operator: The operator which gives the charge (without 
         \epsilon_0).
         equation: there are three formulations of the problem: 'charge','potential' and 'charge_nonlocal'.
@@ -116,7 +122,45 @@ class QuantumCapacitanceSolver:
         if equation=='charge_nonlocal':
             self.__equation=self.__functiontominimize_charge_nonlocal
             self.__nonlocal_charge_potential_function=nonlocal_charge_potential_function
+        self.refresh_dependence_groups()
                         
+    def refresh_dependence_groups(self):
+        """
+        Group the elements by their fermi_energy_charge_dependence and
+        charge_fermi_energy_dependence functions (and the derivatives of
+        those), so that each function
+        is called only once per evaluation, with an array containing the
+        values of all elements of its group.
+        
+        Called by __init__(). Call it again if you change the dependence
+        functions of the elements afterwards.
+        """
+        self.__fermi_energy_groups=self.__group_elements('fermi_energy_charge_dependence')
+        self.__charge_groups=self.__group_elements('charge_fermi_energy_dependence')
+        self.__fermi_energy_derivative_groups=self.__group_elements('fermi_energy_charge_dependence_derivative')
+        self.__charge_derivative_groups=self.__group_elements('charge_fermi_energy_dependence_derivative')
+        
+    def __group_elements(self,attribute):
+        groups={}
+        order=[]
+        for nr,elem in enumerate(self.elements):
+            function=getattr(elem,attribute)
+            if function not in groups:
+                groups[function]=[]
+                order.append(function)
+            groups[function].append(nr)
+        return [(dependence,numpy.array(groups[dependence])) for dependence in order]
+    
+    @staticmethod
+    def __apply_grouped(groups,values):
+        """
+        Evaluate the dependence functions on the array values, one call per
+        group. The functions have to accept arrays.
+        """
+        result=numpy.empty(len(values))
+        for function,indices in groups:
+            result[indices]=function(values[indices])
+        return result
         
     def refresh_environment_contrib(self):
         self.__reset_potential()
@@ -141,56 +185,197 @@ class QuantumCapacitanceSolver:
             
         self.m=numpy.array(basisvecs)
         
-    def __f(self,potvalues):
-        for x,elem in zip(potvalues,self.elements):
-            elem.potential=x   
-        return self.__equation()
-    
-    def __functiontominimize(self): #actually the root, not the minimum
-        potvec=numpy.array([elem.potential for elem in self.elements])
-        fermivec=numpy.array([elem.fermi_energy for elem in self.elements])
+    def __functiontominimize(self,potvec,jacobian=False): #actually the root, not the minimum
+        """
+        The Jacobian is I+diag(f'(Q))*M^T, because the classical charge
+        Q=potvec*M+withnopot is linear in the potential and the Fermi
+        energy of each element depends only on its own charge.
+        """
         charges=numpy.dot(potvec,self.m)+self.withnopot
-        sqrtvec=[elem.fermi_energy_charge_dependence(charge)/Constants.elem_charge for elem,charge in zip(self.elements,charges)]
-        return -fermivec+potvec+sqrtvec
+        sqrtvec=self.__apply_grouped(self.__fermi_energy_groups,charges)/Constants.elem_charge
+        result=-self.__fermivec+potvec+sqrtvec
+        if not jacobian:
+            return result
+        
+        derivative=self.__apply_grouped(self.__fermi_energy_derivative_groups,charges)/Constants.elem_charge
+        return result,numpy.eye(len(potvec))+derivative[:,numpy.newaxis]*self.m.T
     
-    def __functiontominimize_charge(self):
+    def __functiontominimize_charge(self,potvec,jacobian=False):
         """
         Minimize the charge difference instead of the potential difference.
-        """
         
-        potvec=numpy.array([elem.potential for elem in self.elements])
-        fermivec=numpy.array([elem.fermi_energy for elem in self.elements])
+        The Jacobian is M^T+diag(e*g'(e*(E_F-potential))), g being the
+        charge_fermi_energy_dependence.
+        """
         charges_cl=numpy.dot(potvec,self.m)+self.withnopot        
         
-        charges_qm=[elem.charge_fermi_energy_dependence(x*Constants.elem_charge) for x in fermivec-potvec]
+        charges_qm=self.__apply_grouped(self.__charge_groups,(self.__fermivec-potvec)*Constants.elem_charge)
         """
         If rho is a functional:
         charges_qm=charge_in_each_volume_element(fermivec-potvec)
         
         Mind to calculate the volume charge density, not the area charge density!
         """
-        return charges_cl-charges_qm
+        result=charges_cl-charges_qm
+        if not jacobian:
+            return result
+        
+        derivative=self.__apply_grouped(self.__charge_derivative_groups,(self.__fermivec-potvec)*Constants.elem_charge)*Constants.elem_charge
+        return result,self.m.T+numpy.diag(derivative)
     
-    def __functiontominimize_charge_nonlocal(self):
+    def __functiontominimize_charge_nonlocal(self,potvec,jacobian=False):
         """
         Minimize the charge difference for a nonlocal connection between
         potential and charge.
         
         Works identical to __functiontominimize_charge, except for the 
-        nonlocal qm charge calculation.
+        nonlocal qm charge calculation. There is no analytic Jacobian.
         """
-        
-        potvec=numpy.array([elem.potential for elem in self.elements])
-        fermivec=numpy.array([elem.fermi_energy for elem in self.elements])
         charges_cl=numpy.dot(potvec,self.m)+self.withnopot        
         
-        charges_qm=self.__nonlocal_charge_potential_function(fermivec-potvec)
+        charges_qm=self.__nonlocal_charge_potential_function(self.__fermivec-potvec)
         
         return charges_cl-charges_qm    
     
-    def solve(self):
-        potvec=numpy.array([elem.potential for elem in self.elements])
-        loesung=scipy.optimize.root(self.__f,potvec,method='lm')
+    def __jacobian_available(self):
+        if self.__equation==self.__functiontominimize:
+            groups=self.__fermi_energy_derivative_groups
+        elif self.__equation==self.__functiontominimize_charge:
+            groups=self.__charge_derivative_groups
+        else:
+            return False
+        return all(function is not None for function,indices in groups)
+    
+    def __newton(self,x0,tol=1e-10,ftol=1e-8,maxiter=50):
+        """
+        Damped Newton iteration with the analytic Jacobian. The step is
+        halved until the residual decreases. Converged if the largest
+        potential change is below tol*(1+max(abs(potential))) and the
+        residual norm is below ftol*(1+initial residual norm). If the step
+        has to be damped below 1e-4 without decreasing the residual, the
+        iteration has stalled and is stopped without success.
+        """
+        x=x0
+        f,jac=self.__equation(x,True)
+        norm=numpy.linalg.norm(f)
+        residual_tol=ftol*(1+norm)
+        nfev=1
+        success=False
+        stalled=False
+        for nit in range(1,maxiter+1):
+            dx=numpy.linalg.solve(jac,-f)
+            if numpy.max(numpy.abs(dx))<=tol*(1+numpy.max(numpy.abs(x))) \
+                    and norm<=residual_tol:
+                # converged up to rounding, the line search cannot improve
+                success=True
+                break
+            step=1.
+            while True:
+                xnew=x+step*dx
+                fnew,jacnew=self.__equation(xnew,True)
+                nfev+=1
+                normnew=numpy.linalg.norm(fnew)
+                if normnew<=norm:
+                    break
+                if step<1e-4:
+                    stalled=True
+                    break
+                step/=2.
+            if stalled:
+                break
+            x,f,jac,norm=xnew,fnew,jacnew,normnew
+            if numpy.max(numpy.abs(step*dx))<=tol*(1+numpy.max(numpy.abs(x))) \
+                    and norm<=residual_tol:
+                success=True
+                break
+        if success:
+            message='The solution converged.'
+        elif stalled:
+            message='The line search did not decrease the residual.'
+        else:
+            message='The maximum number of iterations is reached.'
+        return scipy.optimize.OptimizeResult(x=x,fun=f,success=success,nit=nit,nfev=nfev,message=message)
+    
+    def solve(self,x0=None,method=None,**kwargs):
+        """
+        Solve the quantum capacitance equation for the current configuration
+        (see refresh_environment_contrib()). The residual is evaluated on
+        arrays only; the potential of the elements is set to the solution
+        afterwards.
+        
+        If the derivatives of the dependence functions are available
+        (fermi_energy_charge_dependence_derivative resp.
+        charge_fermi_energy_dependence_derivative of the elements), the
+        equation is solved by a damped Newton iteration with the analytic
+        Jacobian. Otherwise (or if Newton does not converge) 
+        scipy.optimize.root is used and the Jacobian is approximated by 
+        finite differences.
+        
+        x0: Initial guess for the potential of the elements. Default is 
+            None, which means that the solution of the previous call is used
+            (warm start) or, for the first call, the current potential of
+            the elements.
+        method: None (default) for Newton if possible, else a method of
+                scipy.optimize.root ('lm' if None). For 'hybr' and 'lm',
+                the analytic Jacobian is passed on if available.
+        kwargs: Passed on to scipy.optimize.root, e.g. tol or options.
+        
+        Return:
+        The result object (scipy.optimize.OptimizeResult).
+        """
+        if x0 is None:
+            if self.__last_solution is not None:
+                x0=self.__last_solution
+            else:
+                x0=self.get_potential()
+        fermivec=[elem.fermi_energy for elem in self.elements]
+        
+        loesung=self.solve_configuration(self.withnopot,fermivec,x0,method,**kwargs)
+        
+        for x,elem in zip(loesung.x,self.elements):
+            elem.potential=x
+        self.__last_solution=loesung.x
+        
+        return loesung
+    
+    def solve_configuration(self,withnopot,fermi_energies,x0=None,method=None,**kwargs):
+        """
+        Like solve(), but for a configuration given by arrays instead of
+        the state of the elements. Neither the elements nor the warm start
+        of solve() are changed, so this can be used for many configurations
+        of an environment that depends linearly on the voltages (see
+        sweep.VoltageSweep).
+        
+        withnopot: Charge of the elements if their potential is 0 (see
+                   refresh_environment_contrib()).
+        fermi_energies: Fermi energy of each element.
+        x0: Initial guess for the potential of the elements. Default is 0.
+        method, kwargs: see solve().
+        
+        Return:
+        The result object (scipy.optimize.OptimizeResult).
+        """
+        if x0 is None:
+            x0=numpy.zeros(len(self.elements))
+        x0=numpy.array(x0,dtype=float)
+        
+        saved=self.withnopot,self.__fermivec
+        self.withnopot=numpy.asarray(withnopot,dtype=float)
+        self.__fermivec=numpy.array(fermi_energies,dtype=float)
+        try:
+            loesung=None
+            jacobian=self.__jacobian_available()
+            if method==None and jacobian:
+                loesung=self.__newton(x0)
+            if loesung==None or not loesung.success:
+                if method==None:
+                    method='lm'
+                jacobian=jacobian and method in ('hybr','lm')
+                loesung=scipy.optimize.root(lambda potvec: self.__equation(potvec,jacobian),
+                                            x0,jac=jacobian,method=method,**kwargs)
+        finally:
+            self.withnopot,self.__fermivec=saved
+        
         return loesung
     
     def get_charge(self):
@@ -212,15 +397,23 @@ class FermiEnergyChargeDependence:
     def bulk_graphene(charge,grid_height=1e-9): #grid_height*volume density = area density
         """
         How the Fermi energy of graphene depends on the charge density at 0K.
+        charge can be a number or an array.
         """
-        return -Constants.v_fermi*Constants.hbar*math.copysign(math.sqrt(math.pi*math.fabs(charge*grid_height)/Constants.elem_charge),charge)
+        return -Constants.v_fermi*Constants.hbar*numpy.sign(charge)*numpy.sqrt(math.pi*numpy.abs(charge*grid_height)/Constants.elem_charge)
     
     @staticmethod
     def no_dependence(charge):
         """
         How the Fermi energy of a "metal" depends on the charge density (it doesn't).
         """
-        return 0.
+        return numpy.zeros(numpy.shape(charge))
+    
+    @staticmethod
+    def no_dependence_derivative(charge):
+        """
+        Derivative of no_dependence() with respect to the charge density.
+        """
+        return numpy.zeros(numpy.shape(charge))
     
 class BulkGrapheneWithTemperature:
     """
@@ -229,8 +422,10 @@ class BulkGrapheneWithTemperature:
     The algorithm includes a function inversion, which can either be done with interpolation (Ef_interp()) or
     with a root search (Ef()). The interpolation is strongly suggested for higher speed.
     
-    If you use Q() often, you should probably also implement an interpolation
-    to improve speed.
+    Q() and Ef_interp() accept numbers as well as arrays. Q() is evaluated
+    in closed form (see J1()), Ef_interp() uses a monotone spline table
+    of Q(Ef) which is cached on disk in cachedir, one file per set of
+    parameters (T, grid_height, minEf, maxEf, dEf).
 
     The variables minEf, max Ef, Eftol, dEf are the parameters for the interpolation/root search. minEf and maxEf
     have to span the relevant energy window around the equilibrium Fermi energy = 0. If steps occur, decrease Eftol/dEf.
@@ -247,22 +442,81 @@ class BulkGrapheneWithTemperature:
     maxEf=1.5e-18
     Eftol=1e-25 #for root search
     dEf=1e-22 #for interpolation
+    cachedir=os.path.join(tempfile.gettempdir(),'envtb')
+    
+    #B_n/(n+1)! for the Bernoulli numbers B_0...B_20, used for the series of
+    #the dilogarithm in J1()
+    __dilog_coefficients=numpy.array([1.,-1./2,1./6,0,-1./30,0,1./42,0,
+        -1./30,0,5./66,0,-691./2730,0,7./6,0,-3617./510,0,43867./798,0,
+        -174611./330])/numpy.cumprod(numpy.arange(1,22))
     
-    def __init__(self,T,grid_height,interpolation=True):
+    def __init__(self,T,grid_height,interpolation=True,cachedir=None):
         """
         If you don't want to use Ef_interp(), you can set
         interpolation=False.
+        cachedir: Directory for the interpolation tables. Default is None,
+        which means that the class variable cachedir (a subdirectory of the
+        temporary directory) is used. If cachedir=False, the table is not
+        cached.
         """
         self.T=T
         self.grid_height=grid_height
+        if cachedir is not None:
+            self.cachedir=cachedir
        
-        Ef_grid=numpy.arange(self.maxEf,self.minEf,-self.dEf)
         if interpolation:
-            Q_grid=[self.Q(i,T) for i in Ef_grid]
-            self.interp=scipy.interpolate.interp1d(Q_grid,Ef_grid)
+            #Q decreases with Ef, the interpolation needs increasing Q
+            Ef_grid=numpy.arange(self.maxEf,self.minEf,-self.dEf)
+            self.interp=self.__interpolation_table(Ef_grid)
+            
+    def __interpolation_table(self,Ef_grid):
+        """
+        Monotone spline of Ef(Q) on the table Q(Ef_grid). The table and the
+        spline slopes are read from the cache directory if they have been
+        calculated before.
+        """
+        filename=None
+        if self.cachedir:
+            filename=os.path.join(self.cachedir,'bulkgraphene_T%r_h%r_%r_%r_%r.npy' % 
+                                  (float(self.T),float(self.grid_height),self.minEf,self.maxEf,self.dEf))
+            if os.path.exists(filename):
+                table=numpy.load(filename)
+                if table.shape==(2,len(Ef_grid)):
+                    return MonotoneCubicInterpolation1D(table[0],Ef_grid,table[1])
+        
+        Q_grid=self.Q(Ef_grid)
+        interp=MonotoneCubicInterpolation1D(Q_grid,Ef_grid)
+        
+        if filename is not None:
+            try:
+                if not os.path.isdir(self.cachedir):
+                    os.makedirs(self.cachedir)
+                #write to a temporary file first, parallel processes might read the table
+                tmpfile=filename+'.%d.tmp' % os.getpid()
+                with open(tmpfile,'wb') as f:
+                    numpy.save(f,numpy.array([Q_grid,interp.slopes]))
+                os.rename(tmpfile,filename)
+            except (IOError,OSError):
+                pass
+        return interp
                
     def J1(self,eta):
-        return -float(sympy.mpmath.polylog(2,-sympy.exp(eta)))
+        """
+        Complete Fermi-Dirac integral of order 1, J1(eta)=-Li2(-exp(eta)).
+        eta can be a number or an array.
+        
+        For eta<=0, the dilogarithm Li2(x) is calculated by its series
+        sum_n B_n/(n+1)! u^(n+1) with u=-ln(1-x), which converges fast
+        because |u|<=ln(2). For eta>0, the reflection formula
+        J1(eta)=pi^2/6+eta^2/2-J1(-eta) is used.
+        """
+        eta=numpy.asarray(eta,dtype=float)
+        u=-numpy.log1p(numpy.exp(-numpy.abs(eta)))
+        j=-u*numpy.polyval(self.__dilog_coefficients[::-1],u)
+        j=numpy.where(eta>0,math.pi**2/6+eta**2/2-j,j)
+        if j.ndim==0:
+            return float(j)
+        return j
     
     def n(self,Ef,T):
         return 2/math.pi*(Constants.k_B*T/(Constants.hbar*Constants.v_fermi))**2*self.J1(Ef/(Constants.k_B*T))
@@ -274,15 +528,52 @@ class BulkGrapheneWithTemperature:
         """
         Note that Q is divided by grid_height to calculate a volume density
         (instead of an area density).
+        
+        Ef can be a number or an array.
         """
         if T==None:
             T=self.T        
         return Constants.elem_charge*(self.p(Ef,T)-self.n(Ef,T))/self.grid_height
     
+    def dQ_dEf(self,Ef,T=None):
+        """
+        Derivative of Q() with respect to the Fermi energy, using
+        dJ1/deta=ln(1+exp(eta)). Ef can be a number or an array.
+        """
+        if T==None:
+            T=self.T
+        eta=numpy.abs(numpy.asarray(Ef,dtype=float)/(Constants.k_B*T))
+        J0sum=eta+2*numpy.log1p(numpy.exp(-eta)) #J0(eta)+J0(-eta)
+        return -Constants.elem_charge*2/math.pi*(Constants.k_B*T/(Constants.hbar*Constants.v_fermi))**2*\
+               J0sum/(Constants.k_B*T)/self.grid_height
+    
+    def dEf_dQ(self,charge):
+        """
+        Derivative of Ef_interp() with respect to the charge, calculated
+        analytically from dQ_dEf(). Use it as
+        fermi_energy_charge_dependence_derivative together with Ef_interp().
+        charge can be a number or an array.
+        """
+        return 1./self.dQ_dEf(self.Ef_interp(charge))
+    
     def Ef(self,charge,T=None):
+        """
+        Fermi energy by root search. charge can be a number or an array
+        (every element is searched separately, use Ef_interp() for speed).
+        """
         if T==None:
             T=self.T
-        return scipy.optimize.brentq(lambda myEf: self.Q(myEf,T)-charge,self.minEf,self.maxEf,xtol=self.Eftol)
+        def root(mycharge):
+            return scipy.optimize.brentq(lambda myEf: self.Q(myEf,T)-mycharge,self.minEf,self.maxEf,xtol=self.Eftol)
+        if numpy.ndim(charge)==0:
+            return root(charge)
+        return numpy.array([root(x) for x in numpy.ravel(charge)]).reshape(numpy.shape(charge))
     
     def Ef_interp(self,charge):
-        return self.interp(charge)
+        """
+        Fermi energy by interpolation. charge can be a number or an array.
+        """
+        Ef=self.interp(charge)
+        if numpy.isnan(Ef).any():
+            raise ValueError("A value in charge is outside the interpolation range (adjust minEf/maxEf).")
+        return Ef
@@ -0,0 +1,344 @@
+import numpy
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.optimize
+from .common import Constants
+from .utilities import linear_interpolation_matrix
+from envtb.ldos import kpm
+
+class AndersonMixing:
+    """
+    Anderson mixing for the fixed point problem x=g(x), with the residual
+    r=g(x)-x. The new input is the optimal combination of the previous
+    inputs/residuals plus beta times the combined residual.
+
+    Usage:
+
+      mixing=AndersonMixing(beta=0.3,history=5)
+      x=x0
+      while ...:
+          x=mixing(x,g(x)-x)
+    """
+    beta=None
+    history=None
+
+    def __init__(self,beta=0.3,history=5):
+        """
+        beta: linear mixing parameter
+        history: number of previous iterations that are used. history=0 is
+                 simple linear mixing.
+        """
+        self.beta=beta
+        self.history=history
+        self.reset()
+
+    def reset(self):
+        self.__x=[]
+        self.__r=[]
+
+    def __call__(self,x,residual):
+        x=numpy.asarray(x,dtype=float)
+        residual=numpy.asarray(residual,dtype=float)
+        self.__x=(self.__x+[x])[-self.history-1:]
+        self.__r=(self.__r+[residual])[-self.history-1:]
+
+        if len(self.__x)<2:
+            return x+self.beta*residual
+
+        dx=numpy.diff(self.__x,axis=0).T
+        dr=numpy.diff(self.__r,axis=0).T
+        gamma=numpy.linalg.lstsq(dr,residual,rcond=None)[0]
+        return x+self.beta*residual-numpy.dot(dx+self.beta*dr,gamma)
+
+class SchroedingerPoissonSolver:
+    """
+    Self-consistent solution of the Poisson equation of an electrostatic
+    system (Container) and the Schroedinger equation of a tight-binding
+    system (e.g. a graphene nanoribbon) which sits on a line of elements
+    of the container.
+
+    The tight-binding sites feel the electron potential energy -potential
+    (in eV if the potential is in V), linearly interpolated from the
+    elements along one coordinate axis. The charge of the sites (relative to
+    the charge neutral system) is distributed back onto the elements with
+    the transpose of the interpolation matrix.
+
+    The charge is calculated either by the kernel polynomial method
+    (method='kpm') or from the eigenstates in an energy window around the
+    Fermi energy (method='eigen'). In the latter case, only the states in
+    the window are counted relative to the neutrality level, shifted by the
+    potential each state feels (the polarization of the filled states is
+    neglected).
+
+    Usage:
+
+    1) solver,inhom=container.lu_solver()
+    2) spsolver=SchroedingerPoissonSolver(container,solver,elements,
+       element_positions,hamiltonian,cell_length)
+    3) Set the potentials of the gates as you like.
+    4) result=spsolver.solve(). The charge of the elements is set to the
+       solution, result.x is their potential.
+    5) Go to 3) (the next call starts from the previous solution).
+    """
+    container=None
+    solver=None
+    elements=None
+    hamiltonian_matrix=None
+    coordinates=None
+    interpolation=None
+    green=None
+
+    def __init__(self,container,solver,elements,element_positions,hamiltonian,cell_length,
+                 fermi_energy=0.,kT=0.025,neutrality_level=0.,axis=1,length_unit=1e-10,
+                 element_volume=None,degeneracy=2,method='kpm',kpm_moments=1000,probing_distance=None,
+                 nr_states=40,mixing=None,probing_tolerance=1e-3):
+        """
+        container: the container which describes the electrostatic system.
+        solver: the solution of the system, e.g. generated by
+                container.lu_solver(). The factorization is reused in each
+                iteration.
+        elements: elements of the container where the tight-binding system
+                  is located (e.g. a horizontal line of elements).
+        element_positions: position of these elements along the axis (in m).
+        hamiltonian: a GeneralHamiltonian (e.g. HamiltonianGraphene) or a
+                     w90hamiltonian.Hamiltonian (main cell matrix and
+                     orbital positions are used). Energies in eV.
+        cell_length: length of the tight-binding cell perpendicular to the
+                     cross section of the container (in m), e.g. the
+                     length of the periodic ribbon slice.
+        fermi_energy: Fermi energy of the tight-binding system (in eV).
+        kT: temperature (in eV).
+        neutrality_level: Fermi energy of the charge neutral system (in eV).
+        axis: coordinate axis of the tight-binding sites that corresponds to
+              element_positions.
+        length_unit: unit of the tight-binding coordinates (in m). Default
+                     is Angstrom.
+        element_volume: area of an element in the cross section (in m^2),
+                        default is dx*dy of the finite difference operator.
+        degeneracy: spin degeneracy of the tight-binding states.
+        method: 'kpm' or 'eigen'.
+        kpm_moments: number of Chebyshev moments for 'kpm'.
+        probing_distance: distance (in hoppings) of the probing vectors
+                          for 'kpm' (see kpm.probing_colors()). Default is
+                          None: the distance is doubled until the density
+                          of the charge neutral system is converged within
+                          probing_tolerance (kpm.converged_probing_colors(),
+                          which falls back to the exact diagonal only if
+                          the probing vectors get as many as half the
+                          sites).
+        nr_states: number of eigenstates around the Fermi energy for 'eigen'.
+        mixing: mixing object, default AndersonMixing(beta=1), which mixes
+                the Newton directions (see solve()).
+        probing_tolerance: tolerance of the occupation per site for the
+                           choice of the probing distance.
+        """
+        self.container=container
+        self.solver=solver
+        self.elements=elements
+        self.fermi_energy=fermi_energy
+        self.kT=kT
+        self.neutrality_level=neutrality_level
+        self.degeneracy=degeneracy
+        self.method=method
+        self.kpm_moments=kpm_moments
+        self.nr_states=nr_states
+        if mixing==None:
+            mixing=AndersonMixing(beta=1.)
+        self.mixing=mixing
+
+        if hasattr(hamiltonian,'maincell_hamiltonian_matrix'):
+            matrix=hamiltonian.maincell_hamiltonian_matrix()
+            coordinates=hamiltonian.orbitalpositions()
+        else:
+            if hamiltonian.mtot is None:
+                hamiltonian.build_hamiltonian()
+            matrix=hamiltonian.mtot
+            coordinates=hamiltonian.coords
+        self.hamiltonian_matrix=scipy.sparse.csr_matrix(matrix)
+        self.coordinates=numpy.array(coordinates,dtype=float)
+
+        self.interpolation=linear_interpolation_matrix(self.coordinates[:,axis]*length_unit,element_positions)
+
+        if element_volume==None:
+            operator=elements[0].rect.finitedifference_operator
+            element_volume=operator.dx*operator.dy
+        self.__charge_factor=Constants.elem_charge*degeneracy/(cell_length*element_volume)
+
+        rectangle_elementnumbers_range=container.rectangle_elementnumbers_range()
+        self.__indices=numpy.array([rectangle_elementnumbers_range[elem.rect][0]+elem.index() for elem in elements])
+        
+        #potential of the elements per unit charge density on each element
+        #(the solution is linear in the inhomogeneity, so the factorization
+        #is reused and no further Poisson solution is needed during the
+        #self consistency)
+        self.green=numpy.zeros((len(elements),len(elements)))
+        inhom=numpy.zeros(len(container.createinhomogeneity()))
+        for nr,idx in enumerate(self.__indices):
+            inhom[idx]=1/Constants.epsilon0
+            self.green[:,nr]=self.solver(inhom)[self.__indices]
+            inhom[idx]=0
+
+        self.__probing_colors=None
+        self.__neutral_density=None
+        if method=='kpm':
+            if probing_distance==None:
+                self.__probing_colors,self.__neutral_density=kpm.converged_probing_colors(
+                    self.hamiltonian_matrix,self.neutrality_level,self.kT,probing_tolerance,
+                    self.kpm_moments,coords=self.coordinates,kernel=True)
+            else:
+                self.__probing_colors=kpm.probing_colors(self.hamiltonian_matrix,probing_distance,
+                                                         self.coordinates)
+        self.__eigenvectors=None
+        self.__last_solution=None
+
+    def hamiltonian(self,potential):
+        """
+        Tight-binding matrix for the given potential of the elements.
+        """
+        site_potential=self.interpolation.dot(potential)
+        return self.hamiltonian_matrix-scipy.sparse.diags(site_potential,0,format='csr')
+
+    def site_density(self,potential,derivative=False):
+        """
+        Number of electrons per site (per spin) relative to the charge neutral
+        system.
+        
+        derivative: Also return the derivative of the density with respect
+                    to the potential of each site (i.e. the thermally 
+                    broadened local density of states at the Fermi energy).
+        """
+        site_potential=self.interpolation.dot(potential)
+        H=self.hamiltonian_matrix-scipy.sparse.diags(site_potential,0,format='csr')
+        if self.method=='kpm':
+            density,dos=self.__kpm_density(H)
+        elif self.method=='eigen':
+            density,dos=self.__eigen_density(H,site_potential)
+        else:
+            raise ValueError('Unknown method '+str(self.method))
+        if derivative:
+            return density,dos
+        return density
+
+    def __probing_blocks(self):
+        """
+        The probing vectors in blocks (the unit vectors of all sites if
+        there are no probing colors).
+        """
+        if self.__probing_colors is None:
+            N=self.hamiltonian_matrix.shape[0]
+            return kpm.unit_blocks(numpy.arange(N),N,16)
+        return kpm.probing_blocks(self.__probing_colors,16)
+
+    def __kpm_density(self,H):
+        if self.__neutral_density is None:
+            self.__neutral_density=kpm.fermi_density(self.hamiltonian_matrix,self.neutrality_level,self.kT,
+                                                     self.kpm_moments,self.__probing_blocks())
+        density,dos=kpm.fermi_density(H,self.fermi_energy,self.kT,self.kpm_moments,
+                                      self.__probing_blocks(),derivative=True)
+        return density-self.__neutral_density,dos
+
+    def __eigen_density(self,H,site_potential):
+        k=min(self.nr_states,H.shape[0]-2)
+        v0=None
+        if self.__eigenvectors is not None:
+            v0=self.__eigenvectors.sum(axis=1)
+        center=(self.fermi_energy+self.neutrality_level-numpy.mean(site_potential))/2.
+        w,v=scipy.sparse.linalg.eigsh(H.tocsc(),k=k,sigma=center,v0=v0)
+        self.__eigenvectors=v
+
+        #the neutrality level of each state is shifted by the potential it feels
+        probability=numpy.abs(v)**2
+        occupation=kpm.fermi_function(w,self.fermi_energy,self.kT)-\
+                   kpm.fermi_function(w,self.neutrality_level-numpy.dot(site_potential,probability),self.kT)
+        if abs(occupation[numpy.argmin(w)])>1e-3 or abs(occupation[numpy.argmax(w)])>1e-3:
+            print 'Warning(schroedingerpoisson): energy window too small, increase nr_states'
+        return numpy.dot(probability,occupation),numpy.dot(probability,kpm.fermi_derivative(w,self.fermi_energy,self.kT))
+
+    def charge(self,potential,derivative=False):
+        """
+        Volume charge density of the elements for the given potential of the
+        elements. The sign convention is the one of Element.charge and
+        Container.charge(), i.e. Laplace(potential)=charge/epsilon0, so
+        additional electrons give a positive charge.
+        
+        derivative: Also return the (approximate) derivative of the charge 
+                    with respect to the potential of the elements, a matrix.
+                    Only the local part of the response is included.
+        """
+        density,dos=self.site_density(potential,derivative=True)
+        charge=self.__charge_factor*self.interpolation.T.dot(density)
+        if not derivative:
+            return charge
+        P=self.interpolation
+        return charge,self.__charge_factor*(P.T.dot(P.multiply(dos[:,numpy.newaxis]))).toarray()
+
+    def poisson(self,charge):
+        """
+        Solve the Poisson equation with the given charge density of the
+        elements and the current gate configuration. Returns the solution
+        vector of the container.
+        """
+        inhom=self.container.createinhomogeneity()
+        inhom[self.__indices]+=charge/Constants.epsilon0
+        return self.solver(inhom)
+
+    def solve(self,x0=None,tol=1e-6,maxiter=100,max_step=None):
+        """
+        Self-consistency cycle.
+        
+        The potential of the elements for a given charge is calculated from
+        the response matrix (Green's function of the elements, see
+        __init__()) instead of a full Poisson solution. The residual
+        is preconditioned with the local response of the charge
+        (Newton direction), and the iterates are combined by the mixing
+        object (Anderson mixing by default).
+
+        x0: Initial potential of the elements. Default is the solution of
+            the previous call, or the potential without tight-binding charge.
+        tol: convergence criterion for the potential (in V).
+        maxiter: maximum number of iterations.
+        max_step: maximum change of the potential per iteration (in V).
+                  Default is 4*kT, which keeps the occupations from jumping
+                  in systems with a large density of states (e.g. edge states).
+
+        Return:
+        scipy.optimize.OptimizeResult with the potential x and the charge of
+        the elements, the site_density of the tight-binding system,
+        success and the number of iterations nit. The charge property of the
+        elements is set to the solution.
+        """
+        for elem in self.elements:
+            elem.charge=0
+        external=self.solver(self.container.createinhomogeneity())[self.__indices]
+
+        if x0 is None:
+            x0=self.__last_solution
+        if x0 is None:
+            x0=external
+        x=numpy.array(x0,dtype=float)
+
+        if max_step==None:
+            max_step=4*self.kT
+        self.mixing.reset()
+        identity=numpy.identity(len(x))
+        success=False
+        for nit in range(1,maxiter+1):
+            charge,dcharge=self.charge(x,derivative=True)
+            residual=external+numpy.dot(self.green,charge)-x
+            if numpy.max(numpy.abs(residual))<tol:
+                success=True
+                break
+            step=self.mixing(x,numpy.linalg.solve(identity-numpy.dot(self.green,dcharge),residual))-x
+            x=x+numpy.clip(step,-max_step,max_step)
+
+        if not success:
+            print 'Warning(schroedingerpoisson): no convergence after',maxiter,'iterations'
+
+        site_density=self.site_density(x)
+        charge=self.__charge_factor*self.interpolation.T.dot(site_density)
+        for elem,c in zip(self.elements,charge):
+            elem.charge=c
+        self.__last_solution=x
+
+        return scipy.optimize.OptimizeResult(x=x,charge=charge,site_density=site_density,
+                                             success=success,nit=nit,fun=residual)
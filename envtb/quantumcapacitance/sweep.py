@@ -0,0 +1,213 @@
+import numpy
+import os
+import multiprocessing
+
+#VoltageSweep whose points are calculated by the worker processes. It is set
+#before the pool is created, so the forked workers inherit it and nothing
+#but the chunk boundaries and the results has to be pickled.
+_active_sweep=None
+
+def _run_chunk(chunk):
+    return _active_sweep.run_chunk(*chunk)
+
+class VoltageSweep:
+    """
+    Quantum capacitance calculation for many voltage configurations, e.g.
+    a backgate sweep for several sidegate voltages.
+
+    The electrostatic problem is linear: for a configuration of voltages
+    v_g (one voltage per group of elements) and potentials p of the
+    quantum capacitance elements, the charge of any element is
+    c0+sum_g v_g*c_g+p*K. All these responses are calculated once in
+    __init__() with the factorized system (solver of the qcsolver), so the
+    per-voltage calculation only solves the (small) quantum capacitance
+    equation and neither needs the factorization nor changes any element.
+    This makes the voltage points independent, and run() distributes them
+    over a process pool.
+
+    Usage:
+
+    1) Create a QuantumCapacitanceSolver qcsolver as usual.
+    2) sweep=VoltageSweep(qcsolver,[backgateelements,sidegateelements],
+       grapheneelements)
+    3) charges,potentials=sweep.run(points,processes=4), points being an
+       array of shape (number of points, number of groups).
+    """
+    qcsolver=None
+    voltage_groups=None
+    charge_elements=None
+
+    def __init__(self,qcsolver,voltage_groups,charge_elements=None):
+        """
+        qcsolver: QuantumCapacitanceSolver of the system. refresh_basisvecs()
+                  is called if it hasn't been called yet.
+        voltage_groups: list of lists of elements. All elements of a group
+                        are set to the same voltage: metal elements get
+                        potential=voltage, elements of the qcsolver get
+                        fermi_energy=voltage.
+        charge_elements: The elements whose charge is returned by run().
+                         Default is the elements of the qcsolver.
+
+        The potential/fermi_energy of the elements is restored at the end.
+        """
+        self.qcsolver=qcsolver
+        self.voltage_groups=voltage_groups
+        if charge_elements==None:
+            charge_elements=qcsolver.elements
+        self.charge_elements=charge_elements
+
+        if qcsolver.m is None:
+            qcsolver.refresh_basisvecs()
+
+        container=qcsolver.container
+        qcindex=dict((elem,nr) for nr,elem in enumerate(qcsolver.elements))
+
+        saved=[(elem,elem.potential,elem.fermi_energy) for group in voltage_groups for elem in group]+\
+              [(elem,elem.potential,elem.fermi_energy) for elem in qcsolver.elements]
+        try:
+            for elem in qcsolver.elements:
+                elem.potential=0
+            for group in voltage_groups:
+                for elem in group:
+                    if elem not in qcindex:
+                        elem.potential=0
+
+            def charges(solution):
+                return (container.charge(solution,qcsolver.charge_operator,qcsolver.elements),
+                        container.charge(solution,qcsolver.charge_operator,charge_elements))
+
+            solution0=qcsolver.solver(container.createinhomogeneity())
+            self.__withnopot0,self.__charge0=charges(solution0)
+
+            withnopot_response=[]
+            charge_response=[]
+            fermi_response=numpy.zeros((len(voltage_groups),len(qcsolver.elements)))
+            for nr,group in enumerate(voltage_groups):
+                for elem in group:
+                    if elem in qcindex:
+                        fermi_response[nr,qcindex[elem]]=1
+                    else:
+                        elem.potential=1
+                w,c=charges(qcsolver.solver(container.createinhomogeneity())-solution0)
+                withnopot_response.append(w)
+                charge_response.append(c)
+                for elem in group:
+                    if elem not in qcindex:
+                        elem.potential=0
+            self.__withnopot_response=numpy.array(withnopot_response).reshape(len(voltage_groups),-1)
+            self.__charge_response=numpy.array(charge_response).reshape(len(voltage_groups),-1)
+            self.__fermi_response=fermi_response
+            self.__fermi0=numpy.array([elem.fermi_energy for elem in qcsolver.elements],dtype=float)
+            self.__fermi0[fermi_response.any(axis=0)]=0
+
+            if all(elem in qcindex for elem in charge_elements):
+                self.__potential_response=qcsolver.m[:,[qcindex[elem] for elem in charge_elements]]
+            else:
+                potential_response=[]
+                for elem in qcsolver.elements:
+                    elem.potential=1
+                    potential_response.append(charges(qcsolver.solver(container.createinhomogeneity())-solution0)[1])
+                    elem.potential=0
+                self.__potential_response=numpy.array(potential_response)
+        finally:
+            for elem,potential,fermi_energy in saved:
+                elem.potential=potential
+                elem.fermi_energy=fermi_energy
+
+    def solve_point(self,voltages,x0=None):
+        """
+        Solve the quantum capacitance problem for one voltage configuration.
+
+        voltages: one voltage per group.
+        x0: Initial guess for the potential of the qcsolver elements.
+
+        Return:
+        solution: result object of QuantumCapacitanceSolver.solve_configuration()
+        charges: charges of the charge_elements.
+        """
+        voltages=numpy.asarray(voltages,dtype=float)
+        withnopot=self.__withnopot0+numpy.dot(voltages,self.__withnopot_response)
+        fermi_energies=self.__fermi0+numpy.dot(voltages,self.__fermi_response)
+        solution=self.qcsolver.solve_configuration(withnopot,fermi_energies,x0)
+        if not solution.success:
+            print 'Warning(sweep): no convergence for voltages',voltages
+        charges=self.__charge0+numpy.dot(voltages,self.__charge_response)+\
+                numpy.dot(solution.x,self.__potential_response)
+        return solution,charges
+
+    def run_chunk(self,points,x0=None):
+        """
+        Solve a list of neighbouring voltage configurations in order. Each
+        solution is used as initial guess of the next point (linear
+        extrapolation from the previous two points).
+
+        Return:
+        charges, potentials: arrays with one row per point.
+        """
+        charges=[]
+        potentials=[]
+        previous=[]
+        for point in numpy.asarray(points,dtype=float):
+            if len(previous)==2:
+                (p1,x1),(p2,x2)=previous
+                dp=p2-p1
+                t=numpy.dot(point-p2,dp)/numpy.dot(dp,dp) if numpy.dot(dp,dp)>0 else 0
+                x0=x2+(x2-x1)*t
+            elif len(previous)==1:
+                x0=previous[0][1]
+            solution,charge=self.solve_point(point,x0)
+            previous=(previous+[(point,solution.x)])[-2:]
+            charges.append(charge)
+            potentials.append(solution.x)
+        return numpy.array(charges),numpy.array(potentials)
+
+    def run(self,points,processes=1,chunksize=None):
+        """
+        Calculate the charges for many voltage configurations.
+
+        points: array of shape (number of points, number of groups). For a
+                single group, a 1d array of voltages is accepted, too.
+                Order the points such that neighbours in the list are close
+                to each other (continuation), e.g. sweep the backgate
+                voltage for one sidegate configuration after the other.
+        processes: number of worker processes. None means one per CPU.
+                   The workers are forked (not available on Windows, where
+                   the points are calculated serially).
+        chunksize: number of neighbouring points calculated in a row by
+                   one worker (warm started from each other). Default is
+                   an equal share per process.
+
+        Return:
+        charges: array (number of points, number of charge_elements)
+        potentials: array (number of points, number of qcsolver elements)
+        """
+        global _active_sweep
+
+        points=numpy.asarray(points,dtype=float)
+        if points.ndim==1:
+            points=points.reshape(-1,1)
+        if processes==None:
+            processes=multiprocessing.cpu_count()
+        if not hasattr(os,'fork'):
+            processes=1
+        if chunksize==None:
+            chunksize=-(-len(points)//processes)
+        chunksize=max(chunksize,1)
+        chunks=[(points[i:i+chunksize],) for i in range(0,len(points),chunksize)]
+
+        if processes==1 or len(chunks)==1:
+            results=[self.run_chunk(*chunk) for chunk in chunks]
+        else:
+            _active_sweep=self
+            pool=multiprocessing.Pool(processes)
+            try:
+                results=pool.map(_run_chunk,chunks)
+            finally:
+                pool.close()
+                pool.join()
+                _active_sweep=None
+
+        if len(results)==0:
+            return numpy.zeros((0,len(self.charge_elements))),numpy.zeros((0,len(self.qcsolver.elements)))
+        return numpy.concatenate([charges for charges,potentials in results]),\
+               numpy.concatenate([potentials for charges,potentials in results])
@@ -1,5 +1,6 @@
 import numpy
 import scipy.linalg
+import scipy.sparse
 
 class LinearInterpolationNOGrid:
     """
@@ -236,3 +237,107 @@ class LinearInterpolationNOGrid:
         
         return self.__dim
 
+
+class MonotoneCubicInterpolation1D:
+    """
+    Monotone piecewise cubic (Hermite) interpolation of a function
+    given on a strictly increasing 1D grid. The slopes are chosen
+    according to Fritsch-Carlson (like scipy.interpolate.PchipInterpolator),
+    so the interpolation is monotone where the data is monotone.
+    
+    Construction and evaluation are vectorized, which makes the class
+    suitable for large tables. The slopes can be stored together with
+    the table and passed to the constructor again.
+    
+    Usage::
+    
+      interp=MonotoneCubicInterpolation1D(x,y)
+      yi=interp(xi)
+      
+    Points outside [x[0],x[-1]] give numpy.nan.
+    """
+    
+    def __init__(self,x,y,slopes=None):
+        """
+        x: Grid points, strictly increasing (list or numpy.array).
+        y: Function values at the grid points.
+        slopes: Derivatives at the grid points. Default is None, which means
+        that they are calculated.
+        """
+        self.x=numpy.asarray(x,dtype=float)
+        self.y=numpy.asarray(y,dtype=float)
+        if slopes is None:
+            self.slopes=self.__fritsch_carlson_slopes(self.x,self.y)
+        else:
+            self.slopes=numpy.asarray(slopes,dtype=float)
+            
+    @staticmethod
+    def __fritsch_carlson_slopes(x,y):
+        h=numpy.diff(x)
+        delta=numpy.diff(y)/h
+        slopes=numpy.zeros(len(x))
+        
+        w1=2*h[1:]+h[:-1]
+        w2=h[1:]+2*h[:-1]
+        samesign=delta[:-1]*delta[1:]>0
+        with numpy.errstate(divide='ignore',invalid='ignore'):
+            harmonic=(w1+w2)/(w1/delta[:-1]+w2/delta[1:])
+        slopes[1:-1]=numpy.where(samesign,harmonic,0.)
+        
+        def edge(h0,h1,delta0,delta1):
+            d=((2*h0+h1)*delta0-h0*delta1)/(h0+h1)
+            if numpy.sign(d)!=numpy.sign(delta0):
+                return 0.
+            if numpy.sign(delta0)!=numpy.sign(delta1) and abs(d)>abs(3*delta0):
+                return 3*delta0
+            return d
+        
+        if len(x)>2:
+            slopes[0]=edge(h[0],h[1],delta[0],delta[1])
+            slopes[-1]=edge(h[-1],h[-2],delta[-1],delta[-2])
+        else:
+            slopes[:]=delta[0]
+        return slopes
+    
+    def __call__(self,xi):
+        """
+        Interpolated values at xi (number or array).
+        """
+        xi=numpy.asarray(xi,dtype=float)
+        idx=numpy.clip(numpy.searchsorted(self.x,xi)-1,0,len(self.x)-2)
+        h=self.x[idx+1]-self.x[idx]
+        t=(xi-self.x[idx])/h
+        t2=t*t
+        t3=t2*t
+        result=((2*t3-3*t2+1)*self.y[idx]+(t3-2*t2+t)*h*self.slopes[idx]+
+                (-2*t3+3*t2)*self.y[idx+1]+(t3-t2)*h*self.slopes[idx+1])
+        return numpy.where((xi<self.x[0])|(xi>self.x[-1]),numpy.nan,result)
+
+def linear_interpolation_matrix(points,gridpoints):
+    """
+    Sparse matrix P for the linear interpolation of a function given on 
+    (not necessarily evenly spaced) 1D gridpoints to arbitrary points:
+    f(points)=P*f(gridpoints). Points outside the grid get the value of the
+    nearest gridpoint.
+    
+    The transpose distributes quantities (e.g. charges) located at the
+    points onto the gridpoints, conserving their sum.
+    
+    Return:
+    scipy.sparse.csr_matrix of shape (len(points),len(gridpoints))
+    """
+    points=numpy.asarray(points,dtype=float)
+    gridpoints=numpy.asarray(gridpoints,dtype=float)
+    order=numpy.argsort(gridpoints)
+    sortedgrid=gridpoints[order]
+    
+    if len(gridpoints)==1:
+        return scipy.sparse.csr_matrix(numpy.ones((len(points),1)))
+    
+    idx=numpy.clip(numpy.searchsorted(sortedgrid,points)-1,0,len(gridpoints)-2)
+    t=numpy.clip((points-sortedgrid[idx])/(sortedgrid[idx+1]-sortedgrid[idx]),0,1)
+    rows=numpy.concatenate([numpy.arange(len(points))]*2)
+    columns=numpy.concatenate([order[idx],order[idx+1]])
+    
+    return scipy.sparse.csr_matrix((numpy.concatenate([1-t,t]),(rows,columns)),
+                                   shape=(len(points),len(gridpoints)))
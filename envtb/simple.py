@@ -527,10 +527,10 @@ def GrapheneQuantumCapacitance(equation='potential'):
         element.potential = backgatevoltage
 
     # Create D(E,T) function.
-    Ef_dependence_function = quantumcapacitance.BulkGrapheneWithTemperature(
-        temperature, gridsize).Ef_interp
-    Ef_dependence_function_2 = quantumcapacitance.BulkGrapheneWithTemperature(
-        temperature, gridsize, interpolation=False).Q
+    Ef_dependence = quantumcapacitance.BulkGrapheneWithTemperature(
+        temperature, gridsize)
+    Ef_dependence_function = Ef_dependence.Ef_interp
+    Ef_dependence_function_2 = Ef_dependence.Q
 
     # Set electrochemical potential and D(E,T) for the GNR elements
     for element in grapheneelements:
@@ -538,6 +538,11 @@ def GrapheneQuantumCapacitance(equation='potential'):
         element.fermi_energy = 0
         element.fermi_energy_charge_dependence = Ef_dependence_function
         element.charge_fermi_energy_dependence = Ef_dependence_function_2
+        # Derivatives for the analytic Jacobian of the solver (optional)
+        element.fermi_energy_charge_dependence_derivative = \
+            Ef_dependence.dEf_dQ
+        element.charge_fermi_energy_dependence_derivative = \
+            Ef_dependence.dQ_dEf
 
     # Set dielectric material
     for x in range(graphenepos, hoehe):
@@ -0,0 +1,115 @@
+import numpy as np
+import scipy.linalg
+import wave_function
+
+
+class ArnoldiPropagator(object):
+    """
+    Krylov propagator for non-hermitian hamiltonians, e.g. with a complex
+    absorbing potential (potential.ComplexAbsorbingPotential). The Krylov
+    basis is orthonormalized against all previous vectors (Arnoldi), the
+    projected hamiltonian is an upper Hessenberg matrix and its exponential
+    is calculated directly. The interface is that of
+    lanczos.LanczosPropagator.
+
+    The norm of the wave function is not conserved, the probability
+    absorbed in the step is stored in self.norm_loss after propagate().
+
+    ham: hamiltonian object (with mtot and coords)
+
+    wf: initial wave function
+
+    NK: size of the Krylov subspace
+    """
+
+    def __init__(self, wf, ham, NK=6, dt=1.):
+
+        if isinstance(wf, wave_function.WaveFunction):
+            wf = wf.wf1d
+        wf = np.asarray(wf, dtype=complex)
+        self.norm = np.linalg.norm(wf)
+        self.Q = [wf / self.norm]
+        self.h = np.zeros((1, 0), dtype=complex)
+        self.NK = 0
+        self.dt = dt
+        self.ham = ham
+        if self.ham.mtot is None:
+            self.ham.build_hamiltonian()
+        self.breakdown = False
+        self.norm_loss = 0.0
+        for i in xrange(NK):
+            self.__add_subspace()
+
+    def __add_subspace(self):
+        """
+        One Arnoldi step: the new Krylov vector H q_{NK-1} is
+        orthonormalized against all previous vectors (modified Gram-Schmidt)
+        and the Hessenberg matrix self.h is extended by one column.
+        """
+        if self.breakdown:
+            return None
+        h = np.zeros((self.NK + 2, self.NK + 1), dtype=complex)
+        h[:self.NK + 1, :self.NK] = self.h
+        r = self.ham.mtot.dot(self.Q[-1])
+        for i, q in enumerate(self.Q):
+            h[i, self.NK] = np.vdot(q, r)
+            r = r - h[i, self.NK] * q
+        h[self.NK + 1, self.NK] = np.linalg.norm(r)
+        self.h = h
+        self.NK += 1
+        if abs(h[self.NK, self.NK - 1]) < 10**(-14) * max(np.abs(h).max(), 1.0):
+            # the Krylov space is invariant, the propagation is exact
+            self.breakdown = True
+        else:
+            self.Q.append(r / h[self.NK, self.NK - 1])
+        return None
+
+    def __build_propagator(self):
+        """
+        exp(-i*Hm*dt/hbar) of the NK x NK Hessenberg matrix Hm
+
+        NOTE:
+        hbar = 0.66 * 10**(-15) eV * s (!!!), as in LanczosPropagator
+        """
+        hbar = 0.66 * 10**(-15)
+        return scipy.linalg.expm(-1j * self.dt / hbar * self.h[:self.NK, :self.NK])
+
+    def propagate(self, num_error=10**(-18), regime='SIL'):
+        """
+        Applies the propagator to the initial wave function, see
+        LanczosPropagator.propagate().
+
+        num_error: numerical error: abs(U[NK-1, 0])**2 < num_error
+
+        regime = 'SIL': short iterative Arnoldi with changing of the time step
+                 'TSC': time-step constant and Krylov space is changed
+
+        Return
+        wf_out, dt, NK
+        """
+        if regime not in ('SIL', 'TSC'):
+            raise NameError("name %(regime)s is not defined" % vars())
+
+        while 1:
+            U = self.__build_propagator()
+            wf_krylov = U[:, 0]
+
+            conver = np.abs(wf_krylov[self.NK - 1])**2
+            if self.breakdown or conver < num_error:
+                break
+
+            if regime == 'SIL':
+                scale = 0.95 * (num_error / conver)**(1. / self.NK)
+                self.dt *= max([0.5, scale])
+            elif regime == 'TSC':
+                self.__add_subspace()
+
+        wfk = self.norm * np.dot(np.transpose(self.Q[:self.NK]), wf_krylov)
+        self.norm_loss = self.norm**2 - np.vdot(wfk, wfk).real
+
+        wf_out = wave_function.WaveFunction(wfk)
+        wf_out.coords = self.ham.coords
+
+        return wf_out, self.dt, self.NK
+
+# end class ArnoldiPropagator
@@ -0,0 +1,328 @@
+import numpy as np
+import os
+import numpy.lib.format
+import arnoldi
+import lanczos
+import wave_function
+
+
+class Observable(object):
+    """
+    An observable registered at the TimeEvolutionDriver: callback(t, wf, ham)
+    is evaluated every `every` steps. The values are collected in a
+    preallocated buffer of buffer_size frames, which is copied in bulk to
+    the result array (in memory, or a memory-mapped .npy file).
+    """
+
+    def __init__(self, name, callback, every, shape, dtype, nframes,
+                 buffer_size, file_name=None):
+        self.name = name
+        self.callback = callback
+        self.every = every
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.file_name = file_name
+        self.buffer = np.zeros((buffer_size,) + self.shape, dtype=self.dtype)
+        self.buffer_times = np.zeros(buffer_size)
+        self.nbuffered = 0
+        self.nwritten = 0
+        self.times = np.zeros(nframes)
+        self.nframes = nframes
+        self.resume = False
+        self.__values = None
+
+    @property
+    def values(self):
+        """
+        The result array. The output file is only created (or, after a
+        restart, reopened) on first use.
+        """
+        if self.__values is None:
+            shape = (self.nframes,) + self.shape
+            if self.file_name is None:
+                self.__values = np.zeros(shape, dtype=self.dtype)
+            elif self.resume and os.path.exists(self.file_name):
+                self.__values = np.load(self.file_name, mmap_mode='r+')
+            else:
+                self.__values = numpy.lib.format.open_memmap(
+                    self.file_name, mode='w+', dtype=self.dtype, shape=shape)
+        return self.__values
+
+    def record(self, t, wf, ham):
+        self.buffer[self.nbuffered] = self.callback(t, wf, ham)
+        self.buffer_times[self.nbuffered] = t
+        self.nbuffered += 1
+        if self.nbuffered == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        n = self.nbuffered
+        if n == 0:
+            return None
+        self.values[self.nwritten:self.nwritten + n] = self.buffer[:n]
+        self.times[self.nwritten:self.nwritten + n] = self.buffer_times[:n]
+        self.nwritten += n
+        self.nbuffered = 0
+        if isinstance(self.values, np.memmap):
+            self.values.flush()
+        return None
+
+# end class Observable
+
+
+class TimeEvolutionDriver(object):
+    """
+    Propagation of a wave function on a fixed time grid
+    t_n = t0 + n * dt, n = 0 ... nsteps.
+
+    The driver owns the hamiltonian update (vector potential evaluated once
+    per step, vectorized Peierls phases), the propagator engine and the
+    time grid. Observables are registered with add_observable() and
+    evaluated every few steps; their values are buffered and written in
+    bulk. With a checkpoint file, the run can be interrupted and continued
+    with restart().
+
+    Usage:
+
+        driver = TimeEvolutionDriver(wf, ham, dt, nsteps,
+                                     vector_potential=A_pot,
+                                     checkpoint='run.npz', output='run')
+        driver.add_observable('position',
+            lambda t, wf, ham: wf.calculate_average_position(),
+            every=10, shape=(2,))
+        driver.add_trajectory(writer, every=100)
+        driver.restart()    # continue from the checkpoint, if it exists
+        driver.run()
+        driver.results('position')
+    """
+
+    def __init__(self, wf, ham, dt, nsteps, t0=0.0, vector_potential=None,
+                 propagator='lanczos', NK=10, num_error=10**(-18),
+                 checkpoint=None, checkpoint_every=None, output=None,
+                 buffer_size=100):
+        """
+        wf: initial wave function (WaveFunction or array)
+        ham: hamiltonian instance, or a function t -> hamiltonian instance
+        dt: time step
+        nsteps: number of time steps
+        vector_potential: A(t) = [A_x, A_y], e.g. a
+                          vector_potential.VectorPotential. The hamiltonian
+                          of the step t -> t + dt is
+                          ham.apply_vector_potential(A(t + dt / 2)).
+                          A VectorPotential is tabulated on these times
+                          in advance (VectorPotential.on_grid()).
+        propagator: 'lanczos' (LanczosPropagator with constant time step
+                    and adaptive Krylov size NK, num_error), 'arnoldi'
+                    (ArnoldiPropagator, for non-hermitian hamiltonians with
+                    absorbing potentials, the absorbed probability is
+                    accumulated in self.norm_loss), an object with
+                    a method step(wf1d, t, dt) -> wf1d (e.g.
+                    magnus.MagnusPropagator) or a function
+                    (wf1d, hamiltonian, dt) -> wf1d
+        checkpoint: file name (.npz) of the checkpoint
+        checkpoint_every: steps between checkpoints (default: only at the
+                          end of run())
+        output: prefix of the files <output>_<name>.npy the observables are
+                written to (memory-mapped); None keeps them in memory
+        buffer_size: number of frames buffered per observable
+        """
+        if isinstance(wf, wave_function.WaveFunction):
+            self.wf = wf
+        else:
+            self.wf = wave_function.WaveFunction(np.asarray(wf), getattr(ham, 'coords', None))
+        self.ham = ham
+        self.dt = dt
+        self.nsteps = nsteps
+        self.t0 = t0
+        if hasattr(vector_potential, 'on_grid'):
+            # the driver needs A at the midpoints of the steps
+            vector_potential = vector_potential.on_grid(t0 + 0.5 * dt, dt,
+                                                        nsteps + 1)
+        self.vector_potential = vector_potential
+        self.propagator = propagator
+        self.NK = NK
+        self.num_error = num_error
+        self.checkpoint = checkpoint
+        self.checkpoint_every = checkpoint_every
+        self.output = output
+        self.buffer_size = buffer_size
+        self.step = 0
+        self.norm_loss = 0.0
+        self.A = None
+        self.observables = []
+        self.trajectories = []
+
+    @property
+    def time(self):
+        return self.t0 + self.step * self.dt
+
+    def hamiltonian(self, t):
+        """
+        The hamiltonian of the step t -> t + dt.
+        """
+        if hasattr(self.ham, 'mtot'):
+            ham = self.ham
+        else:
+            ham = self.ham(t + 0.5 * self.dt)
+        if self.vector_potential is not None:
+            self.A = self.vector_potential(t + 0.5 * self.dt)
+            ham = ham.apply_vector_potential(self.A)
+        return ham
+
+    def add_observable(self, name, callback, every=1, shape=(), dtype=float):
+        """
+        Registers callback(t, wf, ham) -> value (of the given shape and
+        dtype), evaluated at the steps n with n % every == 0. ham is the
+        hamiltonian of the following step (with the vector potential).
+        """
+        nframes = self.nsteps // every + 1
+        file_name = None
+        if self.output is not None:
+            file_name = '%s_%s.npy' % (self.output, name)
+        self.observables.append(Observable(
+            name, callback, every, shape, dtype, nframes,
+            min(self.buffer_size, nframes), file_name))
+        return None
+
+    def add_trajectory(self, writer, every=1, callback=None):
+        """
+        Writes the wave function to the trajectory.TrajectoryWriter writer
+        every `every` steps.
+
+        callback: callback(t, wf, ham) -> dictionary of further keyword
+                  arguments of writer.write(), e.g. the expansion and the
+                  observables stored in the trajectory
+        """
+        self.trajectories.append((writer, every, callback))
+        return None
+
+    def results(self, name):
+        """
+        times, values of the observable name recorded so far.
+        """
+        for observable in self.observables:
+            if observable.name == name:
+                observable.flush()
+                n = observable.nwritten
+                return observable.times[:n], observable.values[:n]
+        raise KeyError(name)
+
+    def flush(self):
+        for observable in self.observables:
+            observable.flush()
+        for writer, every, callback in self.trajectories:
+            writer.flush()
+        return None
+
+    def save_checkpoint(self):
+        """
+        Writes the state (wave function, step, Krylov size, the recorded
+        observables and the number of frames of the trajectories) to the
+        checkpoint file. The file is replaced atomically, so an interrupted
+        write leaves the previous checkpoint.
+        """
+        self.flush()
+        state = {'wf': self.wf.wf1d, 'step': self.step, 'NK': self.NK,
+                 'norm_loss': self.norm_loss}
+        for nr, observable in enumerate(self.observables):
+            state['nwritten_%d' % nr] = observable.nwritten
+            state['times_%d' % nr] = observable.times
+            if observable.file_name is None:
+                state['values_%d' % nr] = observable.values
+        for nr, (writer, every, callback) in enumerate(self.trajectories):
+            state['nframes_%d' % nr] = len(writer)
+        tmp_name = self.checkpoint + '.tmp.npz'
+        np.savez(tmp_name, **state)
+        os.rename(tmp_name, self.checkpoint)
+        return None
+
+    def restart(self):
+        """
+        Continues from the checkpoint file, if it exists. Call it after the
+        observables and trajectories have been registered (the output files
+        are reopened). Trajectories have to be reopened by the caller
+        (TrajectoryWriter with append=True); the frames written after the
+        checkpoint are dropped, as they are written again.
+
+        Return:
+        True if a checkpoint was loaded
+        """
+        if self.checkpoint is None or not os.path.exists(self.checkpoint):
+            return False
+        state = np.load(self.checkpoint)
+        self.wf.wf1d = state['wf']
+        self.step = int(state['step'])
+        self.NK = int(state['NK'])
+        if 'norm_loss' in state.files:
+            self.norm_loss = float(state['norm_loss'])
+        for nr, observable in enumerate(self.observables):
+            observable.resume = True
+            observable.nwritten = int(state['nwritten_%d' % nr])
+            observable.nbuffered = 0
+            observable.times[:] = state['times_%d' % nr]
+            if observable.file_name is None:
+                observable.values[:] = state['values_%d' % nr]
+        for nr, (writer, every, callback) in enumerate(self.trajectories):
+            if 'nframes_%d' % nr in state.files:
+                writer.truncate(int(state['nframes_%d' % nr]))
+        return True
+
+    def __propagate(self, ham):
+        if self.propagator == 'lanczos':
+            prop = lanczos.LanczosPropagator(wf=self.wf, ham=ham,
+                                             NK=self.NK, dt=self.dt)
+            wf, dt, self.NK = prop.propagate(num_error=self.num_error,
+                                             regime='TSC')
+            return wf.wf1d
+        if self.propagator == 'arnoldi':
+            prop = arnoldi.ArnoldiPropagator(wf=self.wf, ham=ham,
+                                             NK=self.NK, dt=self.dt)
+            wf, dt, self.NK = prop.propagate(num_error=self.num_error,
+                                             regime='TSC')
+            self.norm_loss += prop.norm_loss
+            return wf.wf1d
+        if hasattr(self.propagator, 'step'):
+            return self.propagator.step(self.wf.wf1d, self.time, self.dt)
+        return self.propagator(self.wf.wf1d, ham, self.dt)
+
+    def __record(self, ham):
+        t = self.time
+        for observable in self.observables:
+            if self.step % observable.every == 0:
+                observable.record(t, self.wf, ham)
+        for writer, every, callback in self.trajectories:
+            if self.step % every == 0:
+                if callback is None:
+                    writer.write(t, self.wf.wf1d)
+                else:
+                    writer.write(t, self.wf.wf1d, **callback(t, self.wf, ham))
+        return None
+
+    def run(self, nsteps=None):
+        """
+        Propagates up to step nsteps (default: the end of the time grid),
+        recording the observables on the way.
+        """
+        if nsteps is None:
+            nsteps = self.nsteps
+        nsteps = min(nsteps, self.nsteps)
+
+        ham = self.hamiltonian(self.time)
+        if self.step == 0:
+            self.__record(ham)
+        while self.step < nsteps:
+            self.wf.wf1d = self.__propagate(ham)
+            self.step += 1
+            ham = self.hamiltonian(self.time)
+            self.__record(ham)
+            if self.checkpoint is not None and self.checkpoint_every and \
+               self.step % self.checkpoint_every == 0:
+                self.save_checkpoint()
+
+        if self.checkpoint is not None:
+            self.save_checkpoint()
+        else:
+            self.flush()
+        return self.wf
+
+# end class TimeEvolutionDriver
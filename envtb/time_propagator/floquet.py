@@ -0,0 +1,182 @@
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+import scipy.special
+import magnus
+
+hbar = magnus.hbar
+
+
+def harmonic_components(vector_potential, frequency, nsamples=64, tolerance=10**(-8)):
+    """
+    Decomposes a monochromatic vector potential (e.g. VectorPotentialWave)
+    into A(t) = a sin(frequency t) + b cos(frequency t).
+
+    Return:
+    a, b: arrays of shape (2,)
+
+    Raises ValueError if A(t) is not of this form.
+    """
+    t = 2. * np.pi / frequency * np.arange(nsamples) / nsamples
+    A = np.array([vector_potential(ti) for ti in t], dtype=float)[:, :2]
+    s = np.sin(frequency * t)
+    c = np.cos(frequency * t)
+    a = 2. / nsamples * np.dot(s, A)
+    b = 2. / nsamples * np.dot(c, A)
+    residual = A - np.outer(s, a) - np.outer(c, b)
+    if np.max(np.abs(residual)) > tolerance * max(np.max(np.abs(A)), 10**(-300)):
+        raise ValueError('the vector potential is not monochromatic')
+    return a, b
+
+
+class FloquetHamiltonian(object):
+    """
+    Floquet hamiltonian of a hamiltonian with Peierls phases of a periodic
+    homogeneous vector potential A(t) = a sin(w t) + b cos(w t).
+
+    The phase of the hopping H_ij is R_ij sin(w t + phi_ij), so its Fourier
+    harmonics are given by Bessel functions (Jacobi-Anger expansion):
+
+    H(t) = sum_m H^(m) e^{i m w t},  H^(m)_ij = H_ij J_m(R_ij) e^{i m phi_ij}
+
+    The extended-space (Sambe space) hamiltonian with the Fourier index
+    n = -nharmonics ... nharmonics is
+
+    H_F[n, n'] = H^(n - n') + n hbar w delta_nn'
+
+    and its eigenvalues in the central zone are the quasienergies.
+    """
+
+    def __init__(self, ham, vector_potential=None, frequency=None,
+                 nharmonics=5, a=None, b=None):
+        """
+        ham: hamiltonian instance without vector potential
+        vector_potential: e.g. VectorPotentialWave; alternatively the
+                          amplitudes a, b of A(t) = a sin(w t) + b cos(w t)
+        frequency: angular frequency w, default vector_potential.frequency
+        nharmonics: cutoff of the Fourier index
+        """
+        if frequency is None:
+            frequency = vector_potential.frequency
+        if vector_potential is not None:
+            a, b = harmonic_components(vector_potential, frequency)
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        self.ham = ham
+        self.frequency = frequency
+        self.nharmonics = nharmonics
+        self.a = np.asarray(a, dtype=float)
+        self.b = np.asarray(b, dtype=float)
+        self.H0 = ham.mtot.tocsr()
+
+        bonds = ham.bond_vectors()
+        p = magnus.conversion_factor * np.dot(bonds, self.a)
+        q = magnus.conversion_factor * np.dot(bonds, self.b)
+        self.__R = np.sqrt(p**2 + q**2)
+        self.__phi = np.arctan2(q, p)
+        self.__matrix = None
+
+    @property
+    def photon_energy(self):
+        return hbar * self.frequency
+
+    def harmonic(self, m):
+        """
+        The Fourier component H^(m) as sparse matrix.
+        """
+        data = self.H0.data * scipy.special.jv(m, self.__R) * \
+               np.exp(1j * m * self.__phi)
+        return scipy.sparse.csr_matrix((data, self.H0.indices, self.H0.indptr),
+                                       shape=self.H0.shape)
+
+    def matrix(self):
+        """
+        The extended-space Floquet hamiltonian (sparse, hermitian) of size
+        (2 nharmonics + 1) N. The blocks are ordered by the Fourier index
+        n = -nharmonics ... nharmonics.
+        """
+        if self.__matrix is not None:
+            return self.__matrix
+        M = self.nharmonics
+        Nf = 2 * M + 1
+        N = self.H0.shape[0]
+        HF = scipy.sparse.kron(scipy.sparse.diags(self.photon_energy * np.arange(-M, M + 1)),
+                               scipy.sparse.identity(N))
+        for m in range(-2 * M, 2 * M + 1):
+            Hm = self.harmonic(m)
+            if abs(Hm).max() == 0:
+                continue
+            # block [n, n'] with n - n' = m
+            HF = HF + scipy.sparse.kron(scipy.sparse.eye(Nf, Nf, k=-m), Hm)
+        self.__matrix = HF.tocsr()
+        return self.__matrix
+
+    def quasienergies(self, k=20, sigma=0.0, return_states=False):
+        """
+        Quasienergies near sigma by a shift-invert solve of the extended
+        hamiltonian. Only states with a mean Fourier index |<n>| < 1/2 are
+        kept, so every quasienergy appears once.
+        The quasienergies are not folded into the zone, i.e. sigma selects
+        the replica.
+
+        Return:
+        quasienergies (sorted), and the central blocks of the states
+        (array (N, number of states)) if return_states
+        """
+        N = self.H0.shape[0]
+        w, v = scipy.sparse.linalg.eigsh(self.matrix(), k=k, sigma=sigma)
+        blocks = v.reshape(2 * self.nharmonics + 1, N, -1)
+        weights = np.sum(np.abs(blocks)**2, axis=1)
+        # the replicas of a state are shifted by integers in the mean
+        # Fourier index, so |<n>| < 1/2 selects one of them
+        mean_index = np.dot(np.arange(-self.nharmonics, self.nharmonics + 1), weights)
+        central = np.abs(mean_index) < 0.5
+        order = np.argsort(w[central])
+        if return_states:
+            return w[central][order], blocks[self.nharmonics][:, central][:, order]
+        return w[central][order]
+
+# end class FloquetHamiltonian
+
+
+def fold(energies, photon_energy):
+    """
+    Folds quasienergies into the zone [-photon_energy / 2, photon_energy / 2).
+    """
+    return np.mod(np.asarray(energies) + 0.5 * photon_energy, photon_energy) - \
+           0.5 * photon_energy
+
+
+def period_propagator(ham, vector_potential, frequency=None, nsteps=100,
+                      basis=None):
+    """
+    The one-period propagator U(T) in a basis block, by propagating all
+    basis vectors at once with the commutator-free Magnus integrator
+    (Chebyshev exponentials of the whole block).
+
+    basis: array (N, M) of vectors, default the identity (full U(T))
+    nsteps: time steps per period
+
+    Return:
+    U(T) basis, array (N, M)
+    """
+    if frequency is None:
+        frequency = vector_potential.frequency
+    if ham.mtot is None:
+        ham.build_hamiltonian()
+    if basis is None:
+        basis = np.identity(ham.mtot.shape[0], dtype=complex)
+    T = 2. * np.pi / frequency
+    prop = magnus.MagnusPropagator(ham, vector_potential, order=4,
+                                   exponential='chebyshev')
+    return prop.propagate(basis, 0.0, T / nsteps, nsteps)
+
+
+def quasienergies_from_propagator(U, frequency):
+    """
+    Quasienergies (folded into the zone, sorted) from the eigenvalues
+    exp(-i e T / hbar) of the one-period propagator U (full matrix).
+    """
+    T = 2. * np.pi / frequency
+    lam = np.linalg.eigvals(U)
+    return np.sort(fold(-hbar * np.angle(lam) / T, hbar * frequency))
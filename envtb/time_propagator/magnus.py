@@ -0,0 +1,173 @@
+import numpy as np
+import scipy.sparse
+import scipy.special
+import arnoldi
+import lanczos
+
+hbar = 0.66 * 10**(-15) # eV * s, as in lanczos.LanczosPropagator
+
+# e/hbar * Angstrem, see GeneralHamiltonian.apply_vector_potential
+conversion_factor = 1.602176487 / 1.0545717*1e5
+
+# Gauss-Legendre nodes of the step and the coefficients of the 4th order
+# commutator-free Magnus integrator (CFM4):
+# U = exp(-i dt (a1 H1 + a2 H2)) exp(-i dt (a2 H1 + a1 H2))
+_gauss_nodes = np.array([0.5 - np.sqrt(3.) / 6., 0.5 + np.sqrt(3.) / 6.])
+_a1 = (3. - 2. * np.sqrt(3.)) / 12.
+_a2 = (3. + 2. * np.sqrt(3.)) / 12.
+
+
+class _MatrixHamiltonian(object):
+    """
+    Minimal hamiltonian instance (mtot and coords) for LanczosPropagator
+    and ArnoldiPropagator.
+    """
+
+    def __init__(self, mtot, coords):
+        self.mtot = mtot
+        self.coords = coords
+
+
+def chebyshev_exponential(H, wf, tau, bounds=None, tolerance=10**(-14)):
+    """
+    exp(-i H tau) wf by a Chebyshev expansion, the coefficients are Bessel
+    functions: exp(-i (a x + b) tau) = e^{-i b tau} sum_n (2 - delta_n0)
+    (-i)^n J_n(a tau) T_n(x).
+
+    H: sparse hermitian matrix
+    tau: time (in units of 1 / energy of H)
+    bounds: (a, b) from envtb.ldos.kpm.spectral_bounds(), calculated if None
+    tolerance: the expansion is cut where |J_n(a tau)| < tolerance
+    """
+    import envtb.ldos.kpm as kpm
+    if bounds is None:
+        bounds = kpm.spectral_bounds(H)
+    a, b = bounds
+    N = int(abs(a * tau) + 10)
+    while abs(scipy.special.jv(N, a * tau)) > tolerance:
+        N += 10
+    n = np.arange(N)
+    c = (2. - (n == 0)) * (-1j)**n * scipy.special.jv(n, a * tau) * \
+        np.exp(-1j * b * tau)
+    return kpm.chebyshev_apply(H, c, a, b, wf)
+
+
+class MagnusPropagator(object):
+    """
+    Commutator-free Magnus integrator for a hamiltonian in a time-dependent
+    (homogeneous) vector potential A(t), i.e. Peierls phases on the hopping
+    elements.
+
+    order=4: CFM4, A(t) is sampled at the two Gauss-Legendre nodes of each
+             step and the step is the product of two exponentials of
+             linear combinations of H(A1) and H(A2). The local error is
+             O(dt^5), so much larger steps than with a single exponential
+             are possible for pulses.
+    order=2: exponential midpoint rule, one exponential of H(A(t + dt/2)).
+
+    The exponentials are calculated with the Lanczos propagator (adaptive
+    Krylov size, exponential='lanczos'), a Chebyshev expansion
+    (exponential='chebyshev') or the Arnoldi propagator for non-hermitian
+    hamiltonians, e.g. with absorbing potentials (exponential='arnoldi'). The phases are calculated from the bond
+    vectors of the unperturbed hamiltonian, which are cached.
+
+    The propagator can be used with TimeEvolutionDriver (propagator=...),
+    which passes the time of the step to step().
+    """
+
+    def __init__(self, ham, vector_potential, order=4, exponential='lanczos',
+                 NK=10, num_error=10**(-18)):
+        """
+        ham: hamiltonian instance without vector potential
+        vector_potential: A(t) = [A_x, A_y], e.g. a VectorPotential;
+                          None for a static hamiltonian
+        """
+        if order not in (2, 4):
+            raise ValueError('order has to be 2 or 4')
+        if exponential not in ('lanczos', 'chebyshev', 'arnoldi'):
+            raise ValueError('unknown exponential %s' % exponential)
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        self.ham = ham
+        self.vector_potential = vector_potential
+        self.order = order
+        self.exponential = exponential
+        self.NK = NK
+        self.num_error = num_error
+        self.H0 = ham.mtot.tocsr()
+        self.bonds = ham.bond_vectors()
+        self.bounds = None
+
+    def phases(self, A):
+        """
+        Peierls phase factors of the stored elements of H0 for the vector
+        potential A = [A_x, A_y].
+        """
+        if A is None:
+            return np.ones(len(self.bonds))
+        A = np.asarray(A, dtype=float)
+        return np.exp(1j * conversion_factor * np.dot(self.bonds, A[:2]))
+
+    def hamiltonian_matrix(self, vector_potentials, weights):
+        """
+        sum_k weights_k H(A_k) as sparse matrix.
+        """
+        phase = sum(w * self.phases(A) for A, w in zip(vector_potentials, weights))
+        return scipy.sparse.csr_matrix(
+            (self.H0.data * phase, self.H0.indices, self.H0.indptr),
+            shape=self.H0.shape)
+
+    def __exponential(self, H, wf, dt):
+        """
+        exp(-i H dt / hbar) wf
+        """
+        if self.exponential == 'chebyshev':
+            if self.bounds is None:
+                import envtb.ldos.kpm as kpm
+                # the phases do not change the Gershgorin bounds
+                self.bounds = kpm.spectral_bounds(self.H0)
+            return chebyshev_exponential(H, wf, dt / hbar, self.bounds)
+        if self.exponential == 'arnoldi':
+            propagator = arnoldi.ArnoldiPropagator
+        else:
+            propagator = lanczos.LanczosPropagator
+        prop = propagator(
+            wf=wf, ham=_MatrixHamiltonian(H, self.ham.coords), NK=self.NK, dt=dt)
+        wf_out, dt_out, self.NK = prop.propagate(num_error=self.num_error,
+                                                 regime='TSC')
+        return wf_out.wf1d
+
+    def __A(self, t):
+        if self.vector_potential is None:
+            return None
+        return self.vector_potential(t)
+
+    def step(self, wf, t, dt):
+        """
+        Propagates the wave function (array, or block of states (N, M) for
+        exponential='chebyshev') from t to t + dt.
+        """
+        if self.order == 2:
+            A = self.__A(t + 0.5 * dt)
+            return self.__exponential(self.hamiltonian_matrix([A], [1.0]), wf, dt)
+
+        A1, A2 = [self.__A(t + c * dt) for c in _gauss_nodes]
+        wf = self.__exponential(self.hamiltonian_matrix([A1, A2], [2 * _a2, 2 * _a1]),
+                                wf, 0.5 * dt)
+        return self.__exponential(self.hamiltonian_matrix([A1, A2], [2 * _a1, 2 * _a2]),
+                                  wf, 0.5 * dt)
+
+    def propagate(self, wf, t0, dt, nsteps):
+        """
+        Propagates the wave function (array or WaveFunction) nsteps steps
+        from t0.
+
+        Return:
+        wave function (array) at t0 + nsteps * dt
+        """
+        wf = np.array(getattr(wf, 'wf1d', wf), dtype=complex)
+        for n in xrange(nsteps):
+            wf = self.step(wf, t0 + n * dt, dt)
+        return wf
+
+# end class MagnusPropagator
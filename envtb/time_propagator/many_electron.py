@@ -0,0 +1,166 @@
+import numpy as np
+import driver
+import magnus
+import observables
+
+
+def fermi_occupations(energies, mu, kT=0.0):
+    """
+    Occupations of the states with the given energies, a step function for
+    kT = 0.
+    """
+    energies = np.real(energies)
+    if kT == 0.0:
+        return (energies <= mu).astype(float)
+    x = np.clip((energies - mu) / kT, -700., 700.)
+    return 1. / (np.exp(x) + 1.)
+
+
+def occupied_states(ham, mu=0.0, kT=0.0, k=20, sigma=0.0, min_occupation=10**(-10)):
+    """
+    The occupied subspace from the eigenstates of the hamiltonian near
+    sigma (sorted_eigenvalue_problem()). Only the k states of the energy
+    window are included, states below the window are treated as inert.
+
+    mu: chemical potential
+    kT: temperature (energy), the states are weighted with Fermi occupations
+    min_occupation: states with smaller occupations are dropped
+
+    Return:
+    energies (M,), block of states (N, M), occupations (M,)
+    """
+    w, v = ham.sorted_eigenvalue_problem(k=k, sigma=sigma)
+    weights = fermi_occupations(w, mu, kT)
+    occupied = weights > min_occupation
+    return np.real(w[occupied]), np.array(v[:, occupied], dtype=complex), \
+           weights[occupied]
+
+
+class ManyElectronPropagation(object):
+    """
+    Time propagation of a many-electron (Slater determinant) state: the
+    occupied orbitals are propagated together as one block (N, M) with the
+    commutator-free Magnus integrator, every exponential is one Chebyshev
+    expansion with sparse matrix - block products. The observables are
+    traces over the block, weighted with the occupations:
+
+    'current': sum_k f_k <psi_k|v|psi_k> (hbar = 1, see
+               observables.total_current)
+    'dipole': sum_k f_k <psi_k|r|psi_k>
+    'occupations': sum_k f_k |<v_n|psi_k>|^2 of the basis states v_n (if a
+                   basis v is given, e.g. the eigenstates)
+
+    The propagation is run by a TimeEvolutionDriver (checkpoints, buffered
+    output), further observables can be registered at self.driver.
+
+    Usage:
+
+        w, block, f = occupied_states(ham, mu=0.0, k=250)
+        run = ManyElectronPropagation(ham, block, dt, nsteps, A_pot,
+                                      weights=f, v=v, every=10)
+        run.run()
+        t, j = run.results('current')
+        frequencies, spectrum = harmonic_spectrum(t, j[:, 0])
+    """
+
+    def __init__(self, ham, block, dt, nsteps, vector_potential=None,
+                 weights=None, v=None, every=1, order=4, t0=0.0,
+                 checkpoint=None, checkpoint_every=None, output=None,
+                 buffer_size=100):
+        """
+        ham: hamiltonian instance without vector potential
+        block: occupied states, array (N, M)
+        vector_potential: A(t), e.g. vector_potential.VectorPotential
+        weights: occupations of the states (default 1)
+        v: basis (N, K) of the occupations, None to skip them
+        every: steps between the recorded frames
+        order: order of the Magnus integrator (2 or 4)
+        checkpoint, checkpoint_every, output, buffer_size: see
+            TimeEvolutionDriver
+        """
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        block = np.array(block, dtype=complex)
+        if block.ndim == 1:
+            block = block[:, np.newaxis]
+        if weights is None:
+            weights = np.ones(block.shape[1])
+        self.ham = ham
+        self.weights = np.asarray(weights, dtype=float)
+        self.v = v
+        self.propagator = magnus.MagnusPropagator(
+            ham, vector_potential, order=order, exponential='chebyshev')
+        self.driver = driver.TimeEvolutionDriver(
+            block, ham, dt, nsteps, t0=t0, vector_potential=vector_potential,
+            propagator=self.propagator, checkpoint=checkpoint,
+            checkpoint_every=checkpoint_every, output=output,
+            buffer_size=buffer_size)
+        self.driver.wf.coords = ham.coords
+        coords = self.driver.wf.coords_array()
+        dimension = coords.shape[1]
+
+        self.driver.add_observable(
+            'current', lambda t, wf, ham2: observables.total_current(
+                wf.wf1d, ham2, coords, self.weights),
+            every=every, shape=(dimension,))
+        self.driver.add_observable(
+            'dipole', lambda t, wf, ham2: observables.dipole(
+                wf.wf1d, coords, self.weights),
+            every=every, shape=(dimension,))
+        if v is not None:
+            self.driver.add_observable(
+                'occupations', lambda t, wf, ham2: observables.occupations(
+                    wf.wf1d, v, self.weights),
+                every=every, shape=(v.shape[1],))
+
+    @property
+    def block(self):
+        return self.driver.wf.wf1d
+
+    def restart(self):
+        return self.driver.restart()
+
+    def run(self, nsteps=None):
+        """
+        Propagates the block, see TimeEvolutionDriver.run().
+
+        Return:
+        block of states (N, M)
+        """
+        return self.driver.run(nsteps).wf1d
+
+    def results(self, name):
+        """
+        times, values of the observable name, see TimeEvolutionDriver.results()
+        """
+        return self.driver.results(name)
+
+# end class ManyElectronPropagation
+
+
+def harmonic_spectrum(times, current, window=np.hanning):
+    """
+    Emission spectrum |omega j(omega)|^2 (i.e. of the time derivative of
+    the current) on the positive frequencies.
+
+    times: equally spaced times
+    current: array (len(times),) or (len(times), components); the
+             components are summed in the spectrum
+    window: window function of the length of the signal, None for none
+
+    Return:
+    angular frequencies, spectrum
+    """
+    times = np.asarray(times)
+    current = np.asarray(current, dtype=float)
+    if current.ndim == 1:
+        current = current[:, np.newaxis]
+    n = len(times)
+    dt = times[1] - times[0]
+    current = current - np.mean(current, axis=0)
+    if window is not None:
+        current = current * window(n)[:, np.newaxis]
+    frequencies = 2. * np.pi * np.fft.rfftfreq(n, dt)
+    j = np.fft.rfft(current, axis=0) * dt
+    spectrum = np.sum(np.abs(frequencies[:, np.newaxis] * j)**2, axis=1)
+    return frequencies, spectrum
@@ -0,0 +1,244 @@
+""" Offline rendering of wave-function trajectories into movies.
+
+    The frames of a trajectory file (trajectory.TrajectoryWriter) are
+    rendered after (or alongside) the propagation job: |wf|^2 is summed onto
+    a pixel grid with site -> pixel indices calculated once from the
+    coordinates, mapped to colors and written as PNG files or piped as raw
+    rgb24 video to ffmpeg. Only the Agg renderer of matplotlib is used (no
+    pyplot, no display), and the frames are rendered by a pool of worker
+    processes.
+
+    Usage:
+
+        renderer = MovieRenderer('wf.trj', ham.coords, resolution=600)
+        renderer.save_frames('pic/frame%05i.png', processes=4)
+        renderer.encode('wf.mp4', fps=25, processes=4)
+"""
+
+import numpy as np
+import os
+import subprocess
+import multiprocessing
+import trajectory
+try:
+    import matplotlib
+    import matplotlib.cm
+    import matplotlib.image
+except:
+    print 'Warning(movie): no module matplotlib'
+    pass
+
+# renderer of MovieRenderer.save_frames() / encode(), inherited by the
+# forked worker processes
+_active_renderer = None
+
+
+def _render_frame(n):
+    return _active_renderer.image(n)
+
+
+def _save_frame(args):
+    n, file_name = args
+    _active_renderer.save_frame(n, file_name)
+    return file_name
+
+
+def load_coordinates(coords):
+    """
+    Coordinates of the sites as array (N, 2): from an array or list (e.g.
+    ham.coords), a .npy file or a text file (one site per line).
+    """
+    if isinstance(coords, basestring):
+        if coords.endswith('.npy'):
+            coords = np.load(coords)
+        else:
+            coords = np.loadtxt(coords)
+    return np.atleast_2d(np.asarray(coords, dtype=float))[:, :2]
+
+
+def ffmpeg_command(output, width, height, fps=25, ffmpeg='ffmpeg',
+                   options=('-pix_fmt', 'yuv420p')):
+    """
+    The ffmpeg command line reading raw rgb24 frames of width x height
+    from stdin.
+    """
+    return [ffmpeg, '-y', '-loglevel', 'error',
+            '-f', 'rawvideo', '-pix_fmt', 'rgb24',
+            '-s', '%ix%i' % (width, height), '-r', str(fps),
+            '-i', '-'] + list(options) + [output]
+
+
+class MovieRenderer(object):
+    """
+    Renders the frames of a trajectory as images of |wf|^2.
+
+    The pixel grid covers the bounding box of the sites; the density of a
+    pixel is the sum over its sites. The colors are normalized to the
+    maximum of every frame (vmax=None) or to a fixed vmax.
+    """
+
+    def __init__(self, traj, coords, resolution=400, upscale=1, colormap='hot',
+                 vmax=None, bounds=None):
+        """
+        traj: trajectory.Trajectory or the name of a trajectory file
+        coords: coordinates of the sites, see load_coordinates()
+        resolution: number of pixels along the longer side of the box
+        upscale: each pixel is repeated upscale x upscale times in the image
+        colormap: name of a matplotlib colormap
+        vmax: density of the top color, None for the maximum of each frame
+        bounds: (xmin, xmax, ymin, ymax) of the box, default the bounding
+                box of the sites
+        """
+        if isinstance(traj, basestring):
+            traj = trajectory.Trajectory(traj)
+        self.trajectory = traj
+        coords = load_coordinates(coords)
+        nsites = self.trajectory.dtype['wf'].shape[0]
+        if len(coords) < nsites:
+            raise ValueError('%i coordinates for %i sites' % (len(coords), nsites))
+        coords = coords[:nsites]
+
+        if bounds is None:
+            bounds = (coords[:, 0].min(), coords[:, 0].max(),
+                      coords[:, 1].min(), coords[:, 1].max())
+        xmin, xmax, ymin, ymax = bounds
+        pixel = max(xmax - xmin, ymax - ymin, 10**(-12)) / float(resolution)
+        nx = int(np.floor((xmax - xmin) / pixel)) + 1
+        ny = int(np.floor((ymax - ymin) / pixel)) + 1
+        i = np.clip(((coords[:, 0] - xmin) / pixel).astype(int), 0, nx - 1)
+        j = np.clip(((coords[:, 1] - ymin) / pixel).astype(int), 0, ny - 1)
+        # row 0 of the image is the top (largest y)
+        self.index = (ny - 1 - j) * nx + i
+        self.shape = (ny, nx)
+        self.upscale = upscale
+        self.colormap = matplotlib.cm.get_cmap(colormap)
+        self.vmax = vmax
+
+    @property
+    def size(self):
+        """
+        width, height of the images in pixels (even, as needed by most
+        video codecs)
+        """
+        height = self.shape[0] * self.upscale
+        width = self.shape[1] * self.upscale
+        return width + width % 2, height + height % 2
+
+    def __len__(self):
+        return len(self.trajectory)
+
+    def density(self, n):
+        """
+        |wf|^2 of frame n summed onto the pixel grid, array (ny, nx).
+        """
+        wf = self.trajectory.wave_function(n)
+        density = np.bincount(self.index, weights=np.abs(wf)**2,
+                              minlength=self.shape[0] * self.shape[1])
+        return density.reshape(self.shape)
+
+    def image(self, n):
+        """
+        The rgb image (uint8, (height, width, 3)) of frame n.
+        """
+        density = self.density(n)
+        vmax = self.vmax
+        if vmax is None:
+            vmax = density.max()
+        if vmax > 0:
+            density = density / vmax
+        rgb = self.colormap(np.clip(density, 0.0, 1.0), bytes=True)[:, :, :3]
+        if self.upscale > 1:
+            rgb = np.repeat(np.repeat(rgb, self.upscale, axis=0), self.upscale, axis=1)
+        width, height = self.size
+        if rgb.shape[:2] != (height, width):
+            rgb = np.pad(rgb, ((0, height - rgb.shape[0]), (0, width - rgb.shape[1]),
+                               (0, 0)), mode='edge')
+        return np.ascontiguousarray(rgb)
+
+    def save_frame(self, n, file_name):
+        matplotlib.image.imsave(file_name, self.image(n))
+
+    def __map(self, function, arguments, processes, ordered_callback=None):
+        """
+        function(argument) for all arguments on a pool of forked worker
+        processes (serially if processes == 1 or fork is not available).
+        The results are passed in order to ordered_callback.
+        """
+        global _active_renderer
+
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        if not hasattr(os, 'fork'):
+            processes = 1
+        _active_renderer = self
+        try:
+            if processes == 1 or len(arguments) < 2:
+                results = (function(argument) for argument in arguments)
+                for result in results:
+                    ordered_callback(result)
+                return None
+            pool = multiprocessing.Pool(processes)
+            try:
+                for result in pool.imap(function, arguments, chunksize=4):
+                    ordered_callback(result)
+            finally:
+                pool.close()
+                pool.join()
+        finally:
+            _active_renderer = None
+        return None
+
+    def save_frames(self, pattern='frame%05i.png', frames=None, processes=None):
+        """
+        Writes frame n to the PNG file pattern % n.
+
+        frames: frame numbers, default all
+        processes: number of worker processes, None means one per CPU
+
+        Return:
+        list of the file names
+        """
+        if frames is None:
+            frames = range(len(self))
+        arguments = [(n, pattern % n) for n in frames]
+        files = []
+        self.__map(_save_frame, arguments, processes, files.append)
+        return files
+
+    def write_raw(self, stream, frames=None, processes=None):
+        """
+        Writes the frames as raw rgb24 video (frame after frame, size
+        self.size) to the file object stream, e.g. sys.stdout to pipe into
+
+            ffmpeg -f rawvideo -pix_fmt rgb24 -s WxH -r 25 -i - out.mp4
+
+        The frames are rendered in parallel and written in order.
+        """
+        if frames is None:
+            frames = range(len(self))
+        self.__map(_render_frame, list(frames), processes,
+                   lambda image: stream.write(image.tostring()))
+        return None
+
+    def encode(self, output, fps=25, frames=None, processes=None,
+               ffmpeg='ffmpeg', options=('-pix_fmt', 'yuv420p')):
+        """
+        Pipes the frames to ffmpeg, which encodes them into the video file
+        output (format from the extension).
+
+        options: output options of ffmpeg
+        """
+        width, height = self.size
+        process = subprocess.Popen(ffmpeg_command(output, width, height, fps,
+                                                  ffmpeg, options),
+                                   stdin=subprocess.PIPE)
+        try:
+            self.write_raw(process.stdin, frames, processes)
+        finally:
+            process.stdin.close()
+            returncode = process.wait()
+        if returncode != 0:
+            raise RuntimeError('ffmpeg failed with exit code %i' % returncode)
+        return None
+
+# end class MovieRenderer
@@ -0,0 +1,146 @@
+import numpy as np
+import scipy.sparse
+
+
+def coordinates_array(coords):
+    """
+    Converts the coordinates of the sites (list of [x, y, (z)]) into a
+    float array of shape (number of sites, dimension).
+    """
+    return np.asarray(coords, dtype=float)
+
+
+def hamiltonian_matrix(ham):
+    """
+    The sparse (csr) matrix of a hamiltonian instance (e.g.
+    envtb.ldos.hamiltonian.GeneralHamiltonian) or of a matrix.
+    """
+    if hasattr(ham, 'mtot'):
+        if ham.mtot is None:
+            ham.build_hamiltonian()
+        ham = ham.mtot
+    return scipy.sparse.csr_matrix(ham)
+
+
+def norm(wf):
+    """
+    <wf|wf>
+    """
+    return np.vdot(wf, wf).real
+
+
+def average_position(wf, coords):
+    """
+    The average position <wf|r|wf> / <wf|wf> of the wave function.
+
+    wf: wave function, array of shape (N,)
+    coords: array of shape (N, dimension), see coordinates_array()
+
+    Return:
+    array with one average per coordinate
+    """
+    weights = np.abs(wf)**2
+    return np.dot(weights, coords) / np.sum(weights)
+
+
+def dipole(wf, coords, weights=None):
+    """
+    sum_k weights_k <wf_k|r|wf_k> of a block of states (N, M) (or of a
+    single wave function), without normalization.
+    """
+    density = np.abs(wf)**2
+    if np.ndim(wf) > 1:
+        density = np.sum(density, axis=1) if weights is None else np.dot(density, weights)
+    return np.dot(density, coords)
+
+
+def occupations(wf, v, weights=None):
+    """
+    Occupations sum_k weights_k |<v_n|wf_k>|^2 of the basis states v_n
+    (columns of v, e.g. eigenstates) by a block of states (N, M).
+    """
+    c = np.abs(expansion_coefficients(wf, v))**2
+    if np.ndim(wf) > 1:
+        c = np.sum(c, axis=1) if weights is None else np.dot(c, weights)
+    return c
+
+
+def expansion_coefficients(wf, v):
+    """
+    The coefficients <v_i|wf> of the wave function in the basis of the
+    columns v_i of v (e.g. eigenvectors from eigenvalue_problem()).
+    """
+    return np.dot(np.conjugate(v.T), wf)
+
+
+def bond_currents(wf, ham, weights=None):
+    """
+    The bond currents J_ij = 2 Im(wf_i^* H_ij wf_j) (hbar = 1), i.e. the
+    probability current flowing from site j to site i,
+    d|wf_i|^2/dt = sum_j J_ij. A vector potential enters through the Peierls
+    phases of H, so the currents are gauge invariant.
+
+    wf: wave function, array of shape (N,), or a block of states (N, M)
+        whose currents are summed (many-electron state)
+    ham: hamiltonian instance or (sparse) matrix, see hamiltonian_matrix()
+    weights: occupations of the states of a block (default 1)
+
+    Return:
+    scipy.sparse.csr_matrix with the sparsity pattern of H
+    """
+    H = hamiltonian_matrix(ham)
+    rows = np.repeat(np.arange(H.shape[0]), np.diff(H.indptr))
+    if np.ndim(wf) == 1:
+        density = np.conjugate(wf[rows]) * wf[H.indices]
+    else:
+        if weights is None:
+            weights = np.ones(wf.shape[1])
+        # the states are summed in chunks of columns, so that the
+        # temporaries (number of bonds x chunk) are not larger than wf
+        chunk = max(1, wf.size // max(len(rows), 1))
+        density = np.zeros(len(rows), dtype=complex)
+        for start in xrange(0, wf.shape[1], chunk):
+            block = wf[:, start:start + chunk]
+            density += np.dot(np.conjugate(block[rows]) * block[H.indices],
+                              weights[start:start + chunk])
+    data = 2. * (density * H.data).imag
+    return scipy.sparse.csr_matrix((data, H.indices, H.indptr), shape=H.shape)
+
+
+def total_current(wf, ham, coords, weights=None):
+    """
+    The expectation value of the velocity operator i [H, r] (hbar = 1),
+    i.e. the sum of the bond currents times the bond vectors,
+    1/2 sum_ij J_ij (r_i - r_j). For a block of states (N, M), the trace
+    over the states (weighted with the occupations weights).
+
+    coords: array of shape (N, dimension), see coordinates_array()
+
+    Return:
+    array with one component per coordinate
+    """
+    J = bond_currents(wf, ham, weights)
+    rows = np.repeat(np.arange(J.shape[0]), np.diff(J.indptr))
+    return 0.5 * np.dot(J.data, coords[rows] - coords[J.indices])
+
+
+def frame_observables(wf, coords, ham=None, v=None):
+    """
+    All observables of one frame of a time propagation.
+
+    wf: wave function, array of shape (N,)
+    coords: array of shape (N, dimension), see coordinates_array()
+    ham: hamiltonian of the frame, the current is calculated if given
+    v: basis for the expansion, the expansion is calculated if given
+
+    Return:
+    dictionary with the keys 'norm', 'position' and, if requested,
+    'current' and 'expansion'
+    """
+    observables = {'norm': norm(wf),
+                   'position': average_position(wf, coords)}
+    if ham is not None:
+        observables['current'] = total_current(wf, ham, coords)
+    if v is not None:
+        observables['expansion'] = expansion_coefficients(wf, v)
+    return observables
@@ -0,0 +1,325 @@
+""" Binary trajectory files for the output of time propagations.
+
+    A trajectory file consists of a header and a sequence of frames of
+    fixed size:
+
+    - 8 bytes magic 'ENVTBTRJ'
+    - 8 bytes little-endian uint64: length of the header in bytes
+    - json header (padded with spaces to a multiple of 64 bytes) with the
+      numpy dtype of a frame and a free description
+    - frames, each one record of the frame dtype: 'time', 'wf' (wave
+      function), optionally 'expansion' and one field per observable.
+
+    Frames are only appended, so the number of frames follows from the
+    file size (an incomplete last frame, e.g. of an interrupted run, is
+    ignored). The reader memory-maps the frames, so any frame is accessed
+    in O(1) without reading the rest of the file.
+"""
+
+import numpy as np
+import json
+import ast
+import os
+
+MAGIC = 'ENVTBTRJ'
+VERSION = 1
+
+
+def frame_dtype(nsites, dtype=np.complex128, expansion_size=0,
+                expansion_dtype=np.float64, observables=()):
+    """
+    The numpy dtype of one frame.
+
+    nsites: length of the wave function
+    dtype: dtype of the wave function, e.g. np.complex64 to halve the
+           file size
+    expansion_size: number of expansion coefficients per frame (0: none)
+    observables: names of scalar (float) observables stored per frame
+    """
+    fields = [('time', '<f8'), ('wf', np.dtype(dtype).newbyteorder('<'), (nsites,))]
+    if expansion_size:
+        fields.append(('expansion', np.dtype(expansion_dtype).newbyteorder('<'),
+                       (expansion_size,)))
+    for name in observables:
+        fields.append((str(name), '<f8'))
+    return np.dtype(fields)
+
+
+def is_trajectory(file_name):
+    """
+    True if the file is a trajectory file (and not e.g. a text file written
+    by WaveFunction.save_wave_function_data()).
+    """
+    try:
+        f = open(file_name, 'rb')
+    except IOError:
+        return False
+    try:
+        return f.read(len(MAGIC)) == MAGIC
+    finally:
+        f.close()
+
+
+def _read_header(f):
+    if f.read(len(MAGIC)) != MAGIC:
+        raise ValueError('%s is not a trajectory file' % f.name)
+    length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+    header = json.loads(f.read(length))
+    descr = []
+    for field in header['dtype']:
+        if len(field) == 3:
+            descr.append((str(field[0]), str(field[1]), tuple(field[2])))
+        else:
+            descr.append((str(field[0]), str(field[1])))
+    dtype = np.dtype(descr)
+    return header, dtype, len(MAGIC) + 8 + length
+
+
+class TrajectoryWriter(object):
+    """
+    Streaming writer of a trajectory file. Frames are appended with
+    write() directly from the propagation loop.
+
+    Usage:
+
+        traj = TrajectoryWriter('wf.trj', len(wf), expansion_size=len(v[0]),
+                                observables=['x', 'y', 'j_x', 'j_y'])
+        for ...:
+            traj.write(time, wf, expansion=c, x=x, y=y, j_x=j_x, j_y=j_y)
+        traj.close()
+    """
+
+    def __init__(self, file_name, nsites=None, dtype=np.complex128,
+                 expansion_size=0, expansion_dtype=np.float64,
+                 observables=(), description=None, append=False):
+        """
+        file_name: name of the trajectory file
+        nsites, dtype, expansion_size, expansion_dtype, observables: see
+            frame_dtype()
+        description: json-serializable description of the run (parameters)
+        append: append to an existing trajectory (e.g. to continue a run).
+                Its frame layout is used, the other parameters are ignored.
+        """
+        self.file_name = file_name
+        if append and os.path.exists(file_name):
+            f = open(file_name, 'rb')
+            try:
+                self.header, self.dtype, self.offset = _read_header(f)
+            finally:
+                f.close()
+            self.file = open(file_name, 'r+b')
+            # drop an incomplete last frame
+            size = os.path.getsize(file_name) - self.offset
+            self.file.truncate(self.offset + size - size % self.dtype.itemsize)
+            self.file.seek(0, 2)
+            return
+
+        if nsites is None:
+            raise ValueError('nsites is needed for a new trajectory')
+        self.dtype = frame_dtype(nsites, dtype, expansion_size,
+                                 expansion_dtype, observables)
+        self.header = {'version': VERSION,
+                       'dtype': self.dtype.descr,
+                       'observables': list(observables),
+                       'description': description}
+        header = json.dumps(self.header)
+        length = len(header) + 64 - (len(MAGIC) + 8 + len(header)) % 64
+        self.file = open(file_name, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(np.array([length], dtype='<u8').tostring())
+        self.file.write(header.ljust(length))
+        self.offset = len(MAGIC) + 8 + length
+
+    def write(self, time, wf, expansion=None, **observables):
+        """
+        Appends a frame.
+
+        time: time of the frame
+        wf: wave function (array or WaveFunction instance)
+        expansion: expansion coefficients, if the trajectory stores them
+        observables: values of the observables, missing ones are nan
+        """
+        frame = np.zeros((), dtype=self.dtype)
+        frame['time'] = time
+        frame['wf'] = getattr(wf, 'wf1d', wf)
+        if expansion is not None:
+            frame['expansion'] = expansion
+        for name in self.header['observables']:
+            frame[name] = observables.pop(name, np.nan)
+        if observables:
+            raise ValueError('unknown observables %s' % observables.keys())
+        self.file.write(frame.tostring())
+
+    def __len__(self):
+        """
+        Number of frames written.
+        """
+        return (self.file.tell() - self.offset) // self.dtype.itemsize
+
+    def truncate(self, nframes):
+        """
+        Drops the frames after the first nframes, e.g. those written after
+        the checkpoint a run is continued from.
+        """
+        self.file.flush()
+        self.file.seek(self.offset + min(nframes, len(self)) * self.dtype.itemsize)
+        self.file.truncate()
+        return None
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+# end class TrajectoryWriter
+
+
+class Trajectory(object):
+    """
+    Read access to a trajectory file. The frames are memory-mapped, so
+    only the accessed frames are read from disk.
+
+    traj = Trajectory('wf.trj')
+    len(traj)            number of frames
+    traj.times           array of the times
+    traj.wave_function(n) wave function of frame n
+    traj['j_x']          observable (or 'time', 'wf', 'expansion') of all
+                         frames, as memory-mapped array
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        f = open(file_name, 'rb')
+        try:
+            self.header, self.dtype, self.offset = _read_header(f)
+        finally:
+            f.close()
+        self.description = self.header.get('description')
+        self.observables = self.header.get('observables', [])
+        nframes = (os.path.getsize(file_name) - self.offset) // self.dtype.itemsize
+        if nframes > 0:
+            self.frames = np.memmap(file_name, dtype=self.dtype, mode='r',
+                                    offset=self.offset, shape=(nframes,))
+        else:
+            self.frames = np.zeros(0, dtype=self.dtype)
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __getitem__(self, name):
+        return self.frames[name]
+
+    @property
+    def times(self):
+        return np.array(self.frames['time'])
+
+    def wave_function(self, n):
+        """
+        The wave function of frame n (negative n counts from the end).
+        """
+        return np.array(self.frames['wf'][n])
+
+    def frame(self, n):
+        """
+        time, wave function of frame n
+        """
+        return float(self.frames['time'][n]), self.wave_function(n)
+
+# end class Trajectory
+
+
+def read_legacy_frame(file_name, n=0):
+    """
+    Reads frame n of a text file written by
+    WaveFunction.save_wave_function_data() (one line 'param   [wf]' per
+    frame). Only the lines up to frame n are read, and the values are
+    parsed with ast.literal_eval instead of eval. Negative n counts from
+    the end (then the whole file is read).
+
+    Return:
+    tm, wf
+    """
+    f = open(file_name, 'r')
+    try:
+        if n < 0:
+            line = f.readlines()[n]
+        else:
+            nframes = 0
+            for line in f:
+                if nframes == n:
+                    break
+                nframes += 1
+            else:
+                raise IndexError('%s has only %d frames' % (file_name, nframes))
+    finally:
+        f.close()
+    lnS = line.split('   ')
+    return float(lnS[0]), np.array(ast.literal_eval(lnS[1]))
+
+
+def read_frame(file_name, n=0):
+    """
+    tm, wf of frame n of a trajectory file or a legacy text file.
+    """
+    if is_trajectory(file_name):
+        return Trajectory(file_name).frame(n)
+    return read_legacy_frame(file_name, n)
+
+
+def read_frames(file_name, numbers):
+    """
+    tm, wf of several frames of a trajectory file or a legacy text file.
+    A legacy file is read in one pass up to the last requested frame.
+
+    numbers: frame numbers (not negative)
+
+    Return:
+    list of (tm, wf) in the order of numbers
+    """
+    if is_trajectory(file_name):
+        traj = Trajectory(file_name)
+        return [traj.frame(n) for n in numbers]
+    wanted = set(numbers)
+    frames = {}
+    f = open(file_name, 'r')
+    try:
+        for i, line in enumerate(f):
+            if i in wanted:
+                lnS = line.split('   ')
+                frames[i] = (float(lnS[0]), np.array(ast.literal_eval(lnS[1])))
+                if len(frames) == len(wanted):
+                    break
+    finally:
+        f.close()
+    missing = wanted.difference(frames)
+    if missing:
+        raise IndexError('frames %s not in %s' % (sorted(missing), file_name))
+    return [frames[n] for n in numbers]
+
+
+def convert_legacy(file_name, trajectory_name, dtype=np.complex128):
+    """
+    Converts a text file written by WaveFunction.save_wave_function_data()
+    into a trajectory file, streaming line by line.
+    """
+    writer = None
+    f = open(file_name, 'r')
+    try:
+        for line in f:
+            lnS = line.split('   ')
+            wf = np.array(ast.literal_eval(lnS[1]))
+            if writer is None:
+                writer = TrajectoryWriter(trajectory_name, len(wf), dtype=dtype)
+            writer.write(float(lnS[0]), wf)
+    finally:
+        f.close()
+        if writer is not None:
+            writer.close()
+    return None
@@ -1,5 +1,4 @@
 import numpy as np
-import math
 try:
     import matplotlib.pylab as plt
     from mpl_toolkits.mplot3d import Axes3D
@@ -11,6 +10,22 @@ except:
 # amplitude of the field should be in V/m
 
 class VectorPotential:
+    """
+    Base class of the laser pulses. A pulse is
+
+    A_x' = sign * E0 / omega / sqrt(2) * env(t) * sin(phase(t))
+    A_y' = sign * E0 / omega / sqrt(2) * env(t) * sin(phase(t) + polarization)
+
+    rotated by 45 degrees and into the direction of the pulse. Subclasses
+    define phase(t), envelope(t) and, if possible, envelope_derivative(t)
+    for the analytic electric field. All of them work on numpy arrays, so
+    a pulse is evaluated on a whole time grid at once: A(t) returns an
+    array of shape (2,) for a scalar t and (len(t), 2) for an array t.
+    """
+
+    sign = 1.0
+    polarization = 0.0
+    CEP = 0.0
 
     def __init__(self):
         self.frequency = None
@@ -20,9 +35,56 @@ class VectorPotential:
     def __envelope(self, t):
         pass
 
+    def phase(self, t):
+        return self.frequency * t + self.CEP
+
+    def envelope(self, t):
+        return np.ones_like(t)
+
+    def envelope_derivative(self, t):
+        return np.zeros_like(t)
+
+    def _rotate(self, VecPot_x, VecPot_y):
+        VecPot_x1 = np.sqrt(2.)/2.*(VecPot_x+VecPot_y)
+        VecPot_y1 = np.sqrt(2.)/2.*(VecPot_x-VecPot_y)
+        return np.stack([self.direction[0] * VecPot_x1 - self.direction[1] * VecPot_y1,
+                         self.direction[1] * VecPot_x1 + self.direction[0] * VecPot_y1], axis=-1)
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        amplitude = self.sign * self.amplitude / self.frequency / np.sqrt(2.)
+        env = self.envelope(t)
+        phase = self.phase(t)
+        return self._rotate(amplitude * np.sin(phase) * env,
+                            amplitude * np.sin(phase + self.polarization) * env)
+
     def get_electric_field(self, t):
-        dt = 0.01 * 10**(-16)
-        return [-(self(t + dt)[0] - self(1.*t)[0]) / dt, -(self(t + dt)[1] - self(1.*t)[1]) / dt]
+        """
+        E = -dA/dt, analytic if the pulse defines envelope_derivative,
+        otherwise by a (vectorized) central difference.
+
+        Return:
+        array of shape (2,) for a scalar t, (len(t), 2) for an array t
+        """
+        t = np.asarray(t, dtype=float)
+        if self.envelope_derivative is None:
+            dt = 10**(-5) / self.frequency
+            return -(self(t + dt) - self(t - dt)) / (2. * dt)
+        amplitude = self.sign * self.amplitude / self.frequency / np.sqrt(2.)
+        env = self.envelope(t)
+        denv = self.envelope_derivative(t)
+        phase = self.phase(t)
+        return -self._rotate(
+            amplitude * (np.sin(phase) * denv + self.frequency * np.cos(phase) * env),
+            amplitude * (np.sin(phase + self.polarization) * denv +
+                         self.frequency * np.cos(phase + self.polarization) * env))
+
+    def on_grid(self, start, dt, n):
+        """
+        The pulse tabulated on the time grid start + k * dt, k = 0 ... n-1,
+        e.g. the time steps of a propagation. See TabulatedVectorPotential.
+        """
+        return TabulatedVectorPotential(self, start, dt, n)
 
     def get_magnetic_filed(self):
         pass
@@ -32,25 +94,25 @@ class VectorPotential:
             tarr = np.linspace(-0.1 / self.frequency, 7 * np.pi / self.frequency, 100)
         else:
             tarr = trange
+        E = self.get_electric_field(tarr)
         plt.subplot(1,2,1)
-        Ex = [self.get_electric_field(t)[0] for t in tarr]
-        plt.plot(tarr, Ex, label = r'$E_x$', **kwrds)
+        plt.plot(tarr, E[:, 0], label = r'$E_x$', **kwrds)
         plt.subplot(1,2,2)
-        Ey = [self.get_electric_field(t)[1] for t in tarr]
-        plt.plot(tarr, Ey, label = r'$E_y$', **kwrds)
+        plt.plot(tarr, E[:, 1], label = r'$E_y$', **kwrds)
 
     def plot_vector_potential(self, trange=None, **kwrds):
         if trange is None:
             tarr = np.linspace(-0.1 / self.frequency, 7 * np.pi / self.frequency, 100)
         else:
             tarr = trange
+        A = self(tarr)
+        Ax = A[:, 0]
+        Ay = A[:, 1]
         plt.subplot(1,2,1)
-        Ax = [self.__call__(t)[0] for t in tarr]
         plt.plot(tarr, Ax, label=r'$A_x$', **kwrds)
         plt.xlabel(r'$t, s$', fontsize=24)
         plt.ylim(1.1*min(Ax), 1.1 * max(Ax))
         plt.subplot(1,2,2)
-        Ay = [self.__call__(t)[1] for t in tarr]
         plt.plot(tarr, Ay, label=r'$A_y$', **kwrds)
         plt.xlabel(r'$t, s$', fontsize=24)
         plt.ylim(1.1 * min(Ay), 1.1 * max(Ay))
@@ -60,8 +122,9 @@ class VectorPotential:
             tarr = np.linspace(-0.1 / self.frequency, 7 * np.pi / self.frequency, 100)
         else:
             tarr = trange
-        Ax = [self.__call__(t)[0] for t in tarr]
-        Ay = [self.__call__(t)[1] for t in tarr]
+        A = self(tarr)
+        Ax = A[:, 0]
+        Ay = A[:, 1]
         fig = plt.figure(figsize=figsize)
         ax = fig.gca(projection='3d')
         ax.plot(Ax, Ay, tarr, label='parametric curve')
@@ -72,12 +135,8 @@ class VectorPotential:
 
     def make_fourier_transform(self, tarr):
 
-        Ax = [self.__call__(t)[0] for t in tarr]
-        Ay = [self.__call__(t)[1] for t in tarr]
-
-        Axfft = np.fft.fft(np.array(Ax))
-        Ayfft = np.fft.fft(np.array(Ay))
-        return Axfft, Ayfft
+        Afft = np.fft.fft(self(tarr), axis=0)
+        return Afft[:, 0], Afft[:, 1]
 
     def plot_fourier_transform(self, trange=None, scale='log', **kwrds):
         '''
@@ -99,9 +158,7 @@ class VectorPotential:
         energy = np.fft.fftfreq(n, d=time_step) * 4.1357 * 10**(-15) 
 
         max_en = max(energy)
-        for i in xrange(0, len(energy)):
-           if energy[i]<0:
-              energy[i] += 2.*max_en
+        energy[energy < 0] += 2.*max_en
 
         plt.subplot(1,2,1)
         if scale=='lin':
@@ -132,7 +189,7 @@ class VectorPotential:
         else:
             tarr = trange
 
-        env = np.array([self.envelope(t) for t in tarr])
+        env = self.envelope(np.asarray(tarr, dtype=float))
         Ax = self.amplitude / self.frequency / np.sqrt(2.) * env
         Ay = self.amplitude / self.frequency / np.sqrt(2.) * env
         Ax1 = np.sqrt(2.)/2.*(Ax+Ay)
@@ -154,16 +211,13 @@ class VectorPotentialWave(VectorPotential):
         """
         self.amplitude= amplitude_E0
         self.frequency = frequency
+        # a continuous wave does not end
+        self.pulse_duration = np.inf
         norm = np.sqrt(direction[0]**2+direction[1]**2)
         self.polarization = polarization
         self.direction = np.array(direction)/norm
 
-    def __call__(self, t):
-        VecPot_x = self.amplitude / self.frequency / np.sqrt(2.) * np.sin(self.frequency * t)
-        VecPot_y = self.amplitude / self.frequency / np.sqrt(2.) * np.sin(self.frequency * t+self.polarization)
-        VecPot_x1 = np.sqrt(2.)/2.*(VecPot_x+VecPot_y)
-        VecPot_y1 = np.sqrt(2.)/2.*(VecPot_x-VecPot_y)
-        return [self.direction[0] * VecPot_x1 - self.direction[1] * VecPot_y1,  self.direction[1] * VecPot_x1 + self.direction[0] * VecPot_y1]
+# end class VectorPotentialWave
 
 
 class FlatTopPulse(VectorPotential):
@@ -188,25 +242,16 @@ class FlatTopPulse(VectorPotential):
 
     def envelope(self, t):
 
-        if t < 0 or t > self.pulse_duration + 2.*self.Tramp:
-            return 0.0
-        elif t >= 0 and t <= self.Tramp:
-
-            return t / self.Tramp
-        elif t > self.pulse_duration + self.Tramp:
-            return 2 + (self.pulse_duration - t) / self.Tramp 
-        else:
-            return 1.0
-
+        t = np.asarray(t, dtype=float)
+        return np.clip(np.minimum(t / self.Tramp,
+                                  2 + (self.pulse_duration - t) / self.Tramp), 0.0, 1.0)
 
-    def __call__(self, t):
+    def envelope_derivative(self, t):
 
-        env = self.envelope(t)
-        VecPot_x = self.amplitude / self.frequency / np.sqrt(2.) * np.sin(self.frequency * t) * env
-        VecPot_y = self.amplitude / self.frequency / np.sqrt(2.) * np.sin(self.frequency * t+self.polarization) * env
-        VecPot_x1 = np.sqrt(2.)/2.*(VecPot_x+VecPot_y)
-        VecPot_y1 = np.sqrt(2.)/2.*(VecPot_x-VecPot_y)
-        return [self.direction[0] * VecPot_x1 - self.direction[1] * VecPot_y1,  self.direction[1] * VecPot_x1 + self.direction[0] * VecPot_y1]
+        t = np.asarray(t, dtype=float)
+        rise = (t > 0) & (t < self.Tramp)
+        fall = (t > self.pulse_duration + self.Tramp) & (t < self.pulse_duration + 2.*self.Tramp)
+        return (rise.astype(float) - fall.astype(float)) / self.Tramp
 
 
 # end class FlatTopPulse
@@ -234,24 +279,19 @@ class SinSqEnvelopePulse(VectorPotential):
         self.CEP = cep
         self.polarization=polarization
 
-    def envelope(self, t):
+    sign = -1.0
 
-        if t >= 0 and t < self.pulse_duration:
-            return  np.sin(self.frequency * t / 2./self.Nc)**2
-        else:
-           return 0.0
+    def envelope(self, t):
 
-    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        return np.where((t >= 0) & (t < self.pulse_duration),
+                        np.sin(self.frequency * t / 2./self.Nc)**2, 0.0)
 
-        env = self.envelope(t)
+    def envelope_derivative(self, t):
 
-        VecPot_x = -self.amplitude / self.frequency / np.sqrt(2.) *\
-                  np.sin(self.frequency * t + self.CEP) * env
-        VecPot_y = -self.amplitude / self.frequency / np.sqrt(2.) *\
-                  np.sin(self.frequency * t + self.CEP + self.polarization) * env
-        VecPot_x1 = np.sqrt(2.)/2.*(VecPot_x+VecPot_y)
-        VecPot_y1 = np.sqrt(2.)/2.*(VecPot_x-VecPot_y)
-        return [self.direction[0] * VecPot_x1 - self.direction[1] * VecPot_y1,  self.direction[1] * VecPot_x1 + self.direction[0] * VecPot_y1]
+        t = np.asarray(t, dtype=float)
+        return np.where((t >= 0) & (t < self.pulse_duration),
+                        self.frequency / 2. / self.Nc * np.sin(self.frequency * t / self.Nc), 0.0)
 
 # end class SinSqEnvelopePulse
 
@@ -292,25 +332,23 @@ class GaussianEnvelopePulse(VectorPotential):
         print 't0', self.t0
         print 'tc', self.tc
 
+    sign = -1.0
+
+    def phase(self, t):
+        return self.frequency * (t-self.tc) + self.CEP
+
     def envelope(self, t):
-        return math.exp(-((t-self.tc)/self.t0)**2/0.7213)
+        return np.exp(-((t-self.tc)/self.t0)**2/0.7213)
 
-    def __call__(self, t):
-        env = self.envelope(t)
-        VecPot_x = -self.amplitude / self.frequency / np.sqrt(2) *\
-                 math.sin(self.frequency * (t-self.tc) + self.CEP) * env
-        VecPot_y = -self.amplitude / self.frequency / np.sqrt(2) *\
-                 math.sin(self.frequency * (t-self.tc) + self.CEP + self.polarization) * env
-        VecPot_x1 = np.sqrt(2.)/2.*(VecPot_x+VecPot_y)
-        VecPot_y1 = np.sqrt(2.)/2.*(VecPot_x-VecPot_y)
-        return [self.direction[0] * VecPot_x1 - self.direction[1] * VecPot_y1,  self.direction[1] * VecPot_x1 + self.direction[0] * VecPot_y1]
+    def envelope_derivative(self, t):
+        return -2. * (t-self.tc) / self.t0**2 / 0.7213 * self.envelope(t)
 
 # end class GaussianEnvelopePulse
 
 
 class CustomEnvelopePulse(VectorPotential):
 
-    def __init__(self, amplitude_E0, frequency, envelope=(lambda t: math.exp(-((t-0.1)/0.1)**2/0.7213)), Nc=1, cep=0.0, direction=[1.0,0.0], polarization=0.0):
+    def __init__(self, amplitude_E0, frequency, envelope=(lambda t: np.exp(-((t-0.1)/0.1)**2/0.7213)), Nc=1, cep=0.0, direction=[1.0,0.0], polarization=0.0, envelope_derivative=None):
 
         """
         This class contains vector potential of a laser field
@@ -319,6 +357,11 @@ class CustomEnvelopePulse(VectorPotential):
         amplitude_E0: is the peak filed strength
 
         frequency: pulse frequency
+
+        envelope: function of the time, preferably working on numpy arrays
+
+        envelope_derivative: derivative of the envelope for the analytic
+        electric field (optional, otherwise numerical differentiation)
         """
 
         self.amplitude= amplitude_E0
@@ -328,16 +371,86 @@ class CustomEnvelopePulse(VectorPotential):
         self.direction = np.array(direction) / norm
         self.CEP = cep
         self.polarization=polarization
-        self.envelope = envelope
+        self.custom_envelope = envelope
+        self.envelope_derivative = envelope_derivative
 
-    def __call__(self, t):
-        env = self.envelope(t)
-        VecPot_x = -self.amplitude / self.frequency / np.sqrt(2) *\
-                 math.sin(self.frequency * t + self.CEP) * env
-        VecPot_y = -self.amplitude / self.frequency / np.sqrt(2) *\
-                 math.sin(self.frequency * t + self.CEP + self.polarization) * env
-        VecPot_x1 = np.sqrt(2.)/2.*(VecPot_x+VecPot_y)
-        VecPot_y1 = np.sqrt(2.)/2.*(VecPot_x-VecPot_y)
-        return [self.direction[0] * VecPot_x1 - self.direction[1] * VecPot_y1,  self.direction[1] * VecPot_x1 + self.direction[0] * VecPot_y1]
+    sign = -1.0
+
+    def envelope(self, t):
+        """
+        The envelope function is called with the time array; envelopes
+        written for scalar t (e.g. with math.exp) are vectorized.
+        """
+        try:
+            return np.asarray(self.custom_envelope(t), dtype=float) * np.ones_like(t)
+        except TypeError:
+            return np.vectorize(self.custom_envelope, otypes=[float])(t)
 
 # end class CustomEnvelopePulse
+
+
+class PulseSequence(VectorPotential):
+    """
+    Sum of several vector potentials, e.g. pump and probe pulses.
+
+    pulses: list of VectorPotential instances
+    delays: time shift of each pulse (default 0)
+    """
+
+    def __init__(self, pulses, delays=None):
+        self.pulses = pulses
+        if delays is None:
+            delays = [0.0] * len(pulses)
+        self.delays = delays
+        self.frequency = min(pulse.frequency for pulse in pulses)
+        self.amplitude = max(pulse.amplitude for pulse in pulses)
+        durations = [getattr(pulse, 'pulse_duration', None) for pulse in pulses]
+        if None in durations:
+            self.pulse_duration = None
+        else:
+            self.pulse_duration = max(duration + delay
+                                      for duration, delay in zip(durations, delays))
+
+    def __call__(self, t):
+        t = np.asarray(t, dtype=float)
+        return sum(pulse(t - delay) for pulse, delay in zip(self.pulses, self.delays))
+
+    def get_electric_field(self, t):
+        t = np.asarray(t, dtype=float)
+        return sum(pulse.get_electric_field(t - delay)
+                   for pulse, delay in zip(self.pulses, self.delays))
+
+# end class PulseSequence
+
+
+class TabulatedVectorPotential(VectorPotential):
+    """
+    A vector potential precomputed on the time grid start + k * dt,
+    k = 0 ... n-1 (one vectorized evaluation). Calls at grid points are
+    answered from the table, other times are passed to the pulse.
+    """
+
+    def __init__(self, pulse, start, dt, n):
+        self.pulse = pulse
+        self.start = start
+        self.dt = dt
+        self.times = start + dt * np.arange(n)
+        self.values = pulse(self.times)
+        self.frequency = pulse.frequency
+        self.amplitude = pulse.amplitude
+        self.pulse_duration = getattr(pulse, 'pulse_duration', None)
+
+    def __call__(self, t):
+        if np.ndim(t) == 0:
+            k = int(round((t - self.start) / self.dt))
+            if 0 <= k < len(self.times) and abs(self.times[k] - t) <= 10**(-9) * abs(self.dt):
+                return self.values[k]
+        return self.pulse(t)
+
+    def get_electric_field(self, t):
+        return self.pulse.get_electric_field(t)
+
+    def on_grid(self, start, dt, n):
+        return self.pulse.on_grid(start, dt, n)
+
+# end class TabulatedVectorPotential
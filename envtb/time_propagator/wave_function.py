@@ -1,5 +1,9 @@
 import numpy as np
+import scipy.sparse.linalg
 import envtb.ldos.plotter
+import envtb.ldos.kpm
+import observables
+import trajectory
 try:
     import matplotlib.pylab as plt
 except:
@@ -33,6 +37,16 @@ class WaveFunction(object):
             np.abs(self.wf1d), self.coords, max_el=maxel, **kwrds)
         plt.axes().set_aspect('equal')
 
+    def coords_array(self):
+        """
+        The coordinates as float array of shape (number of sites, dimension).
+        The array is cached as long as self.coords is not replaced.
+        """
+        if getattr(self, '_coords_source', None) is not self.coords:
+            self._coords_array = observables.coordinates_array(self.coords)
+            self._coords_source = self.coords
+        return self._coords_array
+
     def calculate_average_position(self):
         """
         The function returns the average position of the wave packet on the grid
@@ -43,64 +57,62 @@ class WaveFunction(object):
         Return:
         x_aver, y_aver
         """
-        f_aver = sum([np.abs(self.wf1d[i])**2 for i in xrange(len(self.wf1d))])
-        x_aver = sum([np.abs(self.wf1d[i])**2 * self.coords[i][0]
-                      for i in xrange(len(self.wf1d))]) / f_aver
-        y_aver = sum([np.abs(self.wf1d[i])**2 * self.coords[i][1]
-                      for i in xrange(len(self.wf1d))]) / f_aver
-
-        return x_aver, y_aver
+        position = observables.average_position(self.wf1d, self.coords_array())
+        return position[0], position[1]
 
-    def calculate_current(self, A):
-
-        wf_prime_x = []
-        wf_prime_y = []
-        n = len(self.wf1d)
-        for i in xrange(n-1):
-            if abs(self.coords[i+1][0] - self.coords[i][0]) > 0:
-                wf_prime_x.append((self.wf1d[i+1]-self.wf1d[i]) / (self.coords[i+1][0] - self.coords[i][0]))
-            else:
-                wf_prime_x.append(0.0)
-
-            if abs(self.coords[i+1][1] - self.coords[i][1]) > 0:
-                wf_prime_y.append((self.wf1d[i+1]-self.wf1d[i]) / (self.coords[i+1][1] - self.coords[i][1]))
-            else:
-                wf_prime_y.append(0.0)
-
-        wf_prime_x.append(0)
-        wf_prime_y.append(0)
+    def calculate_current(self, ham):
+        """
+        The function returns the current (expectation value of the velocity
+        operator, hbar = 1) from the bond currents Im(wf_i^* H_ij wf_j)
 
-        j_x = - (np.dot(np.conjugate(np.array(self.wf1d)), np.array(wf_prime_x)) -
-                np.dot(np.array(self.wf1d), np.conjugate(np.array(wf_prime_x)))) * complex(0.0, 1.0)\
-                + A[0] * np.dot(np.array(self.wf1d), np.conjugate(np.array(self.wf1d)))
+        In:
+        ham: hamiltonian (instance or sparse matrix) the wave function is
+             propagated with, including the vector potential
 
-        j_y = - (np.dot(np.conjugate(np.array(self.wf1d)), np.array(wf_prime_y)) -
-               np.dot(np.array(self.wf1d), np.conjugate(np.array(wf_prime_y)))) * complex(0.0, 1.0)\
-                + A[1] * np.dot(np.array(self.wf1d), np.conjugate(np.array(self.wf1d)))
+        Return:
+        j_x, j_y
+        """
+        current = observables.total_current(self.wf1d, ham, self.coords_array())
+        return current[0], current[1]
 
-        return j_x, j_y
+    def calculate_observables(self, ham=None, v=None):
+        """
+        All observables of the wave function in one pass, see
+        envtb.time_propagator.observables.frame_observables()
+        """
+        return observables.frame_observables(self.wf1d, self.coords_array(),
+                                             ham=ham, v=v)
 
     def calculate_polarization(self):
         pass
 
     def wave_function_from_file(self, file_name, wf_num=-1):
+        """
+        Reads frame wf_num of a trajectory file (or of a text file written
+        by earlier versions of save_wave_function_data) into self.wf1d
 
-        f_in = open(file_name,'r')
-        ln = f_in.readlines()
-        lnS = ln[wf_num].split('   ')
-        tm = float(lnS[0])
-        self.wf1d = np.array(eval(lnS[1]))
-
+        Return:
+        time of the frame
+        """
+        tm, self.wf1d = trajectory.read_frame(file_name, wf_num)
         return tm
 
     def expand_wave_function(self, v):
-        return [np.abs(np.dot(np.conjugate(np.transpose(v[:,i])), self.wf1d))
-                for i in xrange(len(v[0,:]))]
+        return np.abs(observables.expansion_coefficients(self.wf1d, v))
+
+    def save_wave_function_data(self, file_out, param=None):
+        """
+        Appends the wave function to file_out
 
-    @staticmethod
-    def save_wave_function_data(wave_function, file_out, param=None):
-        print 'Hi!'
-        file_out.writelines(`param`+'   '+`wave_function.tolist()`+'\n')
+        In:
+        file_out: trajectory.TrajectoryWriter, or an open text file (one
+                  line 'param   [wf]' per frame, slow, for small systems)
+        param: time of the frame
+        """
+        if isinstance(file_out, trajectory.TrajectoryWriter):
+            file_out.write(param, self.wf1d)
+        else:
+            file_out.writelines(`param`+'   '+`self.wf1d.tolist()`+'\n')
         return None
 
     def save_wave_function_pic(self, pic_out, maxel=None, figuresize=(20,10), **kwrds):
@@ -114,16 +126,15 @@ class WaveFunction(object):
         return None
 
     def save_wave_function_expansion(self, file_out, v):
-        a = self.expand_wave_function(v)
+        a = self.expand_wave_function(v).tolist()
         file_out.writelines(`a`+'\n')
         return None
 
-    def save_coords_current(self, file_out, A):
+    def save_coords_current(self, file_out, ham):
 
-        x, y = self.calculate_average_position()
-        j_x, j_y = self.calculate_current(A)
-        x = np.abs(x)
-        y = np.abs(y)
+        frame = self.calculate_observables(ham=ham)
+        x, y = np.abs(frame['position'][:2])
+        j_x, j_y = frame['current'][:2]
         file_out.writelines('%(x)f   %(y)f' %vars()+'   '+  str(j_x) + '   '+str(j_y) + '\n')
 
         return None
@@ -131,6 +142,15 @@ class WaveFunction(object):
 # end class WaveFunction
 
 class GaussianWavePacket(WaveFunction):
+    """
+    Gaussian wave packet(s) exp(-|r - r_c|^2 / 2 sigma^2 + i p0 (r - r_c))
+    centred at the site ic.
+
+    For a batch of packets, ic, p0 and/or sigma are lists (p0: list of
+    [p_x, p_y]) with one entry per packet, shorter ones are broadcast.
+    wf1d is then an array of shape (N, number of packets), each column
+    normalized.
+    """
 
     def __init__(self, coords, ic, p0=[0.0, 0.0], sigma=5.):
 
@@ -156,13 +176,22 @@ class GaussianWavePacket(WaveFunction):
 
     def setup(self):
 
-        wp1d = np.array([
-            self.gauss_function(self.coords[k][0], self.coords[k][1])
-            for k in xrange(self.Ntot)])
+        batch = np.ndim(self.ic) > 0 or np.ndim(self.p0) > 1 or \
+                np.ndim(self.sigma) > 0
+        coords = self.coords_array()[:, :2]
+        ic = np.atleast_1d(self.ic)
+        p0 = np.atleast_2d(np.asarray(self.p0, dtype=float))
+        sigma = np.atleast_1d(np.asarray(self.sigma, dtype=float))
 
-        norm = np.sum(np.dot(np.transpose(np.conjugate(wp1d)), wp1d))
-        wp1d = wp1d / np.sqrt(norm)
-        return wp1d
+        # (N, number of packets, 2)
+        d = coords[:, np.newaxis, :] - coords[ic][np.newaxis, :, :]
+        wp = np.exp(-np.sum(d**2, axis=2) / 2. / sigma**2 +
+                    1j * np.sum(p0 * d, axis=2)) / sigma / np.sqrt(np.pi)
+
+        wp = wp / np.sqrt(np.sum(np.abs(wp)**2, axis=0))
+        if batch:
+            return wp
+        return wp[:, 0]
 
 #end class GaussianWavePacket
 
@@ -175,25 +204,46 @@ class WaveFunction0(WaveFunction):
     ham - hamiltonian
 
     mu- fermi energy
+
+    kT - temperature (only for method='chebyshev')
+
+    method - 'eigsh': sum of the eigenstates below mu out of the k
+             eigenstates closest to sigma (hermitian shift-invert solve)
+             'chebyshev': the Fermi operator f(H) applied to a random
+             vector, i.e. a random superposition of the occupied states,
+             by a Chebyshev expansion with N moments. It needs only
+             sparse matrix-vector products, so it scales to very large
+             systems, but kT has to be finite (N >> bandwidth / kT).
     """
 
-    def __init__(self, ham, mu, kT):
+    def __init__(self, ham, mu, kT, method='eigsh', k=20, sigma=0.0,
+                 N=None, seed=None):
 
         self.ham = ham
-        self.wf1d = self.setup(mu, kT)
         self.coords = self.ham.coords
+        if method == 'eigsh':
+            self.wf1d = self.setup(mu, kT, k=k, sigma=sigma)
+        elif method == 'chebyshev':
+            self.wf1d = self.setup_chebyshev(mu, kT, N=N, seed=seed)
+        else:
+            raise ValueError('unknown method %s' % method)
+
+    def setup(self, mu, kT, k=20, sigma=0.0):
+        H = observables.hamiltonian_matrix(self.ham)
+        w, v = scipy.sparse.linalg.eigsh(H.tocsc(), k=k, sigma=sigma)
+        wf0 = np.sum(v[:, w <= mu], axis=1).astype(complex)
+        print np.sum(w <= mu)
+        norm = np.sum(np.abs(wf0)**2)
+        return wf0 / np.sqrt(norm)
 
-    def setup(self, mu, kT):
-        w, v = self.ham.eigenvalue_problem()
-        wf0 = np.zeros(len(v[:,0]), dtype = complex)
-        count = 0
-        for i in xrange(len(w)):
-            if w[i] <= mu:
-                count += 1
-                #ldos.plotter.Plotter().plot_density(ham.v[:,i], ham.coords)
-                #plt.show()
-                wf0[:] += v[:,i]
-        print count
+    def setup_chebyshev(self, mu, kT, N=None, seed=None):
+        H = observables.hamiltonian_matrix(self.ham)
+        a, b = envtb.ldos.kpm.spectral_bounds(H)
+        if N is None:
+            N = int(4 * a / kT) + 1
+        c = envtb.ldos.kpm.fermi_coefficients(N, mu, kT, a, b)
+        vec = envtb.ldos.kpm.random_vectors(H.shape[0], 1, seed)[:, 0]
+        wf0 = envtb.ldos.kpm.chebyshev_apply(H, c, a, b, vec)
         norm = np.sum(np.abs(wf0)**2)
         return wf0 / np.sqrt(norm)
 
@@ -9,70 +9,126 @@ import envtb.wannier90.w90hamiltonian as w90
 reload(w90)
 reload(fourier)
 from envtb.utility.fourier import GNRSimpleFourierTransform
+import envtb.time_propagator.trajectory as trajectory
 import copy
 import os
+import ast
 
 class NumericalData(object):
-
-    def __init__(self, dic_desc, file_name_wf, file_name_eig, file_name_cc, file_name_exp):
+    """
+    Output of a time propagation. The files are only read when the
+    corresponding attribute is accessed for the first time, and derived
+    quantities are calculated on demand; both are cached. Errors (e.g. a
+    missing file) are raised on access of the attribute.
+
+    Attributes:
+    eig: energy spectrum
+    expansion: expansion coefficients of the frames
+    x, y, j_x, j_y: average position and current of the frames
+    j_x_f, j_y_f: fourier transform of the current
+    wf: the first wave function
+    ro_0, ro: density matrices of the first and the last complete frame
+    trajectory: trajectory.Trajectory of file_name_wf (None for text files)
+
+    If file_name_exp or file_name_cc is None, the expansion or the
+    observables 'x', 'y', 'j_x', 'j_y' are taken from the trajectory.
+    """
+
+    def __init__(self, dic_desc, file_name_wf, file_name_eig, file_name_cc=None, file_name_exp=None):
         self.dic_desc = dic_desc
         self.file_name_wf = file_name_wf
         self.file_name_eig = file_name_eig
         self.file_name_cc = file_name_cc
         self.file_name_exp = file_name_exp
-        try:
-            self.eig = self.__get_energy_spectrum(file_name_eig)
-        except:
-            print 'exception', file_name_eig
-        try:
-            self.expansion = self.__get_expansion(file_name_exp)
-        except:
-            print 'exception', file_name_exp
-        try:
-            self.x, self.y, self.j_x, self.j_y = self.__get_time_coords_current(file_name_cc)
-        except:
-            print 'exception', file_name_cc
-        try:
-            self.j_x_f, self.j_y_f = self.__get_fourier_of_current(self.j_x, self.j_y)
-        except:
-            self.j_x_f = 0.0
-            self_j_y_f = 0.0
-        try:
-            self.wf = self.get_wave_function_from_file(file_name_wf)[1]
-        except:
-            print 'exception', file_name_wf
-        try:
-            self.ro_0, self.ro = self.calculate_density_matrix(self.expansion)
-        except:
-            print 'exception', 'den_matrix'
+        self.__cache = {}
+
+    def __cached(self, name, calculate):
+        if name not in self.__cache:
+            self.__cache[name] = calculate()
+        return self.__cache[name]
+
+    def clear_cache(self):
+        """
+        Forget all loaded data, e.g. to reload files of a running calculation.
+        """
+        self.__cache = {}
+
+    @property
+    def trajectory(self):
+        def load():
+            if trajectory.is_trajectory(self.file_name_wf):
+                return trajectory.Trajectory(self.file_name_wf)
+            return None
+        return self.__cached('trajectory', load)
+
+    @property
+    def eig(self):
+        return self.__cached('eig', lambda: self.__get_energy_spectrum(self.file_name_eig))
+
+    @property
+    def expansion(self):
+        def load():
+            if self.file_name_exp is None:
+                return np.array(self.trajectory['expansion'])
+            return self.__get_expansion(self.file_name_exp)
+        return self.__cached('expansion', load)
+
+    def __coords_current(self):
+        def load():
+            if self.file_name_cc is None:
+                return tuple(np.array(self.trajectory[name])
+                             for name in ['x', 'y', 'j_x', 'j_y'])
+            return self.__get_time_coords_current(self.file_name_cc)
+        return self.__cached('coords_current', load)
+
+    x = property(lambda self: self.__coords_current()[0])
+    y = property(lambda self: self.__coords_current()[1])
+    j_x = property(lambda self: self.__coords_current()[2])
+    j_y = property(lambda self: self.__coords_current()[3])
+
+    def __fourier_of_current(self):
+        return self.__cached('fourier', lambda: self.__get_fourier_of_current(self.j_x, self.j_y))
+
+    j_x_f = property(lambda self: self.__fourier_of_current()[0])
+    j_y_f = property(lambda self: self.__fourier_of_current()[1])
+
+    @property
+    def wf(self):
+        return self.__cached('wf', lambda: self.get_wave_function_from_file(self.file_name_wf)[1])
+
+    def __density_matrices(self):
+        return self.__cached('density_matrices', lambda: self.calculate_density_matrix(self.expansion))
+
+    ro_0 = property(lambda self: self.__density_matrices()[0])
+    ro = property(lambda self: self.__density_matrices()[1])
 
     def __get_energy_spectrum(self, file_name):
         f_eig = open(file_name, 'r')
-        eig = [eval(ln.split('   ')[0]) for ln in f_eig]
-        f_eig.close()
+        try:
+            eig = [ast.literal_eval(ln.split('   ', 1)[0]) for ln in f_eig]
+        finally:
+            f_eig.close()
         return np.array(eig)
 
     def __get_expansion(self,file_name):
+        """
+        The last line is skipped, it might be incomplete.
+        """
         f_exp = open(file_name, 'r')
-        ln_lines=f_exp.readlines()
-        c = [eval(ln) for ln in ln_lines[:-1]]
-        f_exp.close()
+        c = []
+        previous = None
+        try:
+            for ln in f_exp:
+                if previous is not None:
+                    c.append(ast.literal_eval(previous))
+                previous = ln
+        finally:
+            f_exp.close()
         return np.array(c)
 
     def __get_time_coords_current(self, file_name):
-        f_coords = open(file_name, 'r')
-        x = []
-        y = []
-        j_x = []
-        j_y = []
-        for ln in f_coords:
-            lnS = ln.split('   ')
-            x.append(float(lnS[0]))
-            y.append(float(lnS[1]))
-            j_x.append(float(lnS[2]))
-            j_y.append(float(lnS[3]))
-        f_coords.close()
-        return x, y, j_x, j_y
+        data = np.loadtxt(file_name, ndmin=2, usecols=(0, 1, 2, 3))
+        return data[:, 0], data[:, 1], data[:, 2], data[:, 3]
 
     def __get_fourier_of_current(self,j_x, j_y):
         j_x_w = np.fft.fft(np.array(j_x))
@@ -81,17 +137,22 @@ class NumericalData(object):
 
     @staticmethod
     def get_wave_function_from_file(file_name, Nwf=0):
-        fin = open(file_name,'r')
-        ln = fin.readlines()[Nwf]
-        lnS = ln.split('   ')
-        tm = float(lnS[0])
-        wf = np.array(eval(lnS[1]))
-        fin.close()
-        return tm, wf
+        return trajectory.read_frame(file_name, Nwf)
+
+    @staticmethod
+    def get_wave_functions_from_file(file_name, Nwfs):
+        """
+        list of (tm, wf) of the frames Nwfs, read in one pass
+        """
+        return trajectory.read_frames(file_name, Nwfs)
 
     def calculate_density_matrix(self, c):
-        ro_0 = np.array([[c[0,i]*c[0,j].conjugate() for i in xrange(len(c[0,:]))] for j in xrange(len(c[0,:]))])
-        ro = np.array([[c[-2,i]*c[-2,j].conjugate() for i in xrange(len(c[-2,:]))] for j in xrange(len(c[-2,:]))])
+        """
+        Density matrices ro[j, i] = c_i c_j^* of the first and of the second
+        to last expansion.
+        """
+        ro_0 = np.outer(np.conjugate(c[0]), c[0])
+        ro = np.outer(np.conjugate(c[-2]), c[-2])
         return ro_0, ro
 
 # end class NumericalData
@@ -115,12 +176,9 @@ class PlotNumericalData(object):
         return ins
 
     def calculate_pulse_field(self, time_array, Ax):
-        Ax_array = [Ax(t)[0] for t in time_array]
-        Ay_array = [Ax(t)[1] for t in time_array]
-        A_array=[Ax_array, Ay_array]
-        Ex_array = [10**(-12)*Ax.get_electric_field(t)[0] for t in time_array]
-        Ey_array = [10**(-12)*Ax.get_electric_field(t)[1] for t in time_array]
-        E_array=[Ex_array, Ey_array]
+        time_array = np.asarray(time_array, dtype=float)
+        A_array = list(Ax(time_array).T)
+        E_array = list(10**(-12) * Ax.get_electric_field(time_array).T)
         return A_array, E_array
 
     @staticmethod
@@ -362,9 +420,10 @@ class PlotNumericalData(object):
     def plot_wave_functions_stack(file_name, Nx, Ny, nx_s=3, ny_s=10, time_step=2, file_to_save='wf_stack.png', figuresize=(20,30)):
 
         plt.figure(figsize=figuresize)
-        for i in xrange(nx_s * ny_s):
+        frames = NumericalData.get_wave_functions_from_file(
+            file_name, [i*time_step for i in xrange(nx_s * ny_s)])
+        for i, (tm, wf) in enumerate(frames):
             plt.subplot(ny_s,nx_s,i+1)
-            tm, wf = NumericalData.get_wave_function_from_file(file_name, Nwf=i*time_step)
             PlotNumericalData.plot_wave_function(wf, Nx, Ny, file_to_save=None, figuresize=None)
             plt.title('%.2E' % tm)
 